@@ -0,0 +1,355 @@
+#!/usr/bin/python
+# AsyncSupport.py -- Single-threaded, asyncore-based control port client.
+
+"""
+AsyncSupport -- An asyncore-based alternative to TorCtl.Connection.
+
+A TorCtl.Connection runs two threads per connection and hands every reply
+and event between them through queues. An AsyncConnection instead lives in
+an asyncore loop: replies are parsed incrementally as data arrives, replies
+to commands are delivered to AsyncReply callbacks, and events are passed
+straight to the EventHandler's _handle1() on the loop. Any number of
+commands may be in flight at once, and several connections can share one
+loop.
+
+The commands mirror TorCtl.Connection (get_info, sendAndRecv, set_events,
+authenticate), but return an AsyncReply instead of blocking. Call
+result() on it to run the loop until the reply is in, or add_callback() to
+be called from the loop. Event handlers run on the loop, so they must use
+add_callback(): result() raises TorCtlError there. Handlers that expect
+commands to return their replies, such as TorCtl.ConsensusTracker, set
+sync_replies and are refused by set_event_handler().
+"""
+
+__all__ = ["ReplyParser", "AsyncReply", "AsyncConnection"]
+
+import asyncore
+import collections
+import time
+
+from TorUtil import plog, unescape_dots, ProtocolTrace
+import TorCtl
+
+class ReplyParser:
+  """ Incremental parser for control port replies. Data is fed in as it
+      arrives and complete replies are returned in the same form as
+      TorCtl.Connection._read_reply() returns them: (isEvent, lines), where
+      lines is a list of (code, message, data) tuples. """
+  def __init__(self):
+    self._buf = bytearray()
+    self._pos = 0       # Start of the unparsed data
+    self._lines = []    # Lines of the reply being parsed
+    self._block = None  # (code, message) of an unfinished "+" line
+    self._block_start = 0
+    self._scan = 0      # Where to look for the end of the data block
+
+  def _compact(self):
+    # _pos stays at the start of an unfinished data block, so everything
+    # before it has been consumed.
+    if self._pos and self._pos >= len(self._buf) - self._pos:
+      shift = self._pos
+      del self._buf[:shift]
+      self._pos = 0
+      self._block_start -= shift
+      self._scan -= shift
+
+  def feed(self, data):
+    """ Add 'data' and return the list of replies it completes. """
+    self._compact()
+    self._buf += data
+    replies = []
+    while 1:
+      if self._block:
+        idx = self._buf.find('\n', self._scan)
+        if idx < 0:
+          break
+        if idx+1-self._scan <= 8 and \
+            str(self._buf[self._scan:idx+1]) in TorCtl.DATA_TERMINATORS:
+          code, s = self._block
+          more = str(self._buf[self._block_start:self._scan])
+          self._lines.append((code, s, unescape_dots(more)))
+          self._block = None
+          self._pos = idx+1
+          # Need "250 OK" if it's not an event. Otherwise, end
+          if self._lines[0][0][0] == '6':
+            replies.append(self._finish())
+        else:
+          self._scan = idx+1
+        continue
+
+      idx = self._buf.find('\n', self._pos)
+      if idx < 0:
+        break
+      line = str(self._buf[self._pos:idx+1]).strip()
+      self._pos = idx+1
+      if len(line)<4:
+        raise TorCtl.ProtocolError("Badly formatted reply line: Too short")
+      code = line[:3]
+      tp = line[3]
+      s = line[4:]
+      if tp == "-":
+        self._lines.append((code, s, None))
+      elif tp == " ":
+        self._lines.append((code, s, None))
+        replies.append(self._finish())
+      elif tp == "+":
+        self._block = (code, s)
+        self._block_start = self._scan = self._pos
+      else:
+        raise TorCtl.ProtocolError("Badly formatted reply line: unknown type %r"%tp)
+    return replies
+
+  def _finish(self):
+    lines = self._lines
+    self._lines = []
+    return (lines[0][0][0] == '6', lines)
+
+class AsyncReply:
+  """ The pending reply to a command sent on an AsyncConnection. """
+  def __init__(self, conn, expectedTypes=None, parse=None):
+    self._conn = conn
+    self._expectedTypes = expectedTypes
+    self._parse = parse
+    self._done = False
+    self._result = None
+    self._error = None
+    self._callbacks = []
+
+  def add_callback(self, callback):
+    """ Call 'callback(result, error)' from the loop once the reply is in.
+        Exactly one of result and error is not None. """
+    if self._done:
+      callback(self._result, self._error)
+    else:
+      self._callbacks.append(callback)
+
+  def done(self):
+    """ Return true iff the reply has arrived (or the connection failed). """
+    return self._done
+
+  def _set(self, lines, error=None):
+    if error is None:
+      try:
+        if self._expectedTypes is not None:
+          TorCtl._check_reply(lines, self._expectedTypes)
+        if self._parse:
+          lines = self._parse(lines)
+      except TorCtl.TorCtlError, e:
+        error = e
+    self._done = True
+    if error is None:
+      self._result = lines
+    else:
+      self._error = error
+    for callback in self._callbacks:
+      try:
+        callback(self._result, self._error)
+      except:
+        plog("WARN", "Exception in reply callback")
+        self._conn._log_exception()
+    self._callbacks = []
+
+  def result(self, timeout=None):
+    """ Run the connection's loop until the reply is in, then return it or
+        raise its error. Gives up with TorCtlError after 'timeout'
+        seconds, if given. """
+    if not self._done and self._conn._dispatching:
+      # Running the loop again from inside it would reorder replies
+      raise TorCtl.TorCtlError("result() called from an event handler; "
+                               "use add_callback()")
+    deadline = timeout is not None and time.time() + timeout
+    while not self._done:
+      if deadline and time.time() > deadline:
+        raise TorCtl.TorCtlError("Timed out waiting for reply")
+      self._conn.poll(1.0)
+    if self._error is not None:
+      raise self._error
+    return self._result
+
+class AsyncConnection(asyncore.dispatcher):
+  """ A connection to the Tor control port driven by an asyncore loop.
+      'sock' must already be connected. Pass 'map' to share a loop other
+      than asyncore's default one. """
+  READ_SIZE = 65536
+
+  def __init__(self, sock, map=None):
+    if map is None:
+      map = asyncore.socket_map
+    asyncore.dispatcher.__init__(self, sock, map)
+    self._map = map
+    self._parser = ReplyParser()
+    self._out = []
+    self._pending = collections.deque()
+    self._handler = None
+    self._handleFn = None
+    self._closeHandler = None
+    self._closed = 0
+    self._closedEx = None
+    self._debugFile = None
+    self._dispatching = False
+
+  # Connection-compatible configuration
+  def debug(self, f):
+    """ Trace the protocol to 'f'. See Connection.debug(). """
+    if f is not None and not isinstance(f, ProtocolTrace):
+      f = ProtocolTrace(f, "FULL", max_data=None)
+    self._debugFile = f
+
+  def set_close_handler(self, handler):
+    """ Call 'handler' when the connection closes. It gets the exception
+        that closed it, if any. """
+    self._closeHandler = handler
+
+  def _check_handler(self, handler):
+    if getattr(handler, "sync_replies", False):
+      raise TorCtl.TorCtlError(handler.__class__.__name__+" needs replies "
+                               "from a blocking TorCtl.Connection")
+
+  def set_event_handler(self, handler):
+    """ Dispatch future events to 'handler' from the loop. Handlers that
+        set sync_replies are refused with TorCtlError. """
+    self._check_handler(handler)
+    if self._handler:
+      handler.pre_listeners = self._handler.pre_listeners
+      handler.post_listeners = self._handler.post_listeners
+    self._handler = handler
+    self._handler.c = self
+    self._handleFn = handler._handle1
+
+  def add_event_listener(self, listener):
+    self._check_handler(listener)
+    if not self._handler:
+      self.set_event_handler(TorCtl.EventHandler())
+    self._handler.add_event_listener(listener)
+
+  def is_live(self):
+    """ Returns true iff the connection is open. """
+    return not self._closed
+
+  def poll(self, timeout=0.0):
+    """ Run one iteration of this connection's loop. """
+    asyncore.loop(timeout=timeout, map=self._map, count=1)
+
+  # Commands
+  def sendAndRecv(self, msg="", expectedTypes=("250", "251")):
+    """ Send the command 'msg' to Tor and return an AsyncReply for the
+        reply lines. Like Connection.sendAndRecv(), an error reply is
+        raised as ErrorReply and any other unexpected reply type as
+        ProtocolError, when the result is collected. """
+    return self._send(msg, AsyncReply(self, expectedTypes))
+
+  def get_info(self, name):
+    """ Return an AsyncReply for the dict Connection.get_info() would
+        return. """
+    if not isinstance(name, str):
+      name = " ".join(name)
+    return self._send("GETINFO %s\r\n"%name,
+                      AsyncReply(self, ("250", "251"), TorCtl._parse_info))
+
+  def set_events(self, events, extended=False):
+    """ Change the events Tor sends to those in 'events'. """
+    if extended:
+      return self.sendAndRecv("SETEVENTS EXTENDED %s\r\n" % " ".join(events))
+    else:
+      return self.sendAndRecv("SETEVENTS %s\r\n" % " ".join(events))
+
+  def authenticate(self, secret=""):
+    """ Send an authenticating secret (password) to Tor. """
+    return self.sendAndRecv("AUTHENTICATE \"%s\"\r\n"%secret)
+
+  def _send(self, msg, reply):
+    if type(msg) == list:
+      msg = "".join(msg)
+    assert msg.endswith("\r\n")
+    if self._closedEx is not None:
+      raise self._closedEx
+    elif self._closed:
+      raise TorCtl.TorCtlClosed()
+    if self._debugFile:
+      self._debugFile.command(msg)
+    self._pending.append(reply)
+    self._out.append(msg)
+    return reply
+
+  # asyncore callbacks
+  def writable(self):
+    return bool(self._out)
+
+  def handle_write(self):
+    data = "".join(self._out)
+    sent = self.send(data)
+    if sent < len(data):
+      self._out = [data[sent:]]
+    else:
+      self._out = []
+
+  def handle_read(self):
+    data = self.recv(self.READ_SIZE)
+    if not data:
+      return
+    try:
+      replies = self._parser.feed(data)
+    except TorCtl.ProtocolError, e:
+      self._fail(e)
+      return
+    for isEvent, lines in replies:
+      if self._debugFile:
+        self._debugFile.reply(lines)
+      if isEvent:
+        self._dispatch(lines)
+      elif self._pending:
+        self._pending.popleft()._set(lines)
+      else:
+        plog("WARN", "Reply without a pending command: "+str(lines))
+
+  def _dispatch(self, lines):
+    if lines[0][0] == "650" and lines[0][1] == "OK":
+      plog("DEBUG", "Ignoring incompatible syntactic sugar: 650 OK")
+      return
+    if self._handleFn is None:
+      return
+    self._dispatching = True
+    try:
+      try:
+        self._handleFn(time.time(), lines)
+      except:
+        for code, msg, data in lines:
+          plog("WARN", "No event for: "+str(code)+" "+str(msg))
+        self._log_exception()
+    finally:
+      self._dispatching = False
+
+  def _log_exception(self):
+    nil, t, v, tbinfo = asyncore.compact_traceback()
+    plog("WARN", "%s: %s %s" % (t, v, tbinfo))
+
+  def handle_close(self):
+    plog("NOTICE", "Tor closed control connection.")
+    self._fail(TorCtl.TorCtlClosed())
+
+  def handle_error(self):
+    nil, t, v, tbinfo = asyncore.compact_traceback()
+    plog("WARN", "Control connection error: %s %s %s" % (t, v, tbinfo))
+    self._fail(TorCtl.TorCtlError(str(v)))
+
+  def _fail(self, ex):
+    if self._closed:
+      return
+    self._closed = 1
+    self._closedEx = ex
+    asyncore.dispatcher.close(self)
+    while self._pending:
+      self._pending.popleft()._set(None, ex)
+    if self._closeHandler is not None:
+      self._closeHandler(ex)
+
+  def close(self):
+    """ Shut down this controller connection. """
+    if self._closed:
+      return
+    self._closed = 1
+    asyncore.dispatcher.close(self)
+    while self._pending:
+      self._pending.popleft()._set(None, TorCtl.TorCtlClosed())
+    if self._closeHandler is not None:
+      self._closeHandler()
@@ -179,8 +179,8 @@ class NodeGenerator:
 
 class Connection(TorCtl.Connection):
   """Extended Connection class that provides a method for building circuits"""
-  def __init__(self, sock):
-    TorCtl.Connection.__init__(self,sock)
+  def __init__(self, sock, max_events=TorCtl.EVENT_QUEUE_SIZE):
+    TorCtl.Connection.__init__(self, sock, max_events)
   def build_circuit(self, path):
     "Tell Tor to build a circuit chosen by the PathSelector 'path_sel'"
     circ = Circuit()
@@ -270,14 +270,20 @@ class ConserveExitsRestriction(NodeRestriction):
   "Restriction to reject exits from selection"
   def __init__(self, exit_ports=None):
     self.exit_ports = exit_ports
+    self._conserves = {} # Verdicts by shared exit policy
 
   def r_is_ok(self, r):
     if self.exit_ports:
-      for port in self.exit_ports:
-        if r.will_exit_to("255.255.255.255", port):
-          return False
-      return True
-    return not "Exit" in r.flags
+      ok = self._conserves.get(r.policy)
+      if ok is None:
+        ok = True
+        for port in self.exit_ports:
+          if r.will_exit_to("255.255.255.255", port):
+            ok = False
+            break
+        self._conserves[r.policy] = ok
+      return ok
+    return not r.flags & TorCtl.Flags.EXIT
 
   def __str__(self):
     return self.__class__.__name__+"()"
@@ -289,13 +295,13 @@ class FlagsRestriction(NodeRestriction):
      flags as strings."""
     self.mandatory = mandatory
     self.forbidden = forbidden
+    self._mandatory_mask = TorCtl.ns_flag_mask(mandatory)
+    self._forbidden_mask = TorCtl.ns_flag_mask(forbidden)
 
   def r_is_ok(self, router):
-    for m in self.mandatory:
-      if not m in router.flags: return False
-    for f in self.forbidden:
-      if f in router.flags: return False
-    return True
+    flags = router.flags
+    return flags & self._mandatory_mask == self._mandatory_mask \
+        and not flags & self._forbidden_mask
 
   def __str__(self):
     return self.__class__.__name__+"("+str(self.mandatory)+","+str(self.forbidden)+")"
@@ -397,8 +403,15 @@ class ExitPolicyRestriction(NodeRestriction):
   def __init__(self, to_ip, to_port):
     self.to_ip = to_ip
     self.to_port = to_port
+    self._exits = {} # Verdicts by shared exit policy
 
-  def r_is_ok(self, r): return r.will_exit_to(self.to_ip, self.to_port)
+  def r_is_ok(self, r):
+    # Routers with the same policy share it (see compile_exit_policy()),
+    # so filtering a whole consensus checks each distinct policy once.
+    ok = self._exits.get(r.policy)
+    if ok is None:
+      ok = self._exits[r.policy] = r.will_exit_to(self.to_ip, self.to_port)
+    return ok
 
   def __str__(self):
     return self.__class__.__name__+"("+str(self.to_ip)+","+str(self.to_port)+")"
@@ -769,9 +782,9 @@ class BwWeightedGenerator(NodeGenerator):
     for r in self.routers:
       # TODO: Check max_bandwidth and cap...
       self.total_bw += r.bw
-      if "Exit" in r.flags:
+      if r.flags & TorCtl.Flags.EXIT:
         self.total_exit_bw += r.bw
-      if "Guard" in r.flags:
+      if r.flags & TorCtl.Flags.GUARD:
         self.total_guard_bw += r.bw
 
     bw_per_hop = (1.0*self.total_bw)/self.pathlen
@@ -814,9 +827,9 @@ class BwWeightedGenerator(NodeGenerator):
     
     for r in self.routers:
       bw = r.bw
-      if "Exit" in r.flags:
+      if r.flags & TorCtl.Flags.EXIT:
         bw *= self.exit_weight
-      if "Guard" in r.flags:
+      if r.flags & TorCtl.Flags.GUARD:
         bw *= self.guard_weight
       self.total_weighted_bw += bw
 
@@ -835,9 +848,9 @@ class BwWeightedGenerator(NodeGenerator):
         # Below zero here means next() -> choose a new random int+router 
         if i < 0: break
         bw = r.bw
-        if "Exit" in r.flags:
+        if r.flags & TorCtl.Flags.EXIT:
           bw *= self.exit_weight
-        if "Guard" in r.flags:
+        if r.flags & TorCtl.Flags.GUARD:
           bw *= self.guard_weight
 
         i -= bw
@@ -1437,10 +1450,10 @@ class PathBuilder(TorCtl.ConsensusTracker):
   def is_urgent_event(event):
     # If event is stream:NEW*/DETACHED or circ BUILT/FAILED, 
     # it is high priority and requires immediate action.
-    if isinstance(event, TorCtl.CircuitEvent):
+    if event.event_name == "CIRC":
       if event.status in ("BUILT", "FAILED", "CLOSED"):
         return True
-    elif isinstance(event, TorCtl.StreamEvent):
+    elif event.event_name == "STREAM":
       if event.status in ("NEW", "NEWRESOLVE", "DETACHED"):
         return True
     return False
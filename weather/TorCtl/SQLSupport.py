@@ -95,12 +95,13 @@ class Router(Entity):
     # us barf. Apparently 'Text' types can't have unicode chars?
     # self.os = router.os
     self.rate_limited = router.rate_limited
-    self.guard = "Guard" in router.flags
-    self.exit = "Exit" in router.flags
-    self.stable = "Stable" in router.flags
-    self.v2dir = "V2Dir" in router.flags
-    self.v3dir = "V3Dir" in router.flags
-    self.hsdir = "HSDir" in router.flags
+    flags = router.flags
+    self.guard = bool(flags & TorCtl.Flags.GUARD)
+    self.exit = bool(flags & TorCtl.Flags.EXIT)
+    self.stable = bool(flags & TorCtl.Flags.STABLE)
+    self.v2dir = bool(flags & TorCtl.Flags.V2DIR)
+    self.v3dir = "V3Dir" in flags
+    self.hsdir = bool(flags & TorCtl.Flags.HSDIR)
     self.version = router.version.version
     #self.router = router
     return self
@@ -215,7 +215,7 @@ class StatsRouter(TorCtl.Router):
     self.reason_suspected = {}
     self.reason_failed = {}
     self.first_seen = time.time()
-    if "Running" in self.flags:
+    if self.flags & TorCtl.Flags.RUNNING:
       self.became_active_at = self.first_seen
       self.hibernated_at = 0
     else:
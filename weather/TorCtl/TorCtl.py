@@ -22,16 +22,21 @@ classes and constants for each event.
 """
 
 __all__ = ["EVENT_TYPE", "TorCtlError", "TorCtlClosed", "ProtocolError",
-           "ErrorReply", "NetworkStatus", "ExitPolicyLine", "Router",
-           "RouterVersion", "Connection", "parse_ns_body",
+           "ErrorReply", "NetworkStatus", "ExitPolicyLine", "ExitPolicy",
+           "compile_exit_policy", "parse_exit_policy", "Router",
+           "RouterVersion", "Connection", "parse_ns_body", "iter_ns_body",
+           "parse_ns_columns", "NetworkStatusColumns", "NS_FLAGS",
+           "ns_flag_bit", "ns_flag_mask", "ns_flag_names", "Flags",
            "EventHandler", "DebugEventHandler", "NetworkStatusEvent",
            "NewDescEvent", "CircuitEvent", "StreamEvent", "ORConnEvent",
            "StreamBwEvent", "LogEvent", "AddrMapEvent", "BWEvent",
            "BuildTimeoutSetEvent", "UnknownEvent", "ConsensusTracker",
-           "EventListener", "EVENT_STATE" ]
+           "EventListener", "EVENT_STATE", "ReplyFuture", "EventQueue",
+           "LazyEvent", "SyncConnection" ]
 
 import os
 import re
+import select
 import struct
 import sys
 import threading
@@ -43,6 +48,11 @@ import binascii
 import types
 import time
 import copy
+import collections
+import array
+import bisect
+import calendar
+import weakref
 
 from TorUtil import *
 
@@ -79,6 +89,25 @@ EVENT_STATE = Enum2(
           POSTLISTEN="POSTLISTEN",
           DONE="DONE")
 
+# Lines that end a "+" data block. "650 OK" is accepted for old versions
+# of Tor that ended some events that way.
+DATA_TERMINATORS = (".\r\n", ".\n", "650 OK\n", "650 OK\r\n")
+
+# Largest number of commands written back-to-back by the pipelined helpers
+PIPELINE_WINDOW = 500
+
+# Default high-water mark of a Connection's event queue
+EVENT_QUEUE_SIZE = 1000
+
+# Bits of the router flags in NetworkStatusColumns.flags. Flags that aren't
+# listed get the next free bit when they are first seen; see ns_flag_bit().
+NS_FLAGS = {}
+for _i, _flag in enumerate(["Authority", "BadDirectory", "BadExit", "Exit",
+                            "Fast", "Guard", "HSDir", "Named", "Running",
+                            "Stable", "Unnamed", "V2Dir", "Valid"]):
+  NS_FLAGS[_flag] = 1 << _i
+_ns_flags_lock = threading.Lock()
+
 class TorCtlError(Exception):
   "Generic error raised by TorControl code."
   pass
@@ -95,6 +124,8 @@ class ErrorReply(TorCtlError):
   "Raised when Tor controller returns an error"
   pass
 
+_NS_UPDATED_RE = re.compile(r"(\d+)-(\d+)-(\d+) (\d+):(\d+):(\d+)")
+
 class NetworkStatus:
   "Filled in during NS events"
   def __init__(self, nickname, idhash, orhash, updated, ip, orport, dirport, flags, bandwidth=None):
@@ -104,10 +135,12 @@ class NetworkStatus:
     self.ip = ip
     self.orport = int(orport)
     self.dirport = int(dirport)
+    if not isinstance(flags, Flags):
+      flags = Flags.of(flags)
     self.flags = flags
     self.idhex = (self.idhash + "=").decode("base64").encode("hex").upper()
     self.bandwidth = bandwidth
-    m = re.search(r"(\d+)-(\d+)-(\d+) (\d+):(\d+):(\d+)", updated)
+    m = _NS_UPDATED_RE.search(updated)
     self.updated = datetime.datetime(*map(int, m.groups()))
 
 class Event:
@@ -116,6 +149,29 @@ class Event:
     self.arrived_at = 0
     self.state = EVENT_STATE.PRISTINE
 
+class LazyEvent(Event):
+  """ An event whose fields are decoded by EventHandler._decode1() the first
+      time one of them is read. Until then only event_name, arrived_at and
+      state are set. Decoding turns the object into the matching event
+      class, so check event_name rather than isinstance() before touching
+      any field. """
+  def __init__(self, event_name, body, data, decode):
+    Event.__init__(self, event_name)
+    self._raw = (body, data, decode)
+
+  def __getattr__(self, name):
+    raw = self.__dict__.get("_raw")
+    if raw is None or name.startswith("__"):
+      raise AttributeError(name)
+    body, data, decode = raw
+    event = decode(body, data)
+    del self.__dict__["_raw"]
+    arrived_at, state = self.arrived_at, self.state
+    self.__dict__.update(event.__dict__)
+    self.arrived_at, self.state = arrived_at, state
+    self.__class__ = event.__class__
+    return getattr(self, name)
+
 class TimerEvent(Event):
   def __init__(self, event_name, type):
     Event.__init__(self, event_name)
@@ -248,7 +304,7 @@ class ExitPolicyLine:
         if re.match(r"\d+.\d+.\d+.\d+", mask):
           self.netmask=struct.unpack(">I", socket.inet_aton(mask))[0]
         else:
-          self.netmask = ~(2**(32 - int(mask)) - 1)
+          self.netmask = ~(2**(32 - int(mask)) - 1) & 0xFFFFFFFF
       self.ip = struct.unpack(">I", socket.inet_aton(ip))[0]
     self.ip &= self.netmask
     if port_low == "*":
@@ -259,6 +315,14 @@ class ExitPolicyLine:
       self.port_low = int(port_low)
       self.port_high = int(port_high)
   
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    # Lines are shared between the routers of an ExitPolicy, and never
+    # change once built.
+    return self
+
   def check(self, ip, port):
     """Check to see if an ip and port is matched by this line. 
      Returns true if the line is an Accept, and False if it is a Reject. """
@@ -279,6 +343,118 @@ class ExitPolicyLine:
     retr += str(self.port_low)+"-"+str(self.port_high)
     return retr
 
+class ExitPolicy(object):
+  """ An exit policy compiled for lookups. The port space is cut into the
+      intervals on which the set of applicable lines doesn't change, and
+      each interval gets a sorted table of address ranges mapped to the
+      verdict of the first line that covers them, so that check() costs
+      two binary searches. Tables are built the first time a port in
+      their interval is checked, and intervals with the same lines share
+      one. Use compile_exit_policy() or parse_exit_policy() to get the 
+      shared instance for a list of lines. Policies are immutable, so
+      copying one returns it unchanged. """
+  def __init__(self, lines):
+    self.lines = tuple(lines)
+    bounds = set([0, 65536])
+    for line in self.lines:
+      bounds.add(line.port_low)
+      bounds.add(line.port_high+1)
+    self._port_starts = sorted(bounds)
+    self._port_tables = [None]*len(self._port_starts)
+    self._tables = {} # Tables by the indexes of their lines
+
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+  def __reduce__(self):
+    return (compile_exit_policy, (list(self.lines),))
+
+  def check(self, ip, port):
+    """ Return True if connections to the address 'ip' (an int) and 
+        'port' are accepted, False if they are rejected, and None if no
+        line matches. """
+    i = bisect.bisect_right(self._port_starts, port)-1
+    table = self._port_tables[i]
+    if table is None:
+      table = self._port_tables[i] = self._build(self._port_starts[i])
+    starts, verdicts, lines = table
+    if lines is not None:
+      for line in lines:
+        if (ip & line.netmask) == line.ip:
+          return line.match
+      return None
+    return verdicts[bisect.bisect_right(starts, ip)-1]
+
+  def _build(self, port):
+    key = tuple([i for i, line in enumerate(self.lines) 
+                 if line.port_low <= port <= line.port_high])
+    table = self._tables.get(key)
+    if table is not None:
+      return table
+    lines = [self.lines[i] for i in key]
+    ranges = []
+    bounds = set([0, 0x100000000])
+    for line in lines:
+      hostmask = ~line.netmask & 0xFFFFFFFF
+      if hostmask & (hostmask+1):
+        # Not a prefix, so the lines can't be turned into ranges
+        table = self._tables[key] = (None, None, lines)
+        return table
+      ranges.append((line.ip, (line.ip | hostmask)+1, line.match))
+      bounds.add(line.ip)
+      bounds.add((line.ip | hostmask)+1)
+    starts = sorted(bounds)
+    verdicts = [None]*len(starts)
+    # Paint the ranges last line first, so the first match wins
+    for low, high, match in reversed(ranges):
+      lo = bisect.bisect_left(starts, low)
+      hi = bisect.bisect_left(starts, high)
+      verdicts[lo:hi] = [match]*(hi-lo)
+    # Merge neighbouring ranges with the same verdict
+    merged_starts, merged_verdicts = [], []
+    for start, verdict in zip(starts, verdicts):
+      if not merged_verdicts or merged_verdicts[-1] != verdict:
+        merged_starts.append(start)
+        merged_verdicts.append(verdict)
+    table = self._tables[key] = (merged_starts, merged_verdicts, None)
+    return table
+
+_exit_policies = weakref.WeakValueDictionary()
+
+def compile_exit_policy(lines):
+  """ Return the ExitPolicy for the list of ExitPolicyLines 'lines'.
+      Routers with identical policies get the same instance. """
+  key = tuple([(l.match, l.ip, l.netmask, l.port_low, l.port_high)
+               for l in lines])
+  policy = _exit_policies.get(key)
+  if policy is None:
+    policy = ExitPolicy(lines)
+    _exit_policies[key] = policy
+  return policy
+
+_exit_policy_texts = weakref.WeakValueDictionary()
+
+def parse_exit_policy(lines):
+  """ Return the ExitPolicy for the "accept" and "reject" lines of a 
+      descriptor, given as a list of strings. Most routers publish one of
+      a few policies, so the lines are only parsed the first time the 
+      same text is seen. """
+  key = tuple(lines)
+  policy = _exit_policy_texts.get(key)
+  if policy is None:
+    parsed = []
+    for line in lines:
+      kw, sep, rest = line.partition(" ")
+      m = _DESC_POLICY_RE.match(rest)
+      if m:
+        parsed.append(ExitPolicyLine(kw == "accept", *m.groups()))
+    policy = compile_exit_policy(parsed)
+    _exit_policy_texts[key] = policy
+  return policy
+
 class RouterVersion:
   """ Represents a Router's version. Overloads all comparison operators
       to check for newer, older, or equivalent versions. """
@@ -299,11 +475,37 @@ class RouterVersion:
   def __ne__(self, other): return self.version != other.version
   def __str__(self): return self.ver_string
 
+# Descriptor line kinds for Router.build_from_desc(), by keyword
+_DESC_POLICY, _DESC_OPT, _DESC_BANDWIDTH, _DESC_PLATFORM, _DESC_UPTIME, \
+    _DESC_ROUTER, _DESC_PUBLISHED, _DESC_CONTACT = range(8)
+_DESC_KEYWORDS = {
+  "accept" : _DESC_POLICY,
+  "reject" : _DESC_POLICY,
+  "opt" : _DESC_OPT,
+  "bandwidth" : _DESC_BANDWIDTH,
+  "platform" : _DESC_PLATFORM,
+  "uptime" : _DESC_UPTIME,
+  "router" : _DESC_ROUTER,
+  "published" : _DESC_PUBLISHED,
+  "contact" : _DESC_CONTACT
+  }
+# Matched against the rest of the line, after the keyword and a space
+_DESC_POLICY_RE = re.compile(r"(\S+):([^-]+)(?:-(\d+))?")
+_DESC_BANDWIDTH_RE = re.compile(r"(\d+) \d+ (\d+)")
+_DESC_PLATFORM_RE = re.compile(r"Tor (\S+).*on ([\S\s]+)")
+_DESC_UPTIME_RE = re.compile(r"(\d+)")
+_DESC_ROUTER_RE = re.compile(r"(\S+) (\S+)")
+_DESC_PUBLISHED_RE = re.compile(r"(\S+ \S+)")
+
 class Router:
   """ 
   Class to represent a router from a descriptor. Can either be
   created from the parsed fields, or can be built from a
   descriptor+NetworkStatus 
+
+  The exit policy may be given as a list of ExitPolicyLines or as an
+  ExitPolicy. Either way, 'exitpolicy' ends up as the shared tuple of
+  lines and 'policy' as the shared ExitPolicy.
   """     
   def __init__(self, *args):
     if len(args) == 1:
@@ -319,7 +521,12 @@ class Router:
     else:
       self.bw = bw
     self.desc_bw = bw
-    self.exitpolicy = exitpolicy
+    if not isinstance(exitpolicy, ExitPolicy):
+      exitpolicy = compile_exit_policy(exitpolicy)
+    self.exitpolicy = exitpolicy.lines
+    self.policy = exitpolicy
+    if not isinstance(flags, Flags):
+      flags = Flags.of(flags)
     self.flags = flags # Technicaly from NS doc
     self.down = down
     self.ip = struct.unpack(">I", socket.inet_aton(ip))[0]
@@ -347,12 +554,13 @@ class Router:
     the flags, the nickname, and the idhex string). 
     Returns a Router instance.
     """
-    # XXX: Compile these regular expressions? This is an expensive process
-    # Use http://docs.python.org/lib/profile.html to verify this is 
-    # the part of startup that is slow
-    exitpolicy = []
-    dead = not ("Running" in ns.flags)
+    # Each line is dispatched on its keyword, so that at most one of the
+    # precompiled _DESC_* expressions is run on it, and lines with other
+    # keywords cost a dict lookup.
+    policy_lines = []
+    dead = not ns.flags & Flags.RUNNING
     bw_observed = 0
+    rate_limited = False
     version = None
     os = None
     uptime = 0
@@ -362,40 +570,42 @@ class Router:
     contact = None
 
     for line in desc:
-      rt = re.search(r"^router (\S+) (\S+)", line)
-      fp = re.search(r"^opt fingerprint (.+).*on (\S+)", line)
-      pl = re.search(r"^platform Tor (\S+).*on ([\S\s]+)", line)
-      ac = re.search(r"^accept (\S+):([^-]+)(?:-(\d+))?", line)
-      rj = re.search(r"^reject (\S+):([^-]+)(?:-(\d+))?", line)
-      bw = re.search(r"^bandwidth (\d+) \d+ (\d+)", line)
-      up = re.search(r"^uptime (\d+)", line)
-      ct = re.search(r"^contact (.+)", line)
-      pb = re.search(r"^published (\S+ \S+)", line)
-      if re.search(r"^opt hibernating 1", line):
-        dead = True 
-        if ("Running" in ns.flags):
-          plog("INFO", "Hibernating router "+ns.nickname+" is running, flags: "+" ".join(ns.flags))
-      if ac:
-        exitpolicy.append(ExitPolicyLine(True, *ac.groups()))
-      elif rj:
-        exitpolicy.append(ExitPolicyLine(False, *rj.groups()))
-      elif bw:
-        bws = map(int, bw.groups())
-        bw_observed = min(bws)
-        rate_limited = False
-        if bws[0] < bws[1]:
-          rate_limited = True
-      elif pl:
-        version, os = pl.groups()
-      elif up:
-        uptime = int(up.group(1))
-      elif rt:
-        router,ip = rt.groups()
-      elif pb:
-        t = time.strptime(pb.group(1)+" UTC", "20%y-%m-%d %H:%M:%S %Z")
-        published = datetime.datetime(*t[0:6])
-      elif ct:
-        contact = ct.group(1)
+      kw, sep, rest = line.partition(" ")
+      kind = _DESC_KEYWORDS.get(kw)
+      if kind is None:
+        continue
+      if kind == _DESC_POLICY:
+        policy_lines.append(line)
+      elif kind == _DESC_OPT:
+        if rest.startswith("hibernating 1"):
+          dead = True 
+          if ns.flags & Flags.RUNNING:
+            plog("INFO", "Hibernating router "+ns.nickname+" is running, flags: "+" ".join(ns.flags))
+      elif kind == _DESC_BANDWIDTH:
+        m = _DESC_BANDWIDTH_RE.match(rest)
+        if m:
+          bws = map(int, m.groups())
+          bw_observed = min(bws)
+          rate_limited = bws[0] < bws[1]
+      elif kind == _DESC_PLATFORM:
+        m = _DESC_PLATFORM_RE.match(rest)
+        if m:
+          version, os = m.groups()
+      elif kind == _DESC_UPTIME:
+        m = _DESC_UPTIME_RE.match(rest)
+        if m:
+          uptime = int(m.group(1))
+      elif kind == _DESC_ROUTER:
+        m = _DESC_ROUTER_RE.match(rest)
+        if m:
+          router,ip = m.groups()
+      elif kind == _DESC_PUBLISHED:
+        m = _DESC_PUBLISHED_RE.match(rest)
+        if m:
+          t = time.strptime(m.group(1)+" UTC", "20%y-%m-%d %H:%M:%S %Z")
+          published = datetime.datetime(*t[0:6])
+      elif rest: # contact
+        contact = rest
     if router != ns.nickname:
       plog("NOTICE", "Got different names " + ns.nickname + " vs " +
              router + " for " + ns.idhex)
@@ -404,7 +614,8 @@ class Router:
       dead = True
     if not version or not os:
       plog("INFO", "No version and/or OS for router " + ns.nickname)
-    return Router(ns.idhex, ns.nickname, bw_observed, dead, exitpolicy,
+    return Router(ns.idhex, ns.nickname, bw_observed, dead,
+        parse_exit_policy(policy_lines),
         ns.flags, ip, version, os, uptime, published, contact, rate_limited,
         ns.orhash, ns.bandwidth)
   build_from_desc = Callable(build_from_desc)
@@ -423,19 +634,218 @@ class Router:
   def will_exit_to(self, ip, port):
     """ Check the entire exitpolicy to see if the router will allow
         connections to 'ip':'port' """
-    for line in self.exitpolicy:
-      ret = line.check(ip, port)
-      if ret != -1:
-        return ret
-    plog("WARN", "No matching exit line for "+self.nickname)
-    return False
+    ret = self.policy.check(struct.unpack(">I", socket.inet_aton(ip))[0],
+                            port)
+    if ret is None:
+      plog("WARN", "No matching exit line for "+self.nickname)
+      return False
+    return ret
    
+class ReplyFuture:
+  """The pending reply to a command sent with one of the pipelined 
+     Connection methods. The reply arrives on the Connection's _loop 
+     thread; result() blocks until it does."""
+  def __init__(self, conn, expectedTypes=None, parse=None):
+    self._conn = conn
+    self._expectedTypes = expectedTypes
+    self._parse = parse
+    # This condition will get notified when we've got a result...
+    self._condition = threading.Condition()
+    # Here's where the result goes...
+    self._result = []
+
+  def _set(self, reply):
+    self._condition.acquire()
+    try:
+      self._result.append(reply)
+      self._condition.notify()
+    finally:
+      self._condition.release()
+
+  def done(self):
+    """Return true iff the reply has arrived."""
+    return bool(self._result)
+
+  def wait(self):
+    """Wait for the reply and return its raw lines."""
+    # Now wait till the answer is in...
+    self._condition.acquire()
+    try:
+      while not self._result:
+        self._condition.wait()
+    finally:
+      self._condition.release()
+
+    # ...And handle the answer appropriately.
+    assert len(self._result) == 1
+    reply = self._result[0]
+    if reply == "EXCEPTION":
+      raise self._conn._closedEx
+
+    return reply
+
+  def result(self):
+    """Wait for the reply, check it like sendAndRecv() does, and return
+       it, passed through the future's parse function if it has one."""
+    lines = self.wait()
+    if self._expectedTypes is not None:
+      _check_reply(lines, self._expectedTypes)
+    if self._parse:
+      return self._parse(lines)
+    return lines
+
+def _check_reply(lines, expectedTypes):
+  """Raise ErrorReply or ProtocolError if 'lines' isn't a reply of one of
+     the types in 'expectedTypes'."""
+  for tp, msg, _ in lines:
+    if tp[0] in '45':
+      raise ErrorReply("%s %s"%(tp, msg))
+    if tp not in expectedTypes:
+      raise ProtocolError("Unexpectd message type %r"%tp)
+
+def _parse_info(lines):
+  """Turn the reply to a GETINFO command into a dict."""
+  d = {}
+  for _,msg,more in lines:
+    if msg == "OK":
+      break
+    try:
+      k,rest = msg.split("=",1)
+    except ValueError:
+      raise ProtocolError("Bad info line %r",msg)
+    if more:
+      d[k] = more
+    else:
+      d[k] = rest
+  return d
+
+class EventQueue:
+  """A bounded queue of (timestamp, reply) pairs between a Connection's
+     _loop and _eventLoop threads. Events that a slow handler would only
+     process redundantly are coalesced when they are queued: consecutive
+     NEWDESC events merge into one with the union of their id lists, and a
+     NEWCONSENSUS event replaces any older one still in the queue. If the
+     queue still reaches its high-water mark, the oldest event is dropped
+     rather than blocking _loop, which must keep reading command replies
+     for the handler. Timer events and the (single) queued NEWCONSENSUS
+     event are only dropped when nothing else is left to drop, timer
+     events first; the close message is never dropped. One warning is
+     logged when a burst of drops starts and one summary when the queue
+     has drained to half its size again."""
+  def __init__(self, maxsize=EVENT_QUEUE_SIZE):
+    self.maxsize = maxsize
+    self._items = collections.deque()
+    self._cond = threading.Condition()
+    self.peak = 0
+    self.merged = 0
+    self.dropped = 0
+    self._burst_start = None # self.dropped when the current burst began
+
+  def _event_type(self, reply):
+    if reply == "CLOSE" or not isinstance(reply, list):
+      return None # close message or timer event
+    return reply[0][1].split(" ", 1)[0]
+
+  def _coalesce(self, timestamp, reply, evtype):
+    """Fold the event into the queue, and return True if it was."""
+    if evtype == "NEWDESC" and self._items:
+      last_ts, last = self._items[-1]
+      if self._event_type(last) == "NEWDESC":
+        ids = last[0][1].split(" ")[1:]
+        seen = set(ids)
+        for i in reply[0][1].split(" ")[1:]:
+          if i not in seen:
+            seen.add(i)
+            ids.append(i)
+        # The merged event keeps the arrival time of the older one
+        self._items[-1] = (last_ts, [(last[0][0], " ".join(["NEWDESC"]+ids),
+                                      None)])
+        return True
+    elif evtype == "NEWCONSENSUS":
+      for i in xrange(len(self._items)):
+        if self._event_type(self._items[i][1]) == "NEWCONSENSUS":
+          del self._items[i]
+          self.merged += 1
+          break
+    return False
+
+  def put(self, item):
+    timestamp, reply = item
+    self._cond.acquire()
+    try:
+      if self._coalesce(timestamp, reply, self._event_type(reply)):
+        self.merged += 1
+      else:
+        if len(self._items) >= self.maxsize:
+          self._drop_oldest()
+        self._items.append(item)
+        self.peak = max(self.peak, len(self._items))
+      self._cond.notify()
+    finally:
+      self._cond.release()
+
+  def _drop_oldest(self):
+    timer = consensus = None
+    for i in xrange(len(self._items)):
+      reply = self._items[i][1]
+      evtype = self._event_type(reply)
+      if evtype == "NEWCONSENSUS":
+        if consensus is None: consensus = i
+      elif evtype:
+        break
+      elif reply != "CLOSE" and timer is None:
+        timer = i
+    else:
+      if timer is not None: i = timer
+      elif consensus is not None: i = consensus
+      else: return
+    if self._burst_start is None:
+      self._burst_start = self.dropped
+      plog("WARN", "Event queue full ("+str(self.maxsize)
+                   +" events). Dropping the oldest events.")
+    del self._items[i]
+    self.dropped += 1
+
+  def get(self, block=True):
+    """Remove and return the oldest item, waiting for one if 'block' is
+       true and raising Queue.Empty otherwise."""
+    self._cond.acquire()
+    try:
+      while not self._items:
+        if not block:
+          raise Queue.Empty
+        self._cond.wait()
+      item = self._items.popleft()
+      if self._burst_start is not None \
+          and len(self._items) <= self.maxsize/2:
+        plog("WARN", "Dropped "+str(self.dropped-self._burst_start)
+                     +" events while the event queue was full.")
+        self._burst_start = None
+      return item
+    finally:
+      self._cond.release()
+
+  def qsize(self):
+    return len(self._items)
+
+  def stats(self):
+    """Return a dict with the current depth, the high-water mark, the 
+       peak depth, and the number of merged and dropped events."""
+    self._cond.acquire()
+    try:
+      return {"depth": len(self._items), "maxsize": self.maxsize,
+              "peak": self.peak, "merged": self.merged,
+              "dropped": self.dropped}
+    finally:
+      self._cond.release()
+
 class Connection:
   """A Connection represents a connection to the Tor process via the 
      control port."""
-  def __init__(self, sock):
+  def __init__(self, sock, max_events=EVENT_QUEUE_SIZE):
     """Create a Connection to communicate with the Tor process over the
-       socket 'sock'.
+       socket 'sock'. At most 'max_events' events are queued for the
+       event handler; see EventQueue.
     """
     self._handler = None
     self._handleFn = None
@@ -446,7 +856,7 @@ class Connection:
     self._closed = 0
     self._closeHandler = None
     self._eventThread = None
-    self._eventQueue = Queue.Queue()
+    self._eventQueue = EventQueue(max_events)
     self._s = BufSock(sock)
     self._debugFile = None
 
@@ -474,10 +884,18 @@ class Connection:
     finally:
       self._sendLock.release()
 
+  def get_event_queue_stats(self):
+    """Return the statistics of the event queue. See EventQueue.stats()."""
+    return self._eventQueue.stats()
+
   def is_live(self):
     """ Returns true iff the connection is alive and healthy"""
-    return self._thread.isAlive() and self._eventThread.isAlive() and not \
-           self._closed
+    if self._closed or self._closedEx is not None:
+      return False
+    if self._thread is None:
+      # No command sent yet, so the threads haven't been launched
+      return True
+    return self._thread.isAlive() and self._eventThread.isAlive()
 
   def launch_thread(self, daemon=1):
     """Launch a background thread to handle messages from the Tor process."""
@@ -577,53 +995,40 @@ class Connection:
 
   def _sendImpl(self, sendFn, msg):
     """DOCDOC"""
+    return self._sendPipelined(sendFn, [msg])[0].wait()
+
+  def _sendPipelined(self, sendFn, msgs, expectedTypes=None):
+    """Queue a callback for each command in 'msgs' and write them all to
+       Tor at once. Tor answers commands in order, and _loop hands replies
+       to the queued callbacks in order, so each returned ReplyFuture gets
+       the reply to its own command."""
     if self._thread is None and not self._closed:
       self.launch_thread(1)
-    # This condition will get notified when we've got a result...
-    condition = threading.Condition()
-    # Here's where the result goes...
-    result = []
 
     if self._closedEx is not None:
       raise self._closedEx
     elif self._closed:
       raise TorCtlClosed()
 
-    def cb(reply,condition=condition,result=result):
-      condition.acquire()
-      try:
-        result.append(reply)
-        condition.notify()
-      finally:
-        condition.release()
+    futures = [ReplyFuture(self, expectedTypes) for msg in msgs]
 
-    # Sends a message to Tor...
+    # Sends the messages to Tor...
     self._sendLock.acquire() # ensure queue+sendmsg is atomic
     try:
-      self._queue.put(cb)
-      sendFn(msg) # _doSend(msg)
+      for future in futures:
+        self._queue.put(future._set)
+      sendFn("".join(msgs)) # _doSend(msg)
     finally:
       self._sendLock.release()
 
-    # Now wait till the answer is in...
-    condition.acquire()
-    try:
-      while not result:
-        condition.wait()
-    finally:
-      condition.release()
-
-    # ...And handle the answer appropriately.
-    assert len(result) == 1
-    reply = result[0]
-    if reply == "EXCEPTION":
-      raise self._closedEx
-
-    return reply
-
+    return futures
 
   def debug(self, f):
-    """DOCDOC"""
+    """Trace the commands and replies on this connection to 'f', which is
+       either a ProtocolTrace or a file to trace everything to. None turns
+       tracing off."""
+    if f is not None and not isinstance(f, ProtocolTrace):
+      f = ProtocolTrace(f, "FULL", max_data=None)
     self._debugFile = f
 
   def set_event_handler(self, handler):
@@ -649,8 +1054,6 @@ class Connection:
         self._closed = True
         raise TorCtlClosed() 
       line = line.strip()
-      if self._debugFile:
-        self._debugFile.write(str(time.time())+"\t  %s\n" % line)
       if len(line)<4:
         raise ProtocolError("Badly formatted reply line: Too short")
       code = line[:3]
@@ -660,22 +1063,23 @@ class Connection:
         lines.append((code, s, None))
       elif tp == " ":
         lines.append((code, s, None))
+        if self._debugFile:
+          self._debugFile.reply(lines)
         isEvent = (lines and lines[0][0][0] == '6')
         return isEvent, lines
       elif tp != "+":
         raise ProtocolError("Badly formatted reply line: unknown type %r"%tp)
       else:
-        more = []
-        while 1:
-          line = self._s.readline()
-          if self._debugFile:
-            self._debugFile.write("+++ %s" % line)
-          if line in (".\r\n", ".\n", "650 OK\n", "650 OK\r\n"): 
-            break
-          more.append(line)
-        lines.append((code, s, unescape_dots("".join(more))))
+        # Slice the whole data block out of the buffer at once
+        more = self._s.readblock(DATA_TERMINATORS)
+        if more is None:
+          self._closed = True
+          raise TorCtlClosed()
+        lines.append((code, s, unescape_dots(more)))
         isEvent = (lines and lines[0][0][0] == '6')
         if isEvent: # Need "250 OK" if it's not an event. Otherwise, end
+          if self._debugFile:
+            self._debugFile.reply(lines)
           return (isEvent, lines)
 
     # Notreached
@@ -683,11 +1087,7 @@ class Connection:
 
   def _doSend(self, msg):
     if self._debugFile:
-      amsg = msg
-      lines = amsg.split("\n")
-      if len(lines) > 2:
-        amsg = "\n".join(lines[:2]) + "\n"
-      self._debugFile.write(str(time.time())+"\t>>> "+amsg)
+      self._debugFile.command(msg)
     self._s.write(msg)
 
   def set_timer(self, in_seconds, type=None):
@@ -716,14 +1116,20 @@ class Connection:
 
     lines = self._sendImpl(self._doSend, msg)
     # print lines
-    for tp, msg, _ in lines:
-      if tp[0] in '45':
-        raise ErrorReply("%s %s"%(tp, msg))
-      if tp not in expectedTypes:
-        raise ProtocolError("Unexpectd message type %r"%tp)
+    _check_reply(lines, expectedTypes)
 
     return lines
 
+  def sendAndRecvPipelined(self, msgs, expectedTypes=("250", "251")):
+    """Send all the commands in 'msgs' back-to-back without waiting for
+       replies, and return a list of ReplyFutures in the same order. 
+       Calling result() on a future returns its lines or raises, as 
+       sendAndRecv() would for that command.
+    """
+    for msg in msgs:
+      assert msg.endswith("\r\n")
+    return self._sendPipelined(self._doSend, msgs, expectedTypes)
+
   def authenticate(self, secret=""):
     """Sends an authenticating secret (password) to Tor.  You'll need to call 
        this method (or authenticate_cookie) before Tor can start.
@@ -823,6 +1229,10 @@ class Connection:
   def get_router(self, ns):
     """Fill in a Router class corresponding to a given NS class"""
     desc = self.sendAndRecv("GETINFO desc/id/" + ns.idhex + "\r\n")[0][2]
+    return self._router_from_desc(desc, ns)
+
+  def _router_from_desc(self, desc, ns):
+    """Build a Router from 'desc' if it matches the NS class 'ns'"""
     sig_start = desc.find("\nrouter-signature\n")+len("\nrouter-signature\n")
     fp_base64 = sha1(desc[:sig_start]).digest().encode("base64")[:-2]
     r = Router.build_from_desc(desc.split("\n"), ns)
@@ -837,22 +1247,33 @@ class Connection:
     """ Given a list a NetworkStatuses in 'nslist', this function will 
         return a list of new Router instances.
     """
+    return filter(None, self._get_routers(nslist))
+
+  def _get_routers(self, nslist):
+    """ Fetch the descriptors for the NetworkStatuses in 'nslist', 
+        PIPELINE_WINDOW at a time, and return a list with the Router for
+        each of them, or None where there is no matching descriptor.
+    """
     bad_key = 0
-    new = []
-    for ns in nslist:
-      try:
-        r = self.get_router(ns)
-        if r: new.append(r)
-      except ErrorReply:
-        bad_key += 1
-        if "Running" in ns.flags:
-          plog("NOTICE", "Running router "+ns.nickname+"="
-             +ns.idhex+" has no descriptor")
-      except:
-        traceback.print_exception(*sys.exc_info())
-        continue
+    routers = []
+    for i in xrange(0, len(nslist), PIPELINE_WINDOW):
+      window = nslist[i:i+PIPELINE_WINDOW]
+      futures = self.sendAndRecvPipelined(["GETINFO desc/id/"+ns.idhex+"\r\n"
+                                           for ns in window])
+      for ns, future in zip(window, futures):
+        r = None
+        try:
+          r = self._router_from_desc(future.result()[0][2], ns)
+        except ErrorReply:
+          bad_key += 1
+          if "Running" in ns.flags:
+            plog("NOTICE", "Running router "+ns.nickname+"="
+               +ns.idhex+" has no descriptor")
+        except:
+          traceback.print_exception(*sys.exc_info())
+        routers.append(r)
   
-    return new
+    return routers
 
   def get_info(self, name):
     """Return the value of the internal information field named 'name'.
@@ -862,18 +1283,33 @@ class Connection:
     if not isinstance(name, str):
       name = " ".join(name)
     lines = self.sendAndRecv("GETINFO %s\r\n"%name)
+    return _parse_info(lines)
+
+  def get_info_pipelined(self, names):
+    """Send one GETINFO command per name in 'names' back-to-back, and
+       return a list of ReplyFutures whose result() is the dict get_info()
+       would have returned for that name.
+    """
+    futures = self.sendAndRecvPipelined(["GETINFO %s\r\n"%name 
+                                         for name in names])
+    for future in futures:
+      future._parse = _parse_info
+    return futures
+
+  def get_info_batch(self, names):
+    """Get the values of all the fields in 'names', PIPELINE_WINDOW 
+       commands at a time. Unlike a single GETINFO with several keys, one
+       unknown key doesn't fail the whole request: keys that Tor answers
+       with an error are left out of the returned dict.
+    """
     d = {}
-    for _,msg,more in lines:
-      if msg == "OK":
-        break
-      try:
-        k,rest = msg.split("=",1)
-      except ValueError:
-        raise ProtocolError("Bad info line %r",msg)
-      if more:
-        d[k] = more
-      else:
-        d[k] = rest
+    names = list(names)
+    for i in xrange(0, len(names), PIPELINE_WINDOW):
+      for future in self.get_info_pipelined(names[i:i+PIPELINE_WINDOW]):
+        try:
+          d.update(future.result())
+        except ErrorReply, e:
+          plog("DEBUG", "GETINFO failed in batch: "+str(e))
     return d
 
   def set_events(self, events, extended=False):
@@ -976,24 +1412,308 @@ class Connection:
   def post_descriptor(self, desc):
     self.sendAndRecv("+POSTDESCRIPTOR purpose=controller\r\n%s"%escape_dots(desc))
 
+class SyncConnection(Connection):
+  """A Connection that runs no threads, for short-lived batch jobs. Each
+     command writes its request and reads the reply on the calling thread,
+     and events that arrive in between are queued (see EventQueue) until
+     poll_events() hands them to the event handler, also on the calling
+     thread. Commands from several threads are serialized."""
+  def __init__(self, sock, max_events=EVENT_QUEUE_SIZE):
+    Connection.__init__(self, sock, max_events)
+    self._sock = sock
+
+  def launch_thread(self, daemon=1):
+    raise TorCtlError("A SyncConnection runs no threads")
+
+  def close(self):
+    """Shut down this controller connection"""
+    self._sendLock.acquire()
+    try:
+      self._closed = 1
+      self._s.close()
+    finally:
+      self._sendLock.release()
+
+  def is_live(self):
+    """ Returns true iff the connection is alive and healthy"""
+    return not self._closed and self._closedEx is None
+
+  def _sendPipelined(self, sendFn, msgs, expectedTypes=None):
+    """Write the commands in 'msgs' to Tor at once, then read their 
+       replies in order. The returned ReplyFutures are all done."""
+    if self._closedEx is not None:
+      raise self._closedEx
+    elif self._closed:
+      raise TorCtlClosed()
+
+    futures = [ReplyFuture(self, expectedTypes) for msg in msgs]
+
+    self._sendLock.acquire() # hold the lock until all replies are in
+    try:
+      sendFn("".join(msgs))
+      for future in futures:
+        while 1:
+          isEvent, reply = self._read_sync()
+          if not isEvent:
+            break
+          self._queue_event(reply)
+        future._set(reply)
+    finally:
+      self._sendLock.release()
+
+    return futures
+
+  def _read_sync(self):
+    try:
+      return self._read_reply()
+    except Exception, e:
+      self._closedEx = e
+      self._closed = 1
+      if self._closeHandler is not None:
+        self._closeHandler(e)
+      raise
+
+  def _queue_event(self, reply):
+    if self._handler is not None:
+      self._eventQueue.put((time.time(), reply))
+
+  def poll_events(self, timeout=0):
+    """Read any events Tor has sent, waiting up to 'timeout' seconds for
+       the first, and pass them and the events queued while reading
+       command replies to the event handler. Returns the number of events
+       handled."""
+    self._sendLock.acquire()
+    try:
+      while not self._closed and (self._s.buffered() or
+          select.select([self._sock], [], [], timeout)[0]):
+        isEvent, reply = self._read_sync()
+        if isEvent:
+          self._queue_event(reply)
+        else:
+          plog("WARN", "Reply without a pending command: "+str(reply))
+        timeout = 0
+    finally:
+      self._sendLock.release()
+
+    handled = 0
+    while 1:
+      try:
+        (timestamp, reply) = self._eventQueue.get(block=False)
+      except Queue.Empty:
+        return handled
+      if reply[0][0] == "650" and reply[0][1] == "OK":
+        plog("DEBUG", "Ignoring incompatible syntactic sugar: 650 OK")
+        continue
+      self._handleFn(timestamp, reply)
+      handled += 1
+
+_NS_BANDWIDTH_RE = re.compile(r"\d+")
+
+def _iter_ns_entries(data):
+  """Walk the body of an NS event or command once, and yield a tuple
+     (start, end, words, flags, bandwidth) for each router entry: the
+     offsets of the entry, the words of its "r" line, its Flags and its
+     bandwidth in bytes/s (None if it has none). Entries
+     whose "r" line is too short are logged and skipped."""
+  if not data: return
+  if data.startswith("r "):
+    start = 0
+  else:
+    start = data.find("\nr ")+1
+    if not start: return
+  n = len(data)
+  while start < n:
+    end = data.find("\nr ", start)+1 or n
+    rend = data.find("\n", start, end)
+    if rend < 0: rend = end
+    words = data[start+2:rend].split()
+    flags = _NO_FLAGS
+    si = data.find("\ns ", start, end)
+    if si >= 0:
+      se = data.find("\n", si+1, end)
+      if se < 0: se = end
+      flags = Flags.parse(data[si+3:se])
+    bandwidth = None
+    wi = data.find("\nw Bandwidth=", start, end)
+    if wi >= 0:
+      m = _NS_BANDWIDTH_RE.match(data, wi+13)
+      if m:
+        bandwidth = int(m.group())*1000
+    if len(words) < 8:
+      plog("WARN", "Skipping malformed router entry: "+data[start:rend])
+    else:
+      yield start, end, words, flags, bandwidth
+    start = end
+
+def iter_ns_body(data):
+  """Parse the body of an NS event or command into NetworkStatus 
+     instances, yielding each as soon as its entry has been read."""
+  for start, end, w, flags, bandwidth in _iter_ns_entries(data):
+    yield NetworkStatus(w[0], w[1], w[2], w[3]+" "+w[4], w[5], w[6], w[7],
+                        flags, bandwidth)
+
 def parse_ns_body(data):
   """Parse the body of an NS event or command into a list of
      NetworkStatus instances"""
-  if not data: return []
-  nsgroups = re.compile(r"^r ", re.M).split(data)
-  nsgroups.pop(0)
-  nslist = []
-  for nsline in nsgroups:
-    m = re.search(r"^s((?:[ ]\S*)+)", nsline, re.M)
-    flags = m.groups()
-    flags = flags[0].strip().split(" ")
-    m = re.match(r"(\S+)\s(\S+)\s(\S+)\s(\S+\s\S+)\s(\S+)\s(\d+)\s(\d+)", nsline)    
-    w = re.search(r"^w Bandwidth=(\d+)", nsline, re.M)
-    if w:
-      nslist.append(NetworkStatus(*(m.groups()+(flags,)+(int(w.group(1))*1000,))))
-    else:
-      nslist.append(NetworkStatus(*(m.groups() + (flags,))))
-  return nslist
+  return list(iter_ns_body(data))
+
+def ns_flag_bit(flag):
+  """Return the bit of 'flag' in a flags bitmask, giving it the next free
+     bit if it hasn't been seen before."""
+  bit = NS_FLAGS.get(flag)
+  if bit is None:
+    _ns_flags_lock.acquire()
+    try:
+      bit = NS_FLAGS.get(flag)
+      if bit is None:
+        bit = 1 << len(NS_FLAGS)
+        NS_FLAGS[flag] = bit
+    finally:
+      _ns_flags_lock.release()
+  return bit
+
+def ns_flag_mask(flags):
+  """Return the bitmask of the flags in the list 'flags'."""
+  mask = 0
+  for flag in flags:
+    mask |= NS_FLAGS.get(flag) or ns_flag_bit(flag)
+  return mask
+
+def ns_flag_names(mask):
+  """Return the list of flags in the bitmask 'mask', in bit order."""
+  return [flag for bit, flag in sorted([(b, f) for f, b in NS_FLAGS.items()])
+          if mask & bit]
+
+class Flags(int):
+  """ The flags of a router as a bitmask of NS_FLAGS bits. Instances are
+      interned, so routers with the same flags share one object. Flags
+      also behaves like the list of flag names it replaces: "Exit" in
+      flags, iteration, len() and str() work on the names. Hot paths
+      should test bits directly, e.g. flags & Flags.EXIT. Flags are
+      immutable; use with_flag() and without() to get changed ones. """
+  _interned = {}
+  _by_line = {}
+
+  def __new__(cls, mask=0):
+    flags = cls._interned.get(mask)
+    if flags is None:
+      flags = cls._interned.setdefault(mask, int.__new__(cls, mask))
+    return flags
+
+  def of(cls, names):
+    """ Return the Flags for the flag names in the list 'names'. """
+    return cls(ns_flag_mask(names))
+  of = classmethod(of)
+
+  def parse(cls, line):
+    """ Return the Flags for the space separated flag names in 'line', as
+        found on the "s" line of a network status entry. """
+    flags = cls._by_line.get(line)
+    if flags is None:
+      if len(cls._by_line) > 4096: cls._by_line.clear()
+      flags = cls._by_line[line] = cls.of(line.split())
+    return flags
+  parse = classmethod(parse)
+
+  def __contains__(self, name):
+    bit = NS_FLAGS.get(name)
+    return bit is not None and self & bit != 0
+
+  def __iter__(self):
+    return iter(ns_flag_names(self))
+
+  def __len__(self):
+    return len(ns_flag_names(self))
+
+  def with_flag(self, name):
+    return Flags(self | ns_flag_bit(name))
+
+  def without(self, name):
+    bit = NS_FLAGS.get(name)
+    if bit is None: return self
+    return Flags(self & ~bit)
+
+  def __copy__(self):
+    return self
+
+  def __deepcopy__(self, memo):
+    return self
+
+  def __reduce__(self):
+    # Pickle by name: bits of flags outside NS_FLAGS' initial list depend
+    # on the order they were seen in.
+    return (_unpickle_flags, (list(self),))
+
+  def __repr__(self):
+    return repr(list(self))
+
+  __str__ = __repr__
+
+for _flag, _bit in NS_FLAGS.items():
+  setattr(Flags, _flag.upper(), _bit)
+
+_NO_FLAGS = Flags()
+
+def _unpickle_flags(names):
+  return Flags.of(names)
+
+class NetworkStatusColumns:
+  """A network status document in columns rather than as NetworkStatus
+     instances: item i of every list and array is about the i-th router.
+     'flags' holds each router's Flags as a plain bitmask,
+     'bandwidth' its bandwidth in bytes/s or -1 if it has none, 
+     'published' the time of its descriptor in seconds since the epoch,
+     and 'start' and 'end' the offsets of its entry in the document."""
+  def __init__(self):
+    self.idhex = []
+    self.nickname = []
+    self.orhash = []
+    self.flags = array.array("L")
+    self.bandwidth = array.array("l")
+    self.published = array.array("l")
+    self.start = array.array("l")
+    self.end = array.array("l")
+
+  def __len__(self):
+    return len(self.idhex)
+
+  def positions(self):
+    """Return a dict that maps each idhex to its index."""
+    return dict(zip(self.idhex, xrange(len(self.idhex))))
+
+  def has_flags(self, i, flags):
+    """Return true iff router 'i' has all the flags in 'flags'."""
+    mask = ns_flag_mask(flags)
+    return self.flags[i] & mask == mask
+
+  def select(self, flags):
+    """Return the indexes of the routers that have all the flags in
+       'flags'."""
+    mask = ns_flag_mask(flags)
+    return [i for i, f in enumerate(self.flags) if f & mask == mask]
+
+def parse_ns_columns(data):
+  """Parse the body of an NS event or command into a 
+     NetworkStatusColumns."""
+  cols = NetworkStatusColumns()
+  for start, end, w, flags, bandwidth in _iter_ns_entries(data):
+    try:
+      idhex = binascii.b2a_hex(binascii.a2b_base64(w[1]+"=")).upper()
+      d, t = w[3], w[4]
+      published = calendar.timegm((int(d[0:4]), int(d[5:7]), int(d[8:10]),
+                                   int(t[0:2]), int(t[3:5]), int(t[6:8])))
+    except (binascii.Error, ValueError):
+      plog("WARN", "Skipping malformed router entry for "+w[0])
+      continue
+    cols.idhex.append(idhex)
+    cols.nickname.append(w[0])
+    cols.orhash.append(w[2])
+    cols.flags.append(flags)
+    cols.bandwidth.append(bandwidth is None and -1 or bandwidth)
+    cols.published.append(published)
+    cols.start.append(start)
+    cols.end.append(end)
+  return cols
 
 class EventSink:
   def heartbeat_event(self, event): pass
@@ -1066,6 +1786,11 @@ class EventHandler(EventSink):
   """An 'EventHandler' wraps callbacks for the events Tor can return. 
      Each event argument is an instance of the corresponding event
      class."""
+  # True for handlers that send commands from their callbacks and use the
+  # replies right away. They need a blocking Connection; see
+  # AsyncSupport.AsyncConnection.
+  sync_replies = False
+
   def __init__(self):
     """Create a new EventHandler."""
     self._map1 = {
@@ -1090,11 +1815,35 @@ class EventHandler(EventSink):
     self.c = None # Gets set by Connection.set_event_hanlder()
     self.pre_listeners = []
     self.post_listeners = []
+    self._wanted = {}
+
+  def _wants(self, evtype):
+    """Return true iff the handler or one of its listeners does anything
+       with events of type 'evtype'. Cached per type until the listeners
+       change."""
+    try:
+      return self._wanted[evtype]
+    except KeyError:
+      pass
+    wanted = not _is_noop(self.heartbeat_event) or \
+        not _is_noop(self._map1.get(evtype, self.unknown_event))
+    for l in self.pre_listeners + self.post_listeners:
+      if wanted: break
+      wanted = l.listen.im_func is not EventListener.listen.im_func or \
+          not _is_noop(l.heartbeat_event) or \
+          not _is_noop(l._map1.get(evtype, l.unknown_event))
+    self._wanted[evtype] = wanted
+    return wanted
 
   def _handle1(self, timestamp, lines):
-    """Dispatcher: called from Connection when an event is received."""
+    """Dispatcher: called from Connection when an event is received.
+       Events of types nobody handles are dropped undecoded, and the rest
+       are only decoded once a handler reads their fields."""
     for code, msg, data in lines:
-      event = self._decode1(msg, data)
+      evtype = msg.split(" ", 1)[0].upper()
+      if not self._wants(evtype):
+        continue
+      event = LazyEvent(evtype, msg, data, self._decode1)
       event.arrived_at = timestamp
       event.state=EVENT_STATE.PRELISTEN
       for l in self.pre_listeners:
@@ -1243,6 +1992,7 @@ class EventHandler(EventSink):
     if isinstance(evlistener, PostEventListener):
       self.post_listeners.append(evlistener)
     evlistener.set_parent(self)
+    self._wanted.clear()
 
   def heartbeat_event(self, event):
     """Called before any event is received. Convenience function
@@ -1311,6 +2061,16 @@ class EventHandler(EventSink):
   def timer_event(self, event):
     pass
 
+# The do-nothing EventSink and EventHandler callbacks. An event type whose
+# callbacks are all among these doesn't need to be decoded.
+_NOOP_CALLBACKS = frozenset([getattr(cls, name).im_func
+                             for cls in (EventSink, EventHandler)
+                             for name in EventSink.__dict__
+                             if name.endswith("_event")])
+
+def _is_noop(callback):
+  return getattr(callback, "im_func", callback) in _NOOP_CALLBACKS
+
 class Consensus:
   """
   A Consensus is a pickleable container for the members of
@@ -1331,6 +2091,8 @@ class ConsensusTracker(EventHandler):
   A ConsensusTracker is an EventHandler that tracks the current
   consensus of Tor in self.ns_map, self.routers and self.sorted_r
   """
+  sync_replies = True # Fetches descriptors from its event callbacks
+
   def __init__(self, c, RouterClass=Router):
     EventHandler.__init__(self)
     c.set_event_handler(self)
@@ -1370,8 +2132,7 @@ class ConsensusTracker(EventHandler):
     for i in removed_idhexes:
       if i not in self.routers: continue
       self.routers[i].down = True
-      if "Running" in self.routers[i].flags:
-        self.routers[i].flags.remove("Running")
+      self.routers[i].flags = self.routers[i].flags.without("Running")
       if self.routers[i].refcount == 0:
         self.routers[i].deleted = True
         if self.routers[i].__class__.__name__ == "StatsRouter":
@@ -1421,14 +2182,24 @@ class ConsensusTracker(EventHandler):
  
   def new_desc_event(self, d):
     update = False
-    for i in d.idlist:
-      r = None
-      try:
-        ns = self.c.get_network_status("id/"+i)
-        r = self.c.read_routers(ns)
-      except ErrorReply, e:
-        plog("WARN", "Error reply for "+i+" after NEWDESC: "+str(e))
-        continue
+    # Fetch every network status, then every descriptor, PIPELINE_WINDOW
+    # at a time rather than two round-trips per router
+    nslists = []
+    for w in xrange(0, len(d.idlist), PIPELINE_WINDOW):
+      window = d.idlist[w:w+PIPELINE_WINDOW]
+      futures = self.c.sendAndRecvPipelined(["GETINFO ns/id/"+i+"\r\n"
+                                             for i in window])
+      for i, future in zip(window, futures):
+        try:
+          nslists.append((i, parse_ns_body(future.result()[0][2])))
+        except ErrorReply, e:
+          plog("WARN", "Error reply for "+i+" after NEWDESC: "+str(e))
+    routers = self.c._get_routers([ns for i, nslist in nslists
+                                   for ns in nslist])
+    start = 0
+    for i, ns in nslists:
+      r = filter(None, routers[start:start+len(ns)])
+      start += len(ns)
       if not r:
         plog("WARN", "No router desc for "+i+" after NEWDESC")
         continue
@@ -14,6 +14,9 @@ import socket
 import binascii
 import math
 import time
+import random
+import atexit
+import threading
 import ConfigParser
 
 if sys.version_info < (2, 5):
@@ -23,7 +26,8 @@ else:
 
 __all__ = ["Enum", "Enum2", "Callable", "sort_list", "quote", "escape_dots", "unescape_dots",
       "BufSock", "secret_to_key", "urandom_rng", "s2k_gen", "s2k_check", "plog", 
-     "ListenSocket", "zprob", "logfile", "loglevel"]
+     "ListenSocket", "zprob", "logfile", "loglevel", "ProtocolTrace",
+     "tracelevels"]
 
 # TODO: This isn't the right place for these.. But at least it's unified.
 tor_port = 9060
@@ -170,58 +174,271 @@ def escape_dots(s, translate_nl=1):
   return "\r\n".join(lines)
 
 def unescape_dots(s, translate_nl=1):
-  lines = s.split("\r\n")
-
-  for i in xrange(len(lines)):
-    if lines[i].startswith("."):
-      lines[i] = lines[i][1:]
-
-  if lines and lines[-1]:
-    lines.append("")
+  # Same result as removing the leading dot of every "\r\n"-separated line
+  # and making sure the last one is terminated, but in a few C-level passes
+  # instead of a Python loop over every line.
+  if s.startswith("."):
+    s = s[1:]
+  s = s.replace("\r\n.", "\r\n")
+  if s and not s.endswith("\r\n"):
+    s += "\r\n"
 
   if translate_nl:
-    return "\n".join(lines)
+    return s.replace("\r\n", "\n")
   else:
-    return "\r\n".join(lines)
+    return s
 
 # XXX: Exception handling
 class BufSock:
+  """ Buffered line reader for a socket. Data is received in large chunks
+      with recv_into() and kept in a single growable bytearray; lines and
+      data blocks are located by offset and copied out exactly once. """
+  CHUNK_SIZE = 65536
+
   def __init__(self, s):
     self._s = s
-    self._buf = []
+    self._buf = bytearray()
+    self._pos = 0 # Start of the unread data in _buf
+    self._chunk = bytearray(self.CHUNK_SIZE)
+    self._view = memoryview(self._chunk)
+
+  def _fill(self):
+    """ Receive the next chunk from the socket. Returns False on EOF. """
+    # Drop consumed data once it's most of the buffer, so that the buffer
+    # doesn't grow without bound but isn't shifted for every line either.
+    if self._pos and self._pos >= len(self._buf) - self._pos:
+      del self._buf[:self._pos]
+      self._pos = 0
+    n = self._s.recv_into(self._chunk)
+    if not n: return False
+    self._buf += self._view[:n]
+    return True
+
+  def _take(self, end):
+    """ Return the unread data up to offset 'end' and consume it. """
+    result = str(self._buf[self._pos:end])
+    self._pos = end
+    return result
+
+  def buffered(self):
+    """ Return the number of bytes received but not read yet. """
+    return len(self._buf) - self._pos
 
   def readline(self):
-    if self._buf:
-      idx = self._buf[0].find('\n')
-      if idx >= 0:
-        result = self._buf[0][:idx+1]
-        self._buf[0] = self._buf[0][idx+1:]
-        return result
-
+    """ Return the next line including its newline, or None if the socket
+        was closed first. """
+    scan = self._pos
     while 1:
-      s = self._s.recv(128)
-      if not s: return None
+      idx = self._buf.find('\n', scan)
+      if idx >= 0:
+        return self._take(idx+1)
+      scan = len(self._buf)
+      pos = self._pos
+      if not self._fill(): return None
       # XXX: This really does need an exception
       #  raise ConnectionClosed()
-      idx = s.find('\n')
-      if idx >= 0:
-        self._buf.append(s[:idx+1])
-        result = "".join(self._buf)
-        rest = s[idx+1:]
-        if rest:
-          self._buf = [ rest ]
-        else:
-          del self._buf[:]
+      scan -= pos - self._pos # _fill() may have shifted the buffer
+
+  def readblock(self, terminators):
+    """ Return all lines up to (but not including) the first line that is
+        equal to one of 'terminators', and consume the terminator as well.
+        The terminator lines are located by searching the buffer for them
+        directly, and the lines before them are returned as one string,
+        sliced out of the buffer in a single copy. Returns None if the 
+        socket was closed first. """
+    start = self._pos
+    scan = start
+    longest = max([len(t) for t in terminators])
+    while 1:
+      end = self._find_terminator(terminators, start, scan)
+      if end is not None:
+        line_start, line_end = end
+        result = self._take(line_start)
+        self._pos = line_end
         return result
-      else:
-        self._buf.append(s)
+      # A terminator may straddle the end of the data we have so far
+      scan = max(start, len(self._buf) - longest)
+      pos = self._pos
+      if not self._fill(): return None
+      start -= pos - self._pos
+      scan -= pos - self._pos
+
+  def _find_terminator(self, terminators, start, scan):
+    """ Return the (start, end) offsets of the first line at or after
+        'scan' that equals one of 'terminators', or None. """
+    best = None
+    for t in terminators:
+      if scan == start and self._buf.startswith(t, start):
+        return (start, start+len(t))
+      idx = self._buf.find('\n'+t, max(start, scan-1))
+      if idx >= 0 and (best is None or idx < best[0]):
+        best = (idx+1, idx+1+len(t))
+    return best
 
   def write(self, s):
-    self._s.send(s)
+    self._s.sendall(s)
 
   def close(self):
     self._s.close()
 
+tracelevels = {"OFF" : 0, "COMMANDS" : 1, "HEADERS" : 2, "FULL" : 3}
+
+class ProtocolTrace:
+  """ A trace of the control protocol, for Connection.debug(). Depending
+      on 'level' (see tracelevels) it records the commands sent to Tor
+      (COMMANDS), also the lines of every reply and event with data blocks
+      replaced by their size (HEADERS), or everything (FULL). Even at FULL,
+      data blocks longer than 'max_data' bytes are only recorded by size,
+      unless 'max_data' is None.
+
+      Only a 'sample' fraction of the commands and replies are recorded.
+      Records are formatted on the connection's thread but written by a
+      background thread, every 'flush_interval' seconds or once
+      'buffer_size' bytes are waiting. 'f' is either a file name or an open
+      file. A named file is rotated once it reaches 'max_bytes' bytes,
+      keeping 'backups' old files as f.1 (the newest) to f.<backups>; a
+      'max_bytes' of 0 lets it grow without limit. """
+  def __init__(self, f, level="HEADERS", sample=1.0, max_data=4096,
+               max_bytes=0, backups=3, buffer_size=65536, flush_interval=1.0):
+    self.level = tracelevels[level]
+    self.sample = sample
+    self.max_data = max_data
+    self.max_bytes = max_bytes
+    self.backups = backups
+    self.buffer_size = buffer_size
+    self.flush_interval = flush_interval
+    if isinstance(f, str):
+      self.path = f
+      self._file = open(f, "a")
+      self._written = os.path.getsize(f)
+    else:
+      self.path = None
+      self._file = f
+      self._written = 0
+    self._chunks = []
+    self._pending = 0
+    self._cond = threading.Condition()
+    self._writeLock = threading.Lock() # Keeps writes in order
+    self._thread = None
+    self._closed = False
+    atexit.register(self.close)
+
+  def _sampled(self):
+    return self.sample >= 1.0 or random.random() < self.sample
+
+  def command(self, msg):
+    """ Record a command sent to Tor. Only its first line is kept, since
+        the rest of it can be a whole descriptor. """
+    if self.level < tracelevels["COMMANDS"] or not self._sampled():
+      return
+    line = msg.split("\n", 1)[0].rstrip("\r")
+    self._append("%s\t>>> %s\n" % (time.time(), line))
+
+  def reply(self, lines):
+    """ Record a reply or event, as the list of (code, message, data)
+        tuples read by Connection._read_reply(). """
+    if self.level < tracelevels["HEADERS"] or not self._sampled():
+      return
+    stamp = str(time.time())+"\t  "
+    out = []
+    for code, msg, data in lines:
+      out.append(stamp+code+" "+msg+"\n")
+      if data is None:
+        continue
+      if self.level >= tracelevels["FULL"] and \
+          (self.max_data is None or len(data) <= self.max_data):
+        out.append("+++ "+data)
+      else:
+        out.append("+++ [%d bytes]\n" % len(data))
+    self._append("".join(out))
+
+  def write(self, s):
+    """ Record 's' as is. Lets the trace stand in for a file. """
+    if self.level > tracelevels["OFF"]:
+      self._append(s)
+
+  def _append(self, s):
+    self._cond.acquire()
+    try:
+      if self._closed:
+        return
+      self._chunks.append(s)
+      self._pending += len(s)
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run,
+                                        name="ProtocolTrace")
+        self._thread.setDaemon(1)
+        self._thread.start()
+      elif self._pending >= self.buffer_size:
+        self._cond.notify()
+    finally:
+      self._cond.release()
+
+  def _take(self):
+    self._cond.acquire()
+    try:
+      chunks = self._chunks
+      self._chunks = []
+      self._pending = 0
+      return "".join(chunks)
+    finally:
+      self._cond.release()
+
+  def _run(self):
+    while 1:
+      self._cond.acquire()
+      try:
+        if not self._closed and self._pending < self.buffer_size:
+          self._cond.wait(self.flush_interval)
+        closed = self._closed
+      finally:
+        self._cond.release()
+      if closed:
+        return
+      self.flush()
+
+  def flush(self):
+    """ Write out everything recorded so far. """
+    self._writeLock.acquire()
+    try:
+      data = self._take()
+      if not data or self._file is None:
+        return
+      self._file.write(data)
+      self._file.flush()
+      self._written += len(data)
+      if self.path and self.max_bytes and self._written >= self.max_bytes:
+        self._rotate()
+    finally:
+      self._writeLock.release()
+
+  def _rotate(self):
+    self._file.close()
+    for i in xrange(self.backups-1, 0, -1):
+      older = "%s.%d" % (self.path, i)
+      if os.path.exists(older):
+        os.rename(older, "%s.%d" % (self.path, i+1))
+    if self.backups:
+      os.rename(self.path, self.path+".1")
+    self._file = open(self.path, "w")
+    self._written = 0
+
+  def close(self):
+    """ Write out the remaining records and stop the writer thread. Closes
+        the file if the trace opened it. """
+    self._cond.acquire()
+    try:
+      self._closed = True
+      self._cond.notify()
+    finally:
+      self._cond.release()
+    if self._thread is not None:
+      self._thread.join()
+    self.flush()
+    if self.path and self._file is not None:
+      self._file.close()
+      self._file = None
+
 # SocketServer.TCPServer is nuts.. 
 class ListenSocket:
   def __init__(self, listen_ip, port):
@@ -22,7 +22,11 @@ If you are interested in gathering statistics, you can instead
 instantiate or extend from StatsSupport.StatsHandler, which is
 again an event handler with hooks to record statistics on circuit
 creation, stream bandwidth, and circuit failure information.
+
+Controllers that would rather not dedicate threads to each connection can
+use AsyncSupport.AsyncConnection, which runs in an asyncore loop and
+dispatches replies and events to the same EventHandlers.
 """
 
 __all__ = ["TorUtil", "GeoIPSupport", "PathSupport", "TorCtl", "StatsSupport",
-           "SQLSupport", "ScanSupport"]
+           "SQLSupport", "ScanSupport", "AsyncSupport"]
@@ -7,6 +7,35 @@ Configuration settings.
 @var updater_port: The Tor control port for the updater to use. This port 
     must be configured in the torrc file.
 @var base_url: The root URL for the Tor Weather web application.
+@var check_workers: The number of threads that check subscriptions after a
+    new consensus. The checkers are Python code that holds the interpreter
+    lock, so extra threads only overlap waiting on the database and on Tor;
+    they do not use more cores. Each thread has its own database connection,
+    and sqlite serializes writes, so leave this at 1 unless the database is
+    a server with noticeable latency.
+@var mail_senders: The number of threads that deliver queued emails.
+@var mail_max_attempts: The number of delivery attempts before a queued 
+    email is given up on.
+@var mail_retry_delay: The delay in seconds before the first retry of a
+    failed email. The delay doubles with every further attempt.
+@var mail_poll_interval: The number of seconds between two passes of a mail
+    sender over the queue when it isn't woken up.
+@var ctl_pool_size: The largest number of Tor control connections the 
+    updaters keep open at the same time.
+@var ctl_synchronous: Whether the updaters' Tor control connections read
+    replies on the thread that sent the command, rather than starting two
+    threads per connection.
+@var trace_level: How much of the Tor control protocol to trace to
+    log/debug: 'OFF', 'COMMANDS' (only the commands sent), 'HEADERS' (also
+    the reply lines, with data blocks reduced to their size) or 'FULL'.
+@var trace_sample: The fraction of commands and replies to trace.
+@var trace_max_data: The longest data block that is traced in full at the
+    'FULL' level. Longer ones are traced by size only.
+@var trace_max_bytes: The size in bytes at which log/debug is rotated.
+@var trace_backups: The number of rotated trace files to keep.
+@var event_queue_size: The largest number of Tor events queued for the 
+    listener while it is busy checking subscriptions. Repeated new
+    descriptor and consensus events are merged before this limit is hit.
 """
 
 # XXX: Make bulletproof
@@ -17,3 +46,28 @@ control_port = 9051
 
 #The base URL for the Tor Weather web application:
 base_url = 'http://www.weather.torproject.org'
+
+#The number of threads that check subscriptions after a new consensus
+check_workers = 1
+
+#Outbound mail queue settings
+mail_senders = 1
+mail_max_attempts = 8
+mail_retry_delay = 60
+mail_poll_interval = 300
+
+#Tracing of the Tor control protocol to log/debug
+trace_level = 'HEADERS'
+trace_sample = 1.0
+trace_max_data = 4096
+trace_max_bytes = 10 * 1024 * 1024
+trace_backups = 3
+
+#The largest number of Tor events to queue while the listener is busy
+event_queue_size = 1000
+
+#The largest number of Tor control connections to keep open
+ctl_pool_size = 2
+
+#Read Tor's replies on the updater threads instead of separate TorCtl threads
+ctl_synchronous = True
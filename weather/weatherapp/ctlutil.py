@@ -1,24 +1,497 @@
 """This module contains the CtlUtil class. CtlUtil objects set up a connection
 to TorCtl and handle communication concerning consensus documents and 
-descriptor files.
-
-@var debugfile: The debug file used by TorCtl .
+descriptor files. A L{ConsensusSnapshot} holds a fingerprint-indexed copy of
+the full consensus and descriptor documents so that a CtlUtil can answer
+per-router queries without a control port round-trip for each one.
+L{iter_descriptors} walks a descriptor document once and yields a compact
+L{DescriptorRecord} for every router in it. The descriptor accessors of
+CtlUtil all read from such records, which are cached per fingerprint until
+Tor announces a new descriptor or consensus. A L{VersionClassifier} holds the
+recommended versions of the current consensus. CtlUtils are shared across
+runs through the process-wide L{CtlUtilPool} L{pool}, which reconnects when
+a connection has died.
+
+@type debugfile: TorCtl ProtocolTrace
+@var debugfile: The trace of the control protocol in log/debug, or C{None}
+    if L{config.trace_level<config.config>} is C{'OFF'}.
 @var unparsable_email_file: A log file for contacts with unparsable emails.
+@var _END_SIGNATURE: The line that ends every descriptor file.
+@type pool: L{CtlUtilPool}
+@var pool: The pool of control connections shared by the whole process.
 """
 
 import socket
-from TorCtl import TorCtl
+import hashlib
+import threading
+import weakref
+from TorCtl import TorCtl, TorUtil
 from config import config
 import logging
 import re
 import string
 
 #for TorCtl
-debugfile = open('log/debug', 'w')
+debugfile = None
+if config.trace_level != 'OFF':
+    debugfile = TorUtil.ProtocolTrace('log/debug', config.trace_level,
+                                      sample = config.trace_sample,
+                                      max_data = config.trace_max_data,
+                                      max_bytes = config.trace_max_bytes,
+                                      backups = config.trace_backups)
 
 #for unparsable emails
 unparsable_email_file = 'log/unparsable_emails.txt'
 
+_END_SIGNATURE = '-----END SIGNATURE-----'
+
+#Patterns used for every router, compiled once
+_STABLE_RE = re.compile('\ns.* Stable ')
+_PUNCT = string.punctuation
+_EMAIL_RE = re.compile('[^\s]+(?:@|['+_PUNCT+'\s]+at['+_PUNCT+'\s]+).+(?:\.'+
+                       '|['+_PUNCT+'\s]+dot['+_PUNCT+'\s]+)[^\n\s\)\(]+',
+                       re.IGNORECASE)
+_AT_RE = re.compile('['+_PUNCT+'\s]+at['+_PUNCT+'\s]+')
+_DOT_RE = re.compile('['+_PUNCT+'\s]+dot['+_PUNCT+'\s]+')
+
+class DescriptorRecord(object):
+    """The fields Tor Weather uses from a single descriptor file, along with
+    the position of the descriptor in the document it was parsed from.
+
+    @type fingerprint: str
+    @ivar fingerprint: The router's fingerprint with no spaces.
+    @type nickname: str
+    @ivar nickname: The router's name.
+    @type bandwidth: int
+    @ivar bandwidth: The observed bandwidth in B/s.
+    @type platform: str
+    @ivar platform: The platform line without its keyword, e.g. 
+        'Tor 0.2.1.26 on Linux i686'.
+    @type contact: str
+    @ivar contact: The contact line(s), including the keyword.
+    @type hibernating: bool
+    @ivar hibernating: Whether the router published that it is hibernating.
+    @type exit: bool
+    @ivar exit: Whether the exit policy has an accept line for port 80 or
+        for every port. See L{CtlUtil.is_exit}.
+    @type policy: str
+    @ivar policy: A sha1 digest of the exit policy lines.
+    @type email: str
+    @ivar email: The email address parsed from L{contact}, or C{None} if it
+        hasn't been parsed yet. See L{CtlUtil.get_email}.
+    @type start: int
+    @ivar start: The offset of the descriptor in its document.
+    @type end: int
+    @ivar end: The offset just past the descriptor's signature.
+    """
+    __slots__ = ('fingerprint', 'nickname', 'bandwidth', 'platform', 
+                 'contact', 'hibernating', 'exit', 'policy', 'email', 
+                 'start', 'end')
+
+    def __init__(self, start, end):
+        """Create an empty record for the descriptor between C{start} and
+        C{end}."""
+        self.fingerprint = ''
+        self.nickname = ''
+        self.bandwidth = 0
+        self.platform = ''
+        self.contact = ''
+        self.hibernating = False
+        self.exit = False
+        self.policy = ''
+        self.email = None
+        self.start = start
+        self.end = end
+
+def _parse_descriptor(text, start, end):
+    """Parse the descriptor between offsets C{start} and C{end} of C{text},
+    one line at a time. Only the values that are kept are copied out of 
+    C{text}.
+
+    @type text: str
+    @param text: The descriptor document.
+    @type start: int
+    @param start: The offset of the first line of the descriptor.
+    @type end: int
+    @param end: The offset of the descriptor's signature delimiter.
+    @rtype: L{DescriptorRecord}
+    @return: The record of the descriptor.
+    """
+    record = DescriptorRecord(start, end + len(_END_SIGNATURE))
+    policy = hashlib.sha1()
+    contact = []
+    pos = start
+
+    while pos < end:
+        eol = text.find('\n', pos, end)
+        if eol == -1:
+            eol = end
+
+        if text.startswith('router ', pos, eol):
+            words = text[pos:eol].split()
+            if len(words) > 1:
+                record.nickname = words[1]
+        elif text.startswith('opt fingerprint', pos, eol):
+            record.fingerprint = text[pos + 15:eol].replace(' ', '')
+        elif text.startswith('bandwidth', pos, eol):
+            # the 4th word in the line is the bandwidth-observed in B/s
+            words = text[pos:eol].split()
+            if len(words) > 3:
+                record.bandwidth = int(words[3])
+        elif text.startswith('platform ', pos, eol):
+            record.platform = text[pos + 9:eol]
+        elif text.startswith('contact ', pos, eol):
+            contact.append(text[pos:eol])
+        elif text.startswith('opt hibernating 1', pos, eol):
+            record.hibernating = True
+        elif text.startswith('accept', pos, eol):
+            line = text[pos:eol]
+            policy.update(line + '\n')
+            if line.endswith(':80') or line.endswith('*:*'):
+                record.exit = True
+        elif text.startswith('reject', pos, eol):
+            policy.update(text[pos:eol] + '\n')
+
+        pos = eol + 1
+
+    record.contact = ''.join(contact)
+    record.policy = policy.digest()
+    return record
+
+def _platform_version(platform):
+    """Get the Tor version from a platform line.
+
+    @type platform: str
+    @param platform: The platform line without its keyword, e.g.
+        'Tor 0.2.1.26 on Linux i686'.
+    @rtype: str
+    @return: The version, or '' if the platform isn't Tor.
+    """
+    words = platform.split()
+    if len(words) > 1 and words[0] == 'Tor':
+        return words[1]
+    else:
+        return ''
+
+def parse_descriptor(desc):
+    """Parse a single descriptor file, as returned by C{GETINFO 
+    desc/id/...}.
+
+    @type desc: str
+    @param desc: The descriptor file.
+    @rtype: L{DescriptorRecord}
+    @return: The record of the descriptor, or C{None} if C{desc} is empty.
+    """
+    if desc == '':
+        return None
+
+    end = desc.find(_END_SIGNATURE)
+    if end == -1:
+        end = len(desc)
+    record = _parse_descriptor(desc, 0, end)
+    record.end = min(record.end, len(desc))
+    return record
+
+def iter_descriptors(text):
+    """Walk a document of descriptor files, such as the reply to C{GETINFO
+    desc/all-recent}, and yield a L{DescriptorRecord} for every router that
+    publishes its fingerprint. The document is scanned once, by offset, 
+    without splitting it into descriptors or lines. A trailing fragment
+    without a signature is not a complete descriptor and is skipped.
+
+    @type text: str
+    @param text: The descriptor document.
+    @rtype: generator of L{DescriptorRecord}
+    @return: The records of the descriptors in document order.
+    """
+    pos = 0
+    while True:
+        end = text.find(_END_SIGNATURE, pos)
+        if end == -1:
+            break
+
+        start = pos
+        while start < end and text[start] == '\n':
+            start += 1
+
+        record = _parse_descriptor(text, start, end)
+        pos = record.end
+
+        # We ignore routers that don't publish their fingerprints
+        if record.fingerprint != '':
+            yield record
+
+class VersionClassifier:
+    """The recommended versions of one consensus, parsed once so that 
+    classifying a router's version is a dictionary lookup. The types are
+    those returned by L{CtlUtil.get_version_type}.
+
+    @type versions: list[str]
+    @ivar versions: The recommended versions in ascending order.
+    @type stable: list[str]
+    @ivar stable: The recommended versions up to the first alpha or beta.
+    @type recommended: frozenset
+    @ivar recommended: The versions classified as RECOMMENDED: the most 
+        recent stable release and everything after it.
+    @type unrecommended: frozenset
+    @ivar unrecommended: The versions classified as UNRECOMMENDED: the 
+        recommended versions older than the most recent stable release.
+    """
+
+    def __init__(self, version_list):
+        """Classify the versions in C{version_list}.
+
+        @type version_list: list[str]
+        @param version_list: The recommended versions, as listed by Tor.
+        """
+        # Tor lists versions in ascending order; make sure of it, keeping
+        # the listed order for versions that only differ by their tag
+        try:
+            version_list = sorted(version_list, 
+                            key = lambda v: TorCtl.RouterVersion(v).version)
+        except AttributeError:
+            # not a dotted version, so trust Tor's order
+            version_list = list(version_list)
+        self.versions = version_list
+
+        current_stable_index = -1
+        self.stable = version_list
+        for version in version_list:
+            if 'alpha' in version or 'beta' in version:
+                index = version_list.index(version)
+                current_stable_index = index - 1
+                self.stable = version_list[:index]
+                break
+
+        self.recommended = frozenset(version_list[current_stable_index:])
+        self.unrecommended = frozenset(version_list[:current_stable_index]) \
+                             - self.recommended
+        self._types = {}
+
+    def classify(self, version):
+        """Get the type of C{version}. Results are memoized, since thousands
+        of routers run a few dozen versions.
+
+        @type version: str
+        @param version: A Tor version, e.g. '0.2.1.26'.
+        @rtype: str
+        @return: RECOMMENDED, UNRECOMMENDED, OBSOLETE, or ERROR if C{version}
+            is empty.
+        """
+        try:
+            return self._types[version]
+        except KeyError:
+            pass
+
+        if version == '':
+            version_type = 'ERROR'
+        elif version in self.recommended:
+            version_type = 'RECOMMENDED'
+        elif version in self.unrecommended:
+            version_type = 'UNRECOMMENDED'
+        else:
+            version_type = 'OBSOLETE'
+        self._types[version] = version_type
+        return version_type
+
+    def classify_platform(self, platform):
+        """Get the type of the version in a platform line. See 
+        L{classify}.
+
+        @type platform: str
+        @param platform: The platform line without its keyword.
+        @rtype: str
+        @return: The type of the version, or ERROR if there is none.
+        """
+        return self.classify(_platform_version(platform))
+
+    def is_listed(self, version):
+        """Check whether C{version} is one of the recommended versions.
+
+        @type version: str
+        @param version: A Tor version.
+        @rtype: bool
+        @return: C{True} if Tor lists C{version} as recommended.
+        """
+        return version in self.recommended or version in self.unrecommended
+
+class ConsensusSnapshot:
+    """An in-memory copy of the consensus document (C{ns/all}) and of all
+    current descriptor files (C{desc/all-recent}), indexed by router
+    fingerprint. The entries are stored in the same form that C{GETINFO 
+    ns/id/...} and C{GETINFO desc/id/...} return them, so every L{CtlUtil}
+    accessor can be served from the snapshot unchanged.
+
+    @type full_consensus: str
+    @ivar full_consensus: The entire consensus document.
+    @type full_descriptor: str
+    @ivar full_descriptor: All current descriptor files.
+    @type columns: L{TorCtl.NetworkStatusColumns}
+    @ivar columns: The router entries of L{full_consensus}, parsed in
+        columns.
+    @type consensus: dict {str: str}
+    @ivar consensus: Maps fingerprints (no spaces) to their single consensus
+        entry.
+    @type records: dict {str: L{DescriptorRecord}}
+    @ivar records: Maps fingerprints (no spaces) to the record of their 
+        descriptor file. The descriptor text itself is only sliced out of
+        L{full_descriptor} when it is asked for.
+    """
+
+    def __init__(self, full_consensus, full_descriptor):
+        """Parse and index C{full_consensus} and C{full_descriptor}."""
+
+        self.full_consensus = full_consensus
+        self.full_descriptor = full_descriptor
+        self.columns = TorCtl.parse_ns_columns(full_consensus)
+        self._positions = self.columns.positions()
+        self.consensus = self._index_consensus(full_consensus)
+        self.records = self._index_descriptors(full_descriptor)
+        self._digests = None
+
+    def _index_consensus(self, full_consensus):
+        """Split the consensus document into its router entries, using the
+        offsets in L{columns}.
+
+        @type full_consensus: str
+        @param full_consensus: The entire consensus document.
+        @rtype: dict {str: str}
+        @return: A dictionary mapping fingerprints to consensus entries.
+        """
+        entries = {}
+        cols = self.columns
+
+        for i in xrange(len(cols)):
+            entry = full_consensus[cols.start[i]:cols.end[i]]
+            if not entry.endswith('\n'):
+                entry += '\n'
+            entries[cols.idhex[i]] = entry
+
+        return entries
+
+    def has_flag(self, fingerprint, flag):
+        """Check if a router's consensus entry has a flag.
+
+        @type fingerprint: str
+        @param fingerprint: Fingerprint of the router with no spaces.
+        @type flag: str
+        @param flag: The flag to check for, such as 'Stable'.
+        @rtype: bool
+        @return: True if the router is in the consensus and has C{flag}.
+        """
+        i = self._positions.get(fingerprint)
+        if i == None:
+            return False
+        return self.columns.has_flags(i, [flag])
+
+    def _index_descriptors(self, full_descriptor):
+        """Split the descriptor document into individual descriptor files.
+
+        @type full_descriptor: str
+        @param full_descriptor: All current descriptor files.
+        @rtype: dict {str: L{DescriptorRecord}}
+        @return: A dictionary mapping fingerprints to descriptor records.
+        """
+        return dict([(record.fingerprint, record) 
+                     for record in iter_descriptors(full_descriptor)])
+
+    def get_consensus(self, fingerprint):
+        """Get the consensus entry for the router with fingerprint
+        C{fingerprint}.
+
+        @type fingerprint: str
+        @param fingerprint: Fingerprint of the router with no spaces.
+        @rtype: str
+        @return: The consensus entry, or the empty string if the router is
+            not in the consensus.
+        """
+        return self.consensus.get(fingerprint, '')
+
+    def get_descriptor(self, fingerprint):
+        """Get the descriptor file for the router with fingerprint
+        C{fingerprint}.
+
+        @type fingerprint: str
+        @param fingerprint: Fingerprint of the router with no spaces.
+        @rtype: str
+        @return: The descriptor file, or the empty string if there is no
+            current descriptor for the router.
+        """
+        record = self.records.get(fingerprint)
+        if record == None:
+            return ''
+        return self.full_descriptor[record.start:record.end] + '\n'
+
+    def get_record(self, fingerprint):
+        """Get the record of the descriptor file for the router with 
+        fingerprint C{fingerprint}.
+
+        @type fingerprint: str
+        @param fingerprint: Fingerprint of the router with no spaces.
+        @rtype: L{DescriptorRecord}
+        @return: The descriptor record, or C{None} if there is no current
+            descriptor for the router.
+        """
+        return self.records.get(fingerprint)
+
+    def _digest(self, fingerprint):
+        """Compute a digest of the parts of a router's consensus entry and
+        descriptor that Tor Weather uses: whether it is up or hibernating,
+        its name, flags, observed bandwidth, platform, exit policy and
+        contact line.
+
+        @type fingerprint: str
+        @param fingerprint: Fingerprint of the router with no spaces.
+        @rtype: str
+        @return: The digest of the router's state.
+        """
+        cons = self.get_consensus(fingerprint)
+        record = self.get_record(fingerprint)
+        fields = [str(cons != '')]
+
+        for line in cons.split('\n'):
+            if line.startswith('s '):
+                fields.append(line)
+
+        if record != None:
+            fields.extend([record.nickname, str(record.bandwidth), 
+                           record.platform, record.policy, record.contact,
+                           str(record.hibernating)])
+
+        return hashlib.sha1('\n'.join(fields)).digest()
+
+    def digests(self):
+        """Get the digests of every router in the snapshot. See L{_digest}.
+
+        @rtype: dict {str: str}
+        @return: A dictionary mapping fingerprints to digests.
+        """
+        if self._digests is None:
+            fingerprints = set(self.consensus.keys())
+            fingerprints.update(self.records.keys())
+            self._digests = dict([(finger, self._digest(finger)) 
+                                  for finger in fingerprints])
+        return self._digests
+
+    def changed_since(self, previous):
+        """Get the fingerprints of the routers whose state differs from 
+        C{previous}, including routers that appeared or disappeared.
+
+        @type previous: dict {str: str}
+        @param previous: The L{digests} of an earlier snapshot, or C{None}.
+        @rtype: set
+        @return: The fingerprints of the changed routers, or C{None} if there
+            is no earlier snapshot to compare against.
+        """
+        if previous is None:
+            return None
+
+        current = self.digests()
+        changed = set([finger for finger, digest in current.items()
+                       if previous.get(finger) != digest])
+        changed.update([finger for finger in previous 
+                        if finger not in current])
+        return changed
+
 class CtlUtil:
     """A class that handles communication with the local Tor process via
     TorCtl.
@@ -40,6 +513,25 @@ class CtlUtil:
     @ivar authenticator: Authenticator string of the TorCtl connection.
     @type control: TorCtl Connection
     @ivar control: Connection to TorCtl.
+    @type owns_control: bool
+    @ivar owns_control: Whether this CtlUtil opened L{control} itself, and so
+        should close it. See L{close}.
+    @type synchronous: bool
+    @ivar synchronous: Whether L{control} is a TorCtl SyncConnection, which
+        runs no threads and only delivers events when polled.
+    @type snapshot: L{ConsensusSnapshot}
+    @ivar snapshot: The snapshot that single consensus and descriptor
+        requests are answered from, or C{None} if every request should be
+        sent to Tor. See L{load_snapshot}.
+    @type _records: dict {str: L{DescriptorRecord}}
+    @ivar _records: Descriptor records fetched from Tor while no snapshot is
+        loaded, by fingerprint. See L{get_record}.
+    @type _generation: int
+    @ivar _generation: Incremented whenever L{_records} is invalidated, so
+        that a record fetched before the invalidation isn't cached after it.
+    @type _classifier: L{VersionClassifier}
+    @ivar _classifier: The recommended versions of the current consensus, or
+        C{None} if they haven't been fetched yet.
     """
     _CONTROL_HOST = '127.0.0.1'
     _CONTROL_PORT = config.control_port 
@@ -47,18 +539,38 @@ class CtlUtil:
     
     def __init__(self, control_host = _CONTROL_HOST, 
                 control_port = _CONTROL_PORT, sock = None, 
-                authenticator = _AUTHENTICATOR):
-        """Initialize the CtlUtil object, connect to TorCtl."""
+                authenticator = _AUTHENTICATOR, control = None,
+                synchronous = False):
+        """Initialize the CtlUtil object, connect to TorCtl. If C{control}
+        is given, it is used instead: it must already be authenticated and
+        have NEWDESC and NEWCONSENSUS events enabled, and it isn't closed
+        by L{close}. If C{synchronous} is C{True}, the new connection reads
+        replies on the calling thread instead of starting two threads of
+        its own."""
+
+        self.snapshot = None
+        self._records = {}
+        self._generation = 0
+        self._classifier = None
+        self.control_host = control_host
+        self.control_port = control_port
+        self.authenticator = authenticator
+
+        if control != None:
+            self.sock = None
+            self.control = control
+            self.owns_control = False
+            self.synchronous = isinstance(control, TorCtl.SyncConnection)
+            self.control.add_event_listener(_RecordCacheListener(self))
+            return
 
         self.sock = sock
+        self.owns_control = True
+        self.synchronous = synchronous
 
         if not sock:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-        self.control_host = control_host
-        self.control_port = control_port
-        self.authenticator = authenticator
-
         # Try to connect 
         try:
             self.sock.connect((self.control_host, self.control_port))
@@ -71,31 +583,140 @@ class CtlUtil:
             raise
 
         
-        self.control = TorCtl.Connection(self.sock)
+        if synchronous:
+            self.control = TorCtl.SyncConnection(self.sock)
+        else:
+            self.control = TorCtl.Connection(self.sock)
 
         # Authenticate connection
-        self.control.authenticate(config.authenticator)
+        self.control.authenticate(self.authenticator)
 
         # Set up log file
-        self.control.debug(debugfile)
+        if debugfile != None:
+            self.control.debug(debugfile)
+
+        # Forget cached descriptor records when Tor learns new descriptors
+        self.control.add_event_listener(_RecordCacheListener(self))
+        self.control.set_events([TorCtl.EVENT_TYPE.NEWDESC,
+                                 TorCtl.EVENT_TYPE.NEWCONSENSUS])
 
     def __del__(self):
         """Closes the connection when the CtlUtil object is garbage collected.
         (From original Tor Weather)
         """
         
-        self.sock.close()
+        if self.sock != None:
+            self.sock.close()
         del self.sock
         self.sock = None
 
-        try:
-            self.connection.close()
-        except:
-            pass
-        
         del self.control
         self.control = None
 
+    def close(self):
+        """Close the connection to TorCtl, unless it was passed in by the
+        caller."""
+        if self.owns_control:
+            try:
+                self.control.close()
+            except:
+                pass
+            try:
+                self.sock.close()
+            except:
+                pass
+
+    def is_live(self):
+        """Check whether the connection to TorCtl is still usable.
+
+        A synchronous connection is polled for events first, which also
+        notices if Tor has closed it.
+
+        @rtype: bool
+        @return: C{True} if the connection is open and, unless it is
+            synchronous, its threads are running, C{False} otherwise.
+        """
+        try:
+            self.poll_events()
+            return bool(self.control.is_live())
+        except Exception:
+            return False
+
+    def poll_events(self):
+        """Let a synchronous connection deliver the NEWDESC and NEWCONSENSUS
+        events that arrived since it was last polled, so that the cached
+        records and versions are invalidated. Does nothing for a threaded
+        connection, which delivers events as they arrive."""
+        if self.synchronous:
+            self.control.poll_events()
+
+    def load_snapshot(self):
+        """Fetch the full consensus and descriptor documents and the 
+        recommended versions once, and answer all following single consensus
+        and descriptor requests from them.
+        This should be called once per consensus, since the snapshot is not
+        updated when Tor learns new descriptors.
+
+        @rtype: L{ConsensusSnapshot}
+        @return: The newly loaded snapshot.
+        """
+        self.snapshot = None
+
+        # Request both documents and the recommended versions back-to-back
+        # rather than waiting for each reply in turn
+        consensus, descriptor, versions = self.control.get_info_pipelined(
+            ["ns/all", "desc/all-recent", "status/version/recommended"])
+        full_consensus = consensus.result().values()[0]
+        full_descriptor = descriptor.result().values()[0]
+        self._classifier = VersionClassifier(
+            versions.result().values()[0].split(','))
+
+        self.snapshot = ConsensusSnapshot(full_consensus, full_descriptor)
+        return self.snapshot
+
+    def clear_snapshot(self):
+        """Discard the current snapshot, so that requests go to Tor again."""
+        self.snapshot = None
+
+    def invalidate_records(self, fingerprints = None):
+        """Forget cached descriptor records.
+
+        @type fingerprints: list[str]
+        @param fingerprints: The fingerprints whose records are outdated, or
+            C{None} to forget all records.
+        """
+        self._generation += 1
+        if fingerprints == None:
+            self._records = {}
+        else:
+            for fingerprint in fingerprints:
+                self._records.pop(fingerprint, None)
+
+    def get_record(self, fingerprint):
+        """Get the parsed descriptor of the router with fingerprint 
+        C{fingerprint}. Every descriptor is parsed only once: records come 
+        from the snapshot if one is loaded, and are otherwise cached until
+        L{invalidate_records} is called for them.
+
+        @type fingerprint: str
+        @param fingerprint: Fingerprint of the router with no spaces.
+        @rtype: L{DescriptorRecord}
+        @return: The descriptor record, or C{None} if there is no current
+            descriptor for the router.
+        """
+        if self.snapshot is not None:
+            return self.snapshot.get_record(fingerprint)
+
+        self.poll_events()
+        if fingerprint in self._records:
+            return self._records[fingerprint]
+
+        generation = self._generation
+        record = parse_descriptor(self.get_single_descriptor(fingerprint))
+        if generation == self._generation:
+            self._records[fingerprint] = record
+        return record
+
     def get_single_consensus(self, node_id):
         """Get a consensus document for a specific router with fingerprint
         C{node_id}.
@@ -106,6 +727,9 @@ class CtlUtil:
         @return: String representation of the single consensus entry or the
                  empty string if the consensus entry cannot be retrieved.
         """
+        if self.snapshot is not None:
+            return self.snapshot.get_consensus(node_id)
+
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
         cons = ''
@@ -129,6 +753,9 @@ class CtlUtil:
         @rtype: str
         @return: String representation of entire consensus document.
         """
+        if self.snapshot is not None:
+            return self.snapshot.full_consensus
+
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
         return self.control.get_info("ns/all").values()[0]
@@ -144,6 +771,9 @@ class CtlUtil:
         @return: String representation of the single descirptor file or
         the empty string if no such descriptor file exists.
         """
+        if self.snapshot is not None:
+            return self.snapshot.get_descriptor(node_id)
+
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
         desc = ''
@@ -162,25 +792,62 @@ class CtlUtil:
         @rtype: str
         @return: String representation of all descriptor files.
         """
+        if self.snapshot is not None:
+            return self.snapshot.full_descriptor
+
         # get_info method returns a dictionary with single mapping, with
         # all the info stored as the single value, so this extracts the string
         return self.control.get_info("desc/all-recent").values()[0]
 
+    def get_descriptor_records(self):
+        """Get the records of all descriptor files for every router currently
+        up. The records come from the snapshot if one is loaded, and are 
+        otherwise parsed from the descriptor document as they are consumed.
+
+        @rtype: iterable of L{DescriptorRecord}
+        @return: The records of all descriptor files that have a fingerprint.
+        """
+        if self.snapshot is not None:
+            return self.snapshot.records.itervalues()
+        return iter_descriptors(self.get_full_descriptor())
+
     def get_descriptor_list(self):
         """Get a list of strings of all descriptor files for every router
         currently up.
 
         @rtype: list[str]
-        @return: List of strings representing all individual descriptor files.
+        @return: List of strings representing all individual descriptor files,
+            each ending with its signature.
+        """
+        full_descriptor = self.get_full_descriptor()
+        return [full_descriptor[record.start:record.end] 
+                for record in iter_descriptors(full_descriptor)]
+
+    def get_version_classifier(self):
+        """Get the recommended versions of the current consensus. They are
+        only requested from Tor once per consensus.
+
+        @rtype: L{VersionClassifier}
+        @return: The classifier for the currently recommended versions.
         """
-        # Individual descriptors are delimited by -----END SIGNATURE-----
-        return self.get_full_descriptor().split("-----END SIGNATURE-----")
+        self.poll_events()
+        classifier = self._classifier
+        if classifier == None:
+            classifier = VersionClassifier(
+                self.control.get_info("status/version/recommended").\
+                values()[0].split(','))
+            self._classifier = classifier
+        return classifier
+
+    def invalidate_versions(self):
+        """Forget the recommended versions, so that they are requested again
+        the next time they are needed."""
+        self._classifier = None
 
     def get_rec_version_list(self):
         """Get a list of currently recommended versions sorted in ascending
         order."""
-        return self.control.get_info("status/version/recommended").\
-        values()[0].split(',')
+        return list(self.get_version_classifier().versions)
 
     def get_stable_version_list(self):
         """Get a list of stable, recommended versions of client software.
@@ -189,14 +856,7 @@ class CtlUtil:
         @return: A list of stable, recommended versions of client software
         sorted in ascending order.
         """
-        version_list = self.get_rec_version_list()
-        for version in version_list:
-            if 'alpha' in version or 'beta' in version:
-                index = version_list.index(version)
-                version_list = version_list[:index]
-                break
-
-        return version_list
+        return list(self.get_version_classifier().stable)
 
     def get_version(self, fingerprint):
         """Get the version of the Tor software that the relay with fingerprint
@@ -209,13 +869,10 @@ class CtlUtil:
         @return: The version of the Tor software that this relay is running or
                  '' if the version cannot be retrieved.
         """
-        desc = self.get_single_descriptor(fingerprint)
-        search = re.search('\nplatform\sTor\s.*\s', desc)
-
-        if search != None:
-            return search.group().split()[2].replace(' ', '')
-        else:
+        record = self.get_record(fingerprint)
+        if record == None:
             return ''
+        return _platform_version(record.platform)
         
     def get_version_type(self, fingerprint):
         """Get the type of version the relay with fingerprint C{fingerprint}
@@ -234,35 +891,10 @@ class CtlUtil:
         and OBSOLETE if the version isn't on the list. If the relay's version
         cannot be determined, return ERROR.
         """
-        version_list = self.get_rec_version_list()
-        client_version = self.get_version(fingerprint)
-
-        if client_version == '':
+        record = self.get_record(fingerprint)
+        if record == None:
             return 'ERROR'
-
-        current_stable_index = -1
-        for version in version_list:
-            if 'alpha' in version or 'beta' in version:
-                current_stable_index = version_list.index(version) - 1
-                break
-        
-        #if the client has one of these versions, return RECOMMENDED
-        rec_list = version_list[current_stable_index:]
-        
-        #if the client has one of these, return UNRECOMMENDED
-        unrec_list = version_list[:current_stable_index]
-
-        for version in rec_list:
-            if client_version == version:
-                return 'RECOMMENDED'
-        
-        for version in unrec_list:
-            if client_version == version:
-                return 'UNRECOMMENDED'
-
-        #the client doesn't have a RECOMMENDED or UNRECOMMENDED version,
-        #so it must be OBSOLETE
-        return 'OBSOLETE'
+        return self.get_version_classifier().classify_platform(record.platform)
 
 
     def has_rec_version(self, fingerprint):
@@ -276,15 +908,8 @@ class CtlUtil:
         @return: C{True} if the router is running a recommended version, 
             C{False} if not.
         """
-        rec_version_list = self.get_rec_version_list()
         node_version = self.get_version(fingerprint) 
-        rec_version = False
-        for version in rec_version_list:
-            if version == node_version:
-                rec_version = True
-                break
-
-        return rec_version
+        return self.get_version_classifier().is_listed(node_version)
 
     def is_up(self, fingerprint):
         """Check if this node is up (actively running) by requesting a
@@ -313,13 +938,8 @@ class CtlUtil:
             or if the descriptor file can't be accessed for this router.
         """
         try:
-            descriptor = self.get_single_descriptor(node_id)
-            desc_lines = descriptor.split('\n')
-            for line in desc_lines:
-                if (line.startswith('accept') and (line.endswith(':80') 
-                                                   or line.endswith('*:*'))):
-                    return True
-            return False
+            record = self.get_record(node_id)
+            return record != None and record.exit
         except TorCtl.ErrorReply, e:
             logging.error("ErrorReply: %s" % str(e))
             return False
@@ -337,30 +957,8 @@ class CtlUtil:
         """
         # Make a list of tuples of all router fingerprints in descriptor
         # with whitespace removed and router names.
-        router_list= []
-            
-        # Loop through each individual descriptor file.
-        for desc in self.get_descriptor_list():
-            finger = ""
-
-            # Split each descriptor into lines.
-            desc_lines = desc.split("\n")
-                
-            # Loop through each line in the descriptor.
-            for line in desc_lines:
-                if line.startswith("opt fingerprint"):
-                    # Eliminate 'opt fingerprint' and spaces from line
-                    finger = line.replace('opt fingerprint', '')
-                    finger = finger.replace(' ', '')
-                if line.startswith("router "):
-                    # Router name is positioned as second word
-                    name = line.split()[1]
-
-            # We ignore routers that don't publish their fingerprints
-            if not finger == "":
-                router_list.append((finger, name))
-        
-        return router_list
+        return [(record.fingerprint, record.nickname) 
+                for record in self.get_descriptor_records()]
 
     def get_finger_list(self):
         """Get a list of fingerprints for all routers in the current
@@ -409,10 +1007,13 @@ class CtlUtil:
         @return: The router operator's email address or the empty string if
                 the email address is unable to be parsed.
         """
-        
-        desc = self.get_single_descriptor(fingerprint)
-        email = self._parse_email(desc)
-        return email
+        record = self.get_record(fingerprint)
+        if record == None:
+            return self._parse_contact('')
+
+        if record.email == None:
+            record.email = self._parse_contact(record.contact)
+        return record.email
 
     def is_stable(self, fingerprint):
         """Check if a Tor node has the stable flag.
@@ -424,9 +1025,11 @@ class CtlUtil:
         flag, false otherwise.
         """
 
+        if self.snapshot is not None:
+            return self.snapshot.has_flag(fingerprint, 'Stable')
         try:
             info = self.get_single_consensus(fingerprint)
-            if re.search('\ns.* Stable ', info):
+            if _STABLE_RE.search(info):
                 return True
             else:
                 return False
@@ -449,13 +1052,8 @@ class CtlUtil:
         @return: True if the Tor relay has a current descriptor file with
         the hibernating flag, False otherwise."""
 
-        desc = self.get_single_descriptor(fingerprint)
-        if not desc == "":
-            hib_search = re.search('opt hibernating 1', desc)
-            if not hib_search == None:
-                return True
-            else:
-                return False
+        record = self.get_record(fingerprint)
+        return record != None and record.hibernating
 
     def is_up_or_hibernating(self, fingerprint):
         """Check if the Tor relay with fingerprint C{fingerprint} is up or 
@@ -479,15 +1077,10 @@ class CtlUtil:
         @rtype: float
         @return: The observed bandwidth for this Tor relay.
         """
-        desc = self.get_single_descriptor(fingerprint)
-        bandwidth = 0	  	
-        desc_lines = desc.split('\n')
-        for line in desc_lines:
-            if line.startswith('bandwidth'):
-                word_list = line.split()
-                # the 4th word in the line is the bandwidth-observed in B/s
-                bandwidth = int(word_list[3]) / 1000
-        return bandwidth
+        record = self.get_record(fingerprint)
+        if record == None:
+            return 0
+        return record.bandwidth / 1000
         
     def _parse_email(self, desc):
         """Parse the email address from an individual router descriptor 
@@ -500,19 +1093,24 @@ class CtlUtil:
         @return: The email address in desc. If the email address cannot be
                 parsed, the empty string.
         """
-        split_desc = desc.split('\n')
-        punct = string.punctuation
-        contact = ""
+        record = parse_descriptor(desc)
+        if record == None:
+            return self._parse_contact('')
+        return self._parse_contact(record.contact)
 
-        for line in split_desc:
-            if line.startswith('contact '):
-                contact = contact + line
+    def _parse_contact(self, contact):
+        """Parse the email address from the contact line(s) of a router
+        descriptor.
 
+        @type contact: str
+        @param contact: The contact line(s), including the keyword.
+        @rtype: str
+        @return: The email address in contact. If the email address cannot be
+                parsed, the empty string.
+        """
         clean_line = contact.replace('<', ' ').replace('>', ' ') 
 
-        email = re.search('[^\s]+(?:@|['+punct+'\s]+at['+punct+'\s]+).+(?:\.'+
-                          '|['+punct+'\s]+dot['+punct+'\s]+)[^\n\s\)\(]+', 
-                          clean_line, re.IGNORECASE)
+        email = _EMAIL_RE.search(clean_line)
     
         if email == None:
             logging.info("Couldn't parse an email address from line:\n%s" %
@@ -525,9 +1123,140 @@ class CtlUtil:
         else:
             email = email.group()
             email = email.lower()
-            email = re.sub('['+punct+'\s]+at['+punct+'\s]+', '@', email)
-            email = re.sub('['+punct+'\s]+dot['+punct+'\s]+', '.', email)
+            email = _AT_RE.sub('@', email)
+            email = _DOT_RE.sub('.', email)
             email = email.replace(' d0t ', '.').replace(' hyphen ', '-').\
                     replace(' ', '')
 
         return email
+
+class _RecordCacheListener(TorCtl.PostEventListener):
+    """Invalidates the descriptor records and recommended versions cached by
+    a L{CtlUtil} when Tor learns new descriptors or a new consensus.
+
+    @type ctl_util: weakref.ref
+    @ivar ctl_util: A weak reference to the CtlUtil whose cache is 
+        invalidated, so that the event thread doesn't keep the CtlUtil (and
+        its socket) alive.
+    """
+
+    def __init__(self, ctl_util):
+        """Create a listener for C{ctl_util}'s cache."""
+        TorCtl.PostEventListener.__init__(self)
+        self.ctl_util = weakref.ref(ctl_util)
+
+    def new_desc_event(self, event):
+        """Forget the records of the routers with new descriptors."""
+        ctl_util = self.ctl_util()
+        if ctl_util != None:
+            ctl_util.invalidate_records(event.idlist)
+
+    def new_consensus_event(self, event):
+        """Forget all records and the recommended versions."""
+        ctl_util = self.ctl_util()
+        if ctl_util != None:
+            ctl_util.invalidate_records()
+            ctl_util.invalidate_versions()
+
+class CtlUtilPool:
+    """A process-wide pool of L{CtlUtil} objects, so that their control
+    connections are reused across consensus runs instead of being opened,
+    authenticated and torn down every time. Connections are checked with
+    L{CtlUtil.is_live} whenever they are handed out or returned, and dead
+    ones are replaced by fresh connections.
+
+    @type size: int
+    @ivar size: The largest number of CtlUtils in use at the same time.
+    @type _idle: list[L{CtlUtil}]
+    @ivar _idle: CtlUtils that aren't in use.
+    @type _lock: threading.Lock
+    @ivar _lock: Guards L{_idle}.
+    @type _slots: threading.Semaphore
+    @ivar _slots: Limits the number of CtlUtils in use to L{size}.
+    """
+
+    def __init__(self, size):
+        """Create an empty pool of at most C{size} CtlUtils."""
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(size)
+
+    def _discard(self, ctl_util):
+        """Close a CtlUtil that is no longer usable."""
+        logging.info('Discarding a dead Tor control connection.')
+        ctl_util.close()
+
+    def acquire(self):
+        """Get a live CtlUtil, reusing an idle one if possible and otherwise
+        connecting a new one. Blocks while L{size} CtlUtils are in use. Every
+        CtlUtil acquired must be passed to L{release}.
+
+        @rtype: L{CtlUtil}
+        @return: A CtlUtil with a live connection.
+        """
+        self._slots.acquire()
+        try:
+            while True:
+                self._lock.acquire()
+                try:
+                    if not self._idle:
+                        break
+                    ctl_util = self._idle.pop()
+                finally:
+                    self._lock.release()
+                if ctl_util.is_live():
+                    return ctl_util
+                self._discard(ctl_util)
+            return CtlUtil(synchronous = config.ctl_synchronous)
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, ctl_util):
+        """Return a CtlUtil obtained from L{acquire} to the pool. Its
+        snapshot is dropped, since it would be stale by the next use.
+
+        @type ctl_util: L{CtlUtil}
+        @param ctl_util: The CtlUtil to return.
+        """
+        try:
+            ctl_util.clear_snapshot()
+            if ctl_util.is_live():
+                self._lock.acquire()
+                try:
+                    self._idle.append(ctl_util)
+                finally:
+                    self._lock.release()
+            else:
+                self._discard(ctl_util)
+        finally:
+            self._slots.release()
+
+    def adopt(self, control):
+        """Add an existing, authenticated TorCtl connection to the pool, 
+        such as the listener's. It is never closed by the pool.
+
+        @type control: TorCtl Connection
+        @param control: The connection, which must have NEWDESC and 
+            NEWCONSENSUS events enabled. See L{CtlUtil}.
+        """
+        ctl_util = CtlUtil(control = control)
+        self._lock.acquire()
+        try:
+            self._idle.append(ctl_util)
+        finally:
+            self._lock.release()
+
+    def close_all(self):
+        """Close all idle connections."""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for ctl_util in idle:
+            ctl_util.close()
+
+pool = CtlUtilPool(config.ctl_pool_size)
@@ -279,7 +279,7 @@ def node_down_tuple(recipient, fingerprint, name, grace_pd, unsubs_auth,
     router = _get_router_name(fingerprint, name)
     subj = _SUBJECT_HEADER + _NODE_DOWN_SUBJ
     sender = _SENDER
-    num_hours = grace_pd + " hour"
+    num_hours = str(grace_pd) + " hour"
     if grace_pd > 1:
         num_hours += "s"
     unsubURL = url_helper.get_unsubscribe_url(unsubs_auth)
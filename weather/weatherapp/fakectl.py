@@ -0,0 +1,426 @@
+"""A stand-in for the Tor control port, so that TorCtl connections, L{CtlUtil}
+objects and the updaters can be exercised and timed without a running Tor. A
+L{FakeControlPort} answers C{GETINFO} requests from a consensus document, a
+descriptor document and a list of recommended versions, which are either
+recorded from a real Tor or made up by L{synthetic_documents} for any number
+of routers. It can send NEWCONSENSUS and NEWDESC events, or replay a recorded
+event stream, to the connections that asked for them, and can delay every
+reply to imitate a slow control port.
+
+@var FAKE_VERSION: The Tor version the fake control port reports.
+@var RECOMMENDED_VERSIONS: The recommended versions of the synthetic
+    documents.
+"""
+import socket
+import threading
+import time
+
+from TorCtl.TorUtil import escape_dots
+from weatherapp.ctlutil import ConsensusSnapshot
+
+FAKE_VERSION = '0.2.2.13-alpha (fake)'
+
+RECOMMENDED_VERSIONS = ['0.2.1.25', '0.2.1.26', '0.2.2.13-alpha']
+
+def synthetic_fingerprint(i):
+    """A made up, but well-formed, fingerprint for router C{i}."""
+    return '%040X' % (i * 2654435761)
+
+def synthetic_consensus(routers):
+    """Make up a consensus document with C{routers} routers, in the form
+    C{GETINFO ns/all} returns it in.
+
+    @type routers: int
+    @param routers: The number of routers.
+    @rtype: str
+    """
+    entries = []
+    for i in xrange(routers):
+        idhash = synthetic_fingerprint(i).decode('hex').encode('base64')[:-2]
+        entries.append('r router%d %s IpcU7dolas8+Q+oAzwgvZIWx7PA ' \
+                       '2010-08-01 12:00:00 10.%d.%d.%d 9001 9030\n' \
+                       's Fast Running Stable Valid\n' \
+                       'w Bandwidth=%d\n' % (i, idhash, i / 65536 % 256,
+                                             i / 256 % 256, i % 256, i))
+    return ''.join(entries)
+
+def synthetic_descriptors(routers):
+    """Make up a descriptor document for the routers of
+    L{synthetic_consensus}, in the form C{GETINFO desc/all-recent} returns it
+    in.
+
+    @type routers: int
+    @param routers: The number of routers.
+    @rtype: str
+    """
+    descs = []
+    for i in xrange(routers):
+        finger = synthetic_fingerprint(i)
+        descs.append('router router%d 10.%d.%d.%d 9001 0 9030\n' \
+                     'platform Tor %s on Linux i686\n' \
+                     'opt protocols Link 1 2 Circuit 1\n' \
+                     'published 2010-08-01 11:00:00\n' \
+                     'opt fingerprint %s\n' \
+                     'uptime %d\n' \
+                     'bandwidth 512000 5120000 %d\n' \
+                     'contact router%d at example dot com\n' \
+                     'reject 0.0.0.0/8:*\n' \
+                     'accept *:80\n' \
+                     'reject *:*\n' \
+                     'router-signature\n' \
+                     '-----BEGIN SIGNATURE-----\n' \
+                     'abc\n' \
+                     '-----END SIGNATURE-----\n' %
+                     (i, i / 65536 % 256, i / 256 % 256, i % 256,
+                      RECOMMENDED_VERSIONS[i % len(RECOMMENDED_VERSIONS)],
+                      ' '.join([finger[j:j+4] for j in range(0, 40, 4)]),
+                      i * 60, i * 100, i))
+    return ''.join(descs)
+
+def synthetic_documents(routers):
+    """Make up the documents for a L{FakeControlPort} with C{routers}
+    routers.
+
+    @type routers: int
+    @param routers: The number of routers.
+    @rtype: (str, str, list[str])
+    @return: The consensus, the descriptors and the recommended versions.
+    """
+    return (synthetic_consensus(routers), synthetic_descriptors(routers),
+            list(RECOMMENDED_VERSIONS))
+
+def data_reply(key, value):
+    """Format a C{GETINFO} reply with a single data block.
+
+    @type key: str
+    @param key: The key that was asked for.
+    @type value: str
+    @param value: The value, with '\\n' line endings.
+    @rtype: str
+    @return: The reply, as Tor sends it.
+    """
+    return '250+%s=\r\n%s250 OK\r\n' % (key, escape_dots(value))
+
+def split_events(stream):
+    """Split a recorded stream of events into single events.
+
+    @type stream: str
+    @param stream: The events, as Tor sent them.
+    @rtype: list[str]
+    @return: The events, each with its '\\r\\n' line endings.
+    """
+    events = []
+    current = []
+    in_data = False
+    for line in stream.replace('\r\n', '\n').split('\n'):
+        if not line and not in_data:
+            continue
+        current.append(line + '\r\n')
+        if in_data:
+            in_data = (line != '.')
+        elif line[3:4] == '+':
+            in_data = True
+        elif line[3:4] == ' ':
+            events.append(''.join(current))
+            current = []
+    return events
+
+class _Client:
+    """A connection to the fake control port.
+
+    @type sock: socket._socketobject
+    @ivar sock: The socket of the connection.
+    @type events: set
+    @ivar events: The event types the client asked for with C{SETEVENTS}.
+    """
+
+    def __init__(self, sock):
+        """Wrap the accepted socket C{sock}."""
+        self.sock = sock
+        self.events = set()
+        self._lock = threading.Lock()
+
+    def send(self, data):
+        """Send C{data}, without interleaving it with other threads' data."""
+        self._lock.acquire()
+        try:
+            self.sock.sendall(data)
+        finally:
+            self._lock.release()
+
+class FakeControlPort:
+    """A control port on localhost that serves recorded or synthetic
+    documents. Every connection is served by its own thread, and any
+    password is accepted.
+
+    @type consensus: str
+    @ivar consensus: The answer to C{GETINFO ns/all}.
+    @type descriptors: str
+    @ivar descriptors: The answer to C{GETINFO desc/all-recent}.
+    @type versions: list[str]
+    @ivar versions: The answer to C{GETINFO status/version/recommended}.
+    @type latency: float
+    @ivar latency: The number of seconds to wait before answering each
+        command.
+    @type host: str
+    @ivar host: The address the control port listens on.
+    @type port: int
+    @ivar port: The port the control port listens on.
+    @type commands: int
+    @ivar commands: The number of commands answered so far.
+    """
+
+    def __init__(self, consensus, descriptors, versions, latency = 0.0,
+                 host = '127.0.0.1', port = 0):
+        """Listen on C{host} and C{port}, or a free port if C{port} is 0,
+        and serve the given documents. Call L{start} to accept
+        connections."""
+        self.latency = latency
+        self.commands = 0
+        self._lock = threading.Lock()
+        self._clients = []
+        self._thread = None
+        self.set_documents(consensus, descriptors, versions)
+
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(5)
+        self.host, self.port = self._listener.getsockname()
+
+    def set_documents(self, consensus, descriptors, versions):
+        """Serve new documents from now on. Doesn't send any events; see
+        L{emit_newconsensus}.
+
+        @type consensus: str
+        @param consensus: The consensus document.
+        @type descriptors: str
+        @param descriptors: The descriptor document.
+        @type versions: list[str]
+        @param versions: The recommended versions.
+        """
+        snapshot = ConsensusSnapshot(consensus, descriptors)
+        self._lock.acquire()
+        try:
+            self.consensus = consensus
+            self.descriptors = descriptors
+            self.versions = versions
+            self._snapshot = snapshot
+        finally:
+            self._lock.release()
+
+    def start(self):
+        """Start accepting connections in a background thread.
+
+        @rtype: L{FakeControlPort}
+        @return: The control port itself.
+        """
+        self._thread = threading.Thread(target = self._accept,
+                                        name = 'FakeControlPort')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop listening and close every connection."""
+        try:
+            self._listener.close()
+        except socket.error:
+            pass
+        self._lock.acquire()
+        try:
+            clients = self._clients
+            self._clients = []
+        finally:
+            self._lock.release()
+        for client in clients:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR)
+                client.sock.close()
+            except socket.error:
+                pass
+
+    def connect(self):
+        """Open a socket to the control port.
+
+        @rtype: socket._socketobject
+        @return: A connected socket.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((self.host, self.port))
+        return sock
+
+    def _accept(self):
+        """Accept connections until L{stop} is called."""
+        while True:
+            try:
+                sock, address = self._listener.accept()
+            except socket.error:
+                return
+            client = _Client(sock)
+            self._lock.acquire()
+            try:
+                self._clients.append(client)
+            finally:
+                self._lock.release()
+            thread = threading.Thread(target = self._serve, args = (client,),
+                                      name = 'FakeControlPort-client')
+            thread.setDaemon(True)
+            thread.start()
+
+    def _serve(self, client):
+        """Answer the commands of C{client} until it disconnects."""
+        commands = client.sock.makefile('rb')
+        try:
+            try:
+                while True:
+                    line = commands.readline()
+                    if not line:
+                        break
+                    if self.latency:
+                        time.sleep(self.latency)
+                    reply = self._answer(client, line.strip())
+                    self.commands += 1
+                    client.send(reply)
+                    if reply.startswith('250 closing'):
+                        break
+            except socket.error:
+                pass
+        finally:
+            commands.close()
+            self._lock.acquire()
+            try:
+                if client in self._clients:
+                    self._clients.remove(client)
+            finally:
+                self._lock.release()
+            client.sock.close()
+
+    def _answer(self, client, command):
+        """Get the reply to a single-line command.
+
+        @type client: L{_Client}
+        @param client: The client that sent the command.
+        @type command: str
+        @param command: The command, without its line ending.
+        @rtype: str
+        @return: The reply.
+        """
+        parts = command.split(' ', 1)
+        verb = parts[0].upper()
+        args = parts[1:] and parts[1].split() or []
+        if verb == 'AUTHENTICATE':
+            return '250 OK\r\n'
+        elif verb == 'SETEVENTS':
+            client.events = set([arg.upper() for arg in args
+                                 if arg.upper() != 'EXTENDED'])
+            return '250 OK\r\n'
+        elif verb == 'GETINFO':
+            return self._getinfo(args)
+        elif verb == 'QUIT':
+            return '250 closing connection\r\n'
+        else:
+            return '510 Unrecognized command "%s"\r\n' % parts[0]
+
+    def _getinfo(self, keys):
+        """Get the reply to C{GETINFO} for C{keys}.
+
+        @type keys: list[str]
+        @param keys: The keys that were asked for.
+        @rtype: str
+        @return: The reply.
+        """
+        lines = []
+        for key in keys:
+            value = self._value(key)
+            if value == None:
+                return '552 Unrecognized key "%s"\r\n' % key
+            if '\n' in value:
+                lines.append('250+%s=\r\n%s' % (key, escape_dots(value)))
+            else:
+                lines.append('250-%s=%s\r\n' % (key, value))
+        lines.append('250 OK\r\n')
+        return ''.join(lines)
+
+    def _value(self, key):
+        """Get the value of C{key}, or C{None} if it isn't known."""
+        self._lock.acquire()
+        try:
+            snapshot = self._snapshot
+            if key == 'ns/all':
+                return self.consensus
+            elif key == 'desc/all-recent':
+                return self.descriptors
+            elif key == 'status/version/recommended':
+                return ','.join(self.versions)
+            elif key == 'version':
+                return FAKE_VERSION
+        finally:
+            self._lock.release()
+
+        if key.startswith('ns/id/'):
+            return snapshot.get_consensus(key[6:].lstrip('$')) or None
+        elif key.startswith('desc/id/'):
+            return snapshot.get_descriptor(key[8:].lstrip('$')) or None
+        return None
+
+    def emit(self, event):
+        """Send the event C{event} to every client that asked for its type.
+
+        @type event: str
+        @param event: The event, as Tor would send it.
+        @rtype: int
+        @return: The number of clients it was sent to.
+        """
+        evtype = event[4:].split(None, 1)[0].upper()
+        self._lock.acquire()
+        try:
+            clients = [client for client in self._clients
+                       if evtype in client.events]
+        finally:
+            self._lock.release()
+        sent = 0
+        for client in clients:
+            try:
+                client.send(event)
+                sent += 1
+            except socket.error:
+                pass
+        return sent
+
+    def emit_newconsensus(self):
+        """Send a NEWCONSENSUS event with the current consensus.
+
+        @rtype: int
+        @return: The number of clients it was sent to.
+        """
+        return self.emit('650+NEWCONSENSUS\r\n%s650 OK\r\n' %
+                         escape_dots(self.consensus))
+
+    def emit_newdesc(self, fingerprints):
+        """Send a NEWDESC event for the routers with C{fingerprints}.
+
+        @type fingerprints: list[str]
+        @param fingerprints: Fingerprints with no spaces.
+        @rtype: int
+        @return: The number of clients it was sent to.
+        """
+        return self.emit('650 NEWDESC %s\r\n' %
+                         ' '.join(['$' + finger for finger in fingerprints]))
+
+    def replay_events(self, stream, interval = 0.0):
+        """Send every event of a recorded event stream, in order.
+
+        @type stream: str
+        @param stream: The recorded events. See L{split_events}.
+        @type interval: float
+        @param interval: The number of seconds to wait between two events.
+        @rtype: int
+        @return: The number of events replayed.
+        """
+        events = split_events(stream)
+        for i, event in enumerate(events):
+            if i and interval:
+                time.sleep(interval)
+            self.emit(event)
+        return len(events)
@@ -6,7 +6,7 @@ import logging
 import socket
 
 from config import config
-from weatherapp import updaters
+from weatherapp import updaters, mailqueue, ctlutil
 from TorCtl import TorCtl
 
 #very basic log setup
@@ -37,11 +37,18 @@ def listen():
     ctrl_host = '127.0.0.1'
     ctrl_port = config.control_port
     sock.connect((ctrl_host, ctrl_port))
-    ctrl = TorCtl.Connection(sock)
+    ctrl = TorCtl.Connection(sock, config.event_queue_size)
     ctrl.launch_thread(daemon=0)
     ctrl.authenticate(config.authenticator)
     ctrl.set_event_handler(MyEventHandler())
-    ctrl.set_events([TorCtl.EVENT_TYPE.NEWCONSENSUS])
+    #NEWDESC keeps the descriptor caches of the pooled CtlUtil current
+    ctrl.set_events([TorCtl.EVENT_TYPE.NEWCONSENSUS,
+                     TorCtl.EVENT_TYPE.NEWDESC])
+    #let the updaters share this connection rather than open a new one
+    ctlutil.pool.adopt(ctrl)
+    #deliver queued emails, including any left by an earlier run
+    mailqueue.start_senders()
+    mailqueue.wake()
     print 'Listening for new consensus events.'
     logging.info('Listening for new consensus events.')
 
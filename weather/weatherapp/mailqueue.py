@@ -0,0 +1,241 @@
+"""A durable queue for outbound notification emails. The updaters add emails
+to the L{QueuedEmail} table as they produce them, inside the same transaction
+as the subscription changes that caused them, and a pool of background
+L{MailSender} threads, started by the listener, delivers them. Each sender
+reuses one SMTP connection per pass over the queue and retries failed emails,
+including all emails of a pass in which the server couldn't be reached, with
+exponential backoff.
+An email is claimed in the queue before it is sent, so that it is sent at 
+most once even if its row can't be removed afterwards, e.g. because the 
+database is locked by the updaters.
+Emails that still fail after L{config.mail_max_attempts<config.config>}
+attempts are marked as failed and logged.
+
+@var failed_email_file: A log file for emails that could not be delivered.
+@type _senders: list[L{MailSender}]
+@var _senders: The running sender threads.
+@type _senders_lock: threading.Lock
+@var _senders_lock: Guards starting the sender threads.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from config import config
+from weatherapp.models import QueuedEmail
+
+from django.core.mail import EmailMessage, get_connection
+from django.db import connection
+
+failed_email_file = 'log/failed_emails.txt'
+
+_senders = []
+_senders_lock = threading.Lock()
+
+def enqueue(email):
+    """Add an email to the queue.
+
+    @type email: tuple
+    @param email: A (subject, message, sender, recipient list) tuple, as
+        returned by the functions in the L{emails} module.
+    """
+    subject, message, sender, recipients = email
+    for recipient in recipients:
+        QueuedEmail(subject = subject, message = message, sender = sender,
+                    recipient = recipient).save()
+
+class EmailQueue:
+    """A list-like front to the queue, which can be passed to the updaters
+    in place of their list of email tuples. Every appended email is queued
+    immediately.
+
+    @type count: int
+    @ivar count: The number of emails queued through this object.
+    """
+
+    def __init__(self):
+        """Create an empty front to the queue."""
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def append(self, email):
+        """Queue an email.
+
+        @type email: tuple
+        @param email: An email tuple. See L{enqueue}.
+        """
+        enqueue(email)
+        self._lock.acquire()
+        try:
+            self.count += 1
+        finally:
+            self._lock.release()
+
+    def extend(self, emails):
+        """Queue several emails.
+
+        @type emails: list[tuple]
+        @param emails: A list of email tuples. See L{enqueue}.
+        """
+        for email in emails:
+            self.append(email)
+
+    def __len__(self):
+        """Returns the number of emails queued through this object."""
+        return self.count
+
+def _retry_delay(attempts):
+    """Get the time to wait before the next delivery attempt.
+
+    @type attempts: int
+    @param attempts: The number of failed attempts so far.
+    @rtype: timedelta
+    @return: The base delay doubled for every failed attempt, capped at a
+        day.
+    """
+    seconds = config.mail_retry_delay * (2 ** (attempts - 1))
+    return timedelta(seconds = min(seconds, 24 * 60 * 60))
+
+def _record_failure(email, error):
+    """Count a failed delivery attempt of C{email}, and give up on it once
+    it has failed too often.
+
+    @type email: L{QueuedEmail}
+    @param email: The email that couldn't be sent.
+    @type error: Exception
+    @param error: The exception raised while sending.
+    """
+    email.attempts += 1
+    if email.attempts >= config.mail_max_attempts:
+        email.failed = True
+        logging.info('Giving up on email to %s: %s' % (email.recipient,
+                                                         error))
+        failed = open(failed_email_file, 'a')
+        failed.write('%s\t%s\t%s\n' % (email.recipient, email.subject, error))
+        failed.close()
+    else:
+        email.next_attempt = datetime.now() + _retry_delay(email.attempts)
+    email.save()
+
+def drain(index = 0, count = 1, limit = 100):
+    """Send the queued emails that are due, over a single SMTP connection.
+
+    @type index: int
+    @param index: This sender's index. Only emails whose id is congruent to
+        C{index} modulo C{count} are sent, so that senders never share an
+        email.
+    @type count: int
+    @param count: The number of senders.
+    @type limit: int
+    @param limit: The largest number of emails to send in this pass.
+    @rtype: int
+    @return: The number of emails sent.
+    """
+    #Emails that were sent, but couldn't be removed from the queue then
+    QueuedEmail.objects.filter(sent = True).delete()
+
+    due = QueuedEmail.objects.filter(failed = False, sent = False,
+                                     next_attempt__lte = datetime.now())
+    due = [email for email in due.order_by('id')[:limit * count]
+           if email.id % count == index][:limit]
+    if not due:
+        return 0
+
+    sent = 0
+    smtp = get_connection(fail_silently = False)
+    try:
+        smtp.open()
+    except Exception, e:
+        #No email can be sent, so every one in the batch backs off
+        logging.error('Could not connect to the mail server: %s' % e)
+        for email in due:
+            _record_failure(email, e)
+        return 0
+
+    try:
+        for email in due:
+            try:
+                QueuedEmail.objects.filter(pk = email.pk).update(sent = True)
+            except Exception, e:
+                #Leave it for the next pass
+                logging.error('Could not claim email to %s: %s' % 
+                              (email.recipient, e))
+                continue
+
+            try:
+                EmailMessage(email.subject, email.message, email.sender,
+                             [email.recipient], connection = smtp).send()
+            except Exception, e:
+                #Saving the failure also releases the claim
+                try:
+                    _record_failure(email, e)
+                except Exception, e:
+                    logging.error('Could not record failed email to %s: %s'
+                                  % (email.recipient, e))
+                continue
+
+            sent += 1
+            try:
+                email.delete()
+            except Exception, e:
+                #It stays claimed, so it won't be sent again
+                logging.error('Sent email to %s, but could not remove it '
+                              'from the queue: %s' % (email.recipient, e))
+    finally:
+        smtp.close()
+    return sent
+
+class MailSender(threading.Thread):
+    """A daemon thread that repeatedly drains its share of the queue. It
+    wakes up every L{config.mail_poll_interval<config.config>} seconds, or
+    as soon as L{wake} is called.
+
+    @type index: int
+    @ivar index: This sender's index. See L{drain}.
+    @type count: int
+    @ivar count: The number of senders.
+    @type wakeup: threading.Event
+    @ivar wakeup: Set to make the sender drain the queue right away.
+    """
+
+    def __init__(self, index, count):
+        """Create sender C{index} of C{count}."""
+        threading.Thread.__init__(self, name = 'MailSender-%d' % index)
+        self.setDaemon(True)
+        self.index = index
+        self.count = count
+        self.wakeup = threading.Event()
+
+    def run(self):
+        """Drain the queue until the process exits."""
+        while True:
+            self.wakeup.wait(config.mail_poll_interval)
+            self.wakeup.clear()
+            try:
+                try:
+                    while drain(self.index, self.count) > 0:
+                        pass
+                except Exception, e:
+                    logging.error('Mail sender %d failed: %s' % (self.index,
+                                                                 e))
+            finally:
+                #Django opens one connection per thread
+                connection.close()
+
+def start_senders():
+    """Start the L{MailSender} threads, unless they are already running."""
+    _senders_lock.acquire()
+    try:
+        if not _senders:
+            for i in range(config.mail_senders):
+                sender = MailSender(i, config.mail_senders)
+                sender.start()
+                _senders.append(sender)
+    finally:
+        _senders_lock.release()
+
+def wake():
+    """Make the senders drain the queue now. Does nothing unless 
+    L{start_senders} was called, as the listener does."""
+    for sender in _senders:
+        sender.wakeup.set()
@@ -0,0 +1,278 @@
+"""A Django command module to run the Tor Weather micro-benchmarks using
+$ python manage.py benchmark [name ...]
+Without names, every benchmark is run. The benchmarks replay control port
+replies or talk to a L{FakeControlPort<weatherapp.fakectl.FakeControlPort>},
+so no Tor process is needed. The parser and routers benchmarks time the
+current parsers against the original ones in L{weatherapp.testutil}. The
+cycle benchmark runs the updaters against a temporary test database.
+
+@type BENCHMARKS: list[str]
+@var BENCHMARKS: The names of the available benchmarks.
+"""
+import sys
+import threading
+import time
+from optparse import make_option
+
+from config import config
+from weatherapp import ctlutil, fakectl, testutil, updaters
+from weatherapp.models import Router, Subscriber, NodeDownSub, BandwidthSub
+from TorCtl import TorCtl
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import setup_test_environment, \
+                              teardown_test_environment
+
+BENCHMARKS = ['parser', 'routers', 'cycle']
+
+def synthetic_ns_reply(routers):
+    """Build a C{GETINFO ns/all} reply for C{routers} made up routers."""
+    return fakectl.data_reply('ns/all', fakectl.synthetic_consensus(routers))
+
+def synthetic_desc_reply(routers):
+    """Build a C{GETINFO desc/all-recent} reply for C{routers} made up
+    routers."""
+    return fakectl.data_reply('desc/all-recent',
+                              fakectl.synthetic_descriptors(routers))
+
+def _best_time(function, iterations):
+    """Run C{function} C{iterations} times.
+
+    @rtype: (float, object)
+    @return: The fastest run in seconds and the result of the last run.
+    """
+    best = None
+    for i in xrange(iterations):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def bench_parser(replies, iterations, out):
+    """Time the legacy and current reply readers on each reply.
+
+    @type replies: list[(str, str)]
+    @param replies: (name, raw reply) pairs.
+    @type iterations: int
+    @param iterations: The number of runs to take the best time of.
+    @param out: The stream to write the results to.
+    """
+    for name, data in replies:
+        legacy_time, legacy = _best_time(lambda:
+            testutil.legacy_read_reply(testutil.LegacyBufSock(
+                testutil.ReplaySocket(data))),
+            iterations)
+        current_time, current = _best_time(lambda:
+            TorCtl.Connection(testutil.ReplaySocket(data))._read_reply(),
+            iterations)
+        out.write('parser %-20s %9d bytes  legacy %8.4fs  current %8.4fs  '
+                  '%5.1fx\n' % (name, len(data), legacy_time, current_time,
+                                legacy_time / max(current_time, 1e-9)))
+
+def bench_routers(consensus, descriptors, iterations, out):
+    """Time building TorCtl Routers from every descriptor with the legacy
+    and current Router.build_from_desc.
+
+    @type consensus: str
+    @param consensus: The consensus document with the routers' flags.
+    @type descriptors: str
+    @param descriptors: The descriptor document.
+    @type iterations: int
+    @param iterations: The number of runs to take the best time of.
+    @param out: The stream to write the results to.
+    """
+    nslist = dict([(ns.idhex, ns) for ns in TorCtl.parse_ns_body(consensus)])
+    pairs = []
+    for record in ctlutil.iter_descriptors(descriptors):
+        ns = nslist.get(record.fingerprint)
+        if ns != None:
+            pairs.append((descriptors[record.start:record.end].split('\n'),
+                          ns))
+
+    legacy_time, legacy = _best_time(lambda:
+        [testutil.legacy_build_from_desc(desc, ns) for desc, ns in pairs],
+        iterations)
+    current_time, current = _best_time(lambda:
+        [TorCtl.Router.build_from_desc(desc, ns) for desc, ns in pairs],
+        iterations)
+    out.write('routers %-19s %9d routers  legacy %8.4fs  current %8.4fs  '
+              '%5.1fx\n' % ('build_from_desc', len(pairs), legacy_time,
+                             current_time,
+                             legacy_time / max(current_time, 1e-9)))
+
+def _documents(options):
+    """Get the consensus, descriptors and recommended versions to run the
+    routers and cycle benchmarks on: the recorded documents, if given, and
+    otherwise synthetic ones."""
+    if options['consensus'] or options['descriptors']:
+        if not (options['consensus'] and options['descriptors']):
+            raise CommandError('--consensus and --descriptors go together')
+        return (open(options['consensus']).read(),
+                open(options['descriptors']).read(),
+                fakectl.RECOMMENDED_VERSIONS)
+    return fakectl.synthetic_documents(options['routers'])
+
+class _CycleHandler(TorCtl.EventHandler):
+    """Runs the updaters for every NEWCONSENSUS event, like the listener
+    does, and signals when each run has finished.
+
+    @type finished: threading.Event
+    @ivar finished: Set when a run has finished.
+    @type error: Exception
+    @ivar error: The exception the last run raised, if any.
+    """
+
+    def __init__(self):
+        """Create a handler that hasn't seen any runs."""
+        TorCtl.EventHandler.__init__(self)
+        self.finished = threading.Event()
+        self.error = None
+
+    def new_consensus_event(self, event):
+        """Run the updaters and signal L{finished}."""
+        try:
+            try:
+                updaters.run_all()
+            except Exception, e:
+                self.error = e
+        finally:
+            self.finished.set()
+
+def _add_subscribers(count):
+    """Subscribe C{count} confirmed subscribers to node down and low
+    bandwidth notifications, one for each of the first synthetic routers.
+
+    @type count: int
+    @param count: The number of subscribers.
+    """
+    for i in xrange(count):
+        router = Router(fingerprint = fakectl.synthetic_fingerprint(i),
+                        name = 'router%d' % i)
+        router.save()
+        subscriber = Subscriber(email = 'sub%d@example.com' % i,
+                                router = router, confirmed = True)
+        subscriber.save()
+        NodeDownSub(subscriber = subscriber, grace_pd = 1).save()
+        BandwidthSub(subscriber = subscriber, threshold = 20).save()
+
+def bench_cycle(server, cycles, out):
+    """Time full consensus cycles against C{server}. Each cycle starts with
+    a NEWCONSENSUS event and ends when L{updaters.run_all} has updated the
+    routers and checked the subscriptions. The first cycle sees every router
+    for the first time; the following ones see an unchanged consensus.
+
+    @type server: L{FakeControlPort<weatherapp.fakectl.FakeControlPort>}
+    @param server: The running control port to use.
+    @type cycles: int
+    @param cycles: The number of cycles.
+    @param out: The stream to write the results to.
+    """
+    ctrl = TorCtl.Connection(server.connect(), config.event_queue_size)
+    ctrl.authenticate(config.authenticator)
+    handler = _CycleHandler()
+    ctrl.set_event_handler(handler)
+    ctrl.set_events([TorCtl.EVENT_TYPE.NEWCONSENSUS,
+                     TorCtl.EVENT_TYPE.NEWDESC])
+    ctlutil.pool.adopt(ctrl)
+    try:
+        for i in xrange(cycles):
+            handler.finished.clear()
+            commands = server.commands
+            start = time.time()
+            if not server.emit_newconsensus():
+                raise CommandError('The control connection is closed')
+            handler.finished.wait()
+            elapsed = time.time() - start
+            if handler.error != None:
+                raise CommandError('Cycle failed: %s' % handler.error)
+            out.write('cycle  %-4s %9d routers  %6d commands  %8.4fs\n' %
+                      (i == 0 and 'cold' or 'warm', 
+                       Router.objects.count(), server.commands - commands,
+                       elapsed))
+    finally:
+        ctlutil.pool.close_all()
+        ctrl.close()
+
+def _run_cycles(documents, options, out):
+    """Run the cycle benchmark on a temporary test database, so that the
+    real one is never touched."""
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity = 0, autoclobber = True)
+    consensus, descriptors, versions = documents
+    server = fakectl.FakeControlPort(consensus, descriptors, versions,
+                                     latency = options['latency']).start()
+    try:
+        _add_subscribers(min(options['subscribers'], options['routers']))
+        bench_cycle(server, options['cycles'], out)
+    finally:
+        server.stop()
+        connection.creation.destroy_test_db(old_name, verbosity = 0)
+        teardown_test_environment()
+
+class Command(BaseCommand):
+    """Represents a Django manage.py command to run the micro-benchmarks.
+
+    @type help: str
+    @cvar help: Help text for the command"""
+
+    help = 'Run the Tor Weather micro-benchmarks: ' + ', '.join(BENCHMARKS)
+    args = '[name ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--reply', action = 'append', dest = 'replies',
+                    default = [], help = 'A file with a recorded control '
+                    'port reply, such as the reply to GETINFO ns/all. Can '
+                    'be given more than once. Replaces the synthetic '
+                    'replies.'),
+        make_option('--routers', type = 'int', dest = 'routers',
+                    default = 6000, help = 'The number of routers in the '
+                    'synthetic replies and documents.'),
+        make_option('--iterations', type = 'int', dest = 'iterations',
+                    default = 5, help = 'The number of runs to take the '
+                    'best time of.'),
+        make_option('--consensus', dest = 'consensus', default = None,
+                    help = 'A file with a recorded consensus document for '
+                    'the routers and cycle benchmarks. Needs '
+                    '--descriptors.'),
+        make_option('--descriptors', dest = 'descriptors', default = None,
+                    help = 'A file with a recorded descriptor document for '
+                    'the routers and cycle benchmarks. Needs '
+                    '--consensus.'),
+        make_option('--latency', type = 'float', dest = 'latency',
+                    default = 0.0, help = 'The number of seconds the fake '
+                    'control port waits before each reply.'),
+        make_option('--cycles', type = 'int', dest = 'cycles', default = 3,
+                    help = 'The number of consensus cycles to time.'),
+        make_option('--subscribers', type = 'int', dest = 'subscribers',
+                    default = 1000, help = 'The number of subscribers in '
+                    'the cycle benchmark.'),
+    )
+
+    def handle(self, *args, **options):
+        """Called when benchmark is called from the command line. Runs the
+        named benchmarks."""
+        names = args or BENCHMARKS
+        for name in names:
+            if name not in BENCHMARKS:
+                raise CommandError('Unknown benchmark: %s' % name)
+
+        replies = []
+        for path in options['replies']:
+            replies.append((path, open(path, 'rb').read()))
+        if not replies:
+            replies = [('ns/all', synthetic_ns_reply(options['routers'])),
+                       ('desc/all-recent',
+                        synthetic_desc_reply(options['routers']))]
+
+        if 'parser' in names:
+            bench_parser(replies, options['iterations'], sys.stdout)
+        if 'routers' in names or 'cycle' in names:
+            documents = _documents(options)
+        if 'routers' in names:
+            bench_routers(documents[0], documents[1], options['iterations'],
+                          sys.stdout)
+        if 'cycle' in names:
+            _run_cycles(documents, options, sys.stdout)
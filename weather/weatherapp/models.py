@@ -4,18 +4,23 @@ module contains three models that correspond to the three main database tables
 (L{Router}, L{Subscriber}, and L{Subscription}), as well as four subclasses of
 L{Subscription} for the various subscription types and three classes for forms
 (L{GenericForm}, L{SubscribeForm}, and L{PreferencesForm}), which specify and do
-the work of the forms displayed on the sign-up and preferences pages.
+the work of the forms displayed on the sign-up and preferences pages. The
+L{TriggerDeadline} table indexes the times at which triggered subscriptions
+are next due to be checked, and the L{QueuedEmail} table is the spool of
+outbound notification emails.
 
 @group Helper Functions: insert_fingerprint_spaces, get_rand_string,
     hours_since
 @group Models: Router, Subscriber, Subscription
 @group Subscription Subclasses: NodeDownSub, VersionSub, BandwidthSub, 
     TShirtSub
+@group Deadlines: TriggerDeadline, TriggerDeadlineManager
+@group Mail Queue: QueuedEmail
 @group Forms: GenericForm, SubscribeForm, PreferencesForm
 @group Custom Fields: PrefixedIntegerField
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import base64
 import os
 import re
@@ -219,6 +224,24 @@ class Subscriber(models.Model):
             default=_DEFAULTS['pref_auth'])
     sub_date = models.DateTimeField(default=_DEFAULTS['sub_date'])
 
+    def save(self, *args, **kwargs):
+        """Save this L{Subscriber}. If it is confirmed, its subscriptions
+        are marked due, so that the updaters check them in their next run."""
+        super(Subscriber, self).save(*args, **kwargs)
+        if self.confirmed:
+            TriggerDeadline.objects.mark_due(TriggerDeadline.NODE_DOWN,
+                NodeDownSub.objects.filter(subscriber=self).values_list(
+                                                            'pk', flat=True))
+            TriggerDeadline.objects.mark_due(TriggerDeadline.VERSION,
+                VersionSub.objects.filter(subscriber=self).values_list(
+                                                            'pk', flat=True))
+            TriggerDeadline.objects.mark_due(TriggerDeadline.BANDWIDTH,
+                BandwidthSub.objects.filter(subscriber=self).values_list(
+                                                            'pk', flat=True))
+            TriggerDeadline.objects.mark_due(TriggerDeadline.T_SHIRT,
+                TShirtSub.objects.filter(subscriber=self).values_list(
+                                                            'pk', flat=True))
+
     def __unicode__(self):
         """Returns a simple description of this L{Subscriber}, namely
         its L{email}.
@@ -452,6 +475,15 @@ class NodeDownSub(Subscription):
     triggered= models.BooleanField(default=_DEFAULTS['triggered'])
     grace_pd = models.IntegerField(default=None, blank=False)
     last_changed = models.DateTimeField(default=_DEFAULTS['last_changed'])
+
+    def save(self, *args, **kwargs):
+        """Save this L{NodeDownSub}, and mark it due if its subscriber is
+        confirmed, so that the updaters check it with its new preferences 
+        in their next run."""
+        super(NodeDownSub, self).save(*args, **kwargs)
+        if self.subscriber.confirmed:
+            TriggerDeadline.objects.mark_due(TriggerDeadline.NODE_DOWN, 
+                                             [self.pk])
     
     def is_grace_passed(self):
         """Check if the C{subscriber}'s C{router} has been offline for 
@@ -463,11 +495,25 @@ class NodeDownSub(Subscription):
         """
 
         if self.triggered \
-                and hours_since(self.last_changed) >= grace_pd:
+                and hours_since(self.last_changed) >= self.grace_pd:
             return True
         else:
             return False
 
+    def get_deadline(self):
+        """Get the time at which the grace period of this subscription ends,
+        if it is triggered and no email has been sent yet.
+
+        @rtype: datetime
+        @return: The end of the grace period, or C{None} if there is nothing
+            pending.
+        """
+
+        if self.triggered and not self.emailed:
+            return self.last_changed + timedelta(hours=self.grace_pd)
+        else:
+            return None
+
 class VersionSub(Subscription):
     """Model for version update notification subscriptions, which send 
     notifications to their C{subscriber} if the C{subscriber}'s C{router} is
@@ -495,6 +541,15 @@ class VersionSub(Subscription):
     notify_type = models.CharField(max_length=_NOTIFY_TYPE_MAX_LEN,
             default=None, blank=False)
 
+    def save(self, *args, **kwargs):
+        """Save this L{VersionSub}, and mark it due if its subscriber is
+        confirmed, so that the updaters check it with its new notification
+        type in their next run."""
+        super(VersionSub, self).save(*args, **kwargs)
+        if self.subscriber.confirmed:
+            TriggerDeadline.objects.mark_due(TriggerDeadline.VERSION, 
+                                             [self.pk])
+
 class BandwidthSub(Subscription):   
     """Model for low bandwidth notification subscriptions, which send
     notifications to their C{subscriber} if the C{subscriber}'s C{router} has
@@ -523,6 +578,15 @@ class BandwidthSub(Subscription):
     _DEFAULTS = { 'threshold': 20 }
 
     threshold = models.IntegerField(_DEFAULTS['threshold'])
+
+    def save(self, *args, **kwargs):
+        """Save this L{BandwidthSub}, and mark it due if its subscriber is
+        confirmed, so that the updaters check it with its new threshold in
+        their next run."""
+        super(BandwidthSub, self).save(*args, **kwargs)
+        if self.subscriber.confirmed:
+            TriggerDeadline.objects.mark_due(TriggerDeadline.BANDWIDTH, 
+                                             [self.pk])
     
 class TShirtSub(Subscription):
     """Model for t-shirt notification subscriptions, which send notifications 
@@ -554,15 +618,39 @@ class TShirtSub(Subscription):
     @ivar last_changed: The datetime at which the L{triggered} flag was last
         changed. Default is the current time, evaluated with a call to
         datetime.now.
+    @type last_hours: IntegerField (int)
+    @ivar last_hours: The number of hours the router had been up when 
+        L{avg_bandwidth} was last updated, or C{None} if it hasn't been 
+        since the router came up. Default is C{None}.
+    @type last_bandwidth: IntegerField (int)
+    @ivar last_bandwidth: The router's bandwidth in kB/s when 
+        L{avg_bandwidth} was last updated, or C{None} if it hasn't been since
+        the router came up. The updaters use it for the hours in which the
+        router didn't change and the subscription wasn't checked. Default is
+        C{None}.
     """
     
     _DEFAULTS = { 'triggered': False,
                   'avg_bandwidth': 0,
-                  'last_changed': datetime.now }
+                  'last_changed': datetime.now,
+                  'last_hours': None,
+                  'last_bandwidth': None }
 
     triggered = models.BooleanField(default=_DEFAULTS['triggered'])
     avg_bandwidth = models.IntegerField(default=_DEFAULTS['avg_bandwidth'])
     last_changed = models.DateTimeField(default=_DEFAULTS['last_changed'])
+    last_hours = models.IntegerField(default=_DEFAULTS['last_hours'],
+                                     null=True, blank=True)
+    last_bandwidth = models.IntegerField(default=_DEFAULTS['last_bandwidth'],
+                                         null=True, blank=True)
+
+    def save(self, *args, **kwargs):
+        """Save this L{TShirtSub}, and mark it due if its subscriber is
+        confirmed, so that the updaters check it in their next run."""
+        super(TShirtSub, self).save(*args, **kwargs)
+        if self.subscriber.confirmed:
+            TriggerDeadline.objects.mark_due(TriggerDeadline.T_SHIRT, 
+                                             [self.pk])
 
     def get_hours_since_triggered(self):
         """Get the number of hours that the L{router<Subscriber.router>} has
@@ -578,6 +666,20 @@ class TShirtSub(Subscription):
         else:
             return hours_since(self.last_changed)
         
+    def get_threshold(self):
+        """Get the average bandwidth the L{router<Subscriber.router>} needs
+        to earn a t-shirt: 100 kB/s for an exit node, 500 kB/s for a 
+        non-exit node.
+
+        @rtype: int
+        @return: The bandwidth threshold in kB/s.
+        """
+
+        if self.subscriber.router.exit:
+            return 100
+        else:
+            return 500
+
     def should_email(self):
         """Determines if the L{subscriber<Subscription.subscriber>} has earned a
         t-shirt by running its L{router<Subscriber.router>}. Determines this by
@@ -594,14 +696,24 @@ class TShirtSub(Subscription):
         hours_up = self.get_hours_since_triggered()
         
         if not self.emailed and self.triggered and hours_up >= 1464:
-            if self.subscriber.router.exit:
-                if self.avg_bandwidth >= 100:
-                    return True
-            else:
-                if self.avg_bandwidth >= 500:
-                    return True
+            if self.avg_bandwidth >= self.get_threshold():
+                return True
         return False
 
+    def get_deadline(self):
+        """Get the time at which the L{router<Subscriber.router>} will have
+        been up for 1464 hours, if it is up and no email has been sent yet.
+
+        @rtype: datetime
+        @return: The time the router will have been up for 1464 hours, or
+            C{None} if there is nothing pending.
+        """
+
+        if self.triggered and not self.emailed:
+            return self.last_changed + timedelta(hours=1464)
+        else:
+            return None
+
 
 # CUSTOM FIELDS ---------------------------------------------------------------
 # -----------------------------------------------------------------------------
@@ -1383,3 +1495,197 @@ class DeployedDatetime(models.Model):
 
         return self.deployed
 
+class TriggerDeadlineManager(models.Manager):
+    """Manager for L{TriggerDeadline}, which treats the table as a queue of
+    subscriptions ordered by the time they are due."""
+
+    def due_subscriptions(self, kind, now):
+        """Get the subscriptions of type C{kind} whose deadline has passed.
+
+        @type kind: str
+        @param kind: The L{kind<TriggerDeadline.kind>} of deadline.
+        @type now: datetime
+        @param now: The current time.
+        @rtype: set
+        @return: The primary keys of the due subscriptions.
+        """
+        return set(self.filter(kind=kind, due__lte=now).values_list(
+                                                'subscription', flat=True))
+
+    def mark_due(self, kind, pks, now=None):
+        """Make subscriptions due right away, so that the updaters check 
+        them in their next run even if their router didn't change.
+
+        @type kind: str
+        @param kind: The L{kind<TriggerDeadline.kind>} of deadline.
+        @type pks: list[int]
+        @param pks: The primary keys of the subscriptions.
+        @type now: datetime
+        @param now: The due time. Default value is the current time.
+        """
+        if now == None:
+            now = datetime.now()
+        for pk in pks:
+            if not self.filter(subscription=pk).update(kind=kind, due=now):
+                self.create(subscription_id=pk, kind=kind, due=now)
+
+    def sync(self, kind, deadlines):
+        """Bring the deadlines of type C{kind} in line with C{deadlines},
+        writing only the ones that changed.
+
+        @type kind: str
+        @param kind: The L{kind<TriggerDeadline.kind>} of deadline.
+        @type deadlines: dict {int: datetime}
+        @param deadlines: Maps subscription primary keys to their new
+            deadline, or to C{None} if they have no pending deadline.
+            Subscriptions that aren't in C{deadlines} keep their deadline.
+        """
+        #updaters imports this module, so it can't be imported at the top
+        from weatherapp.updaters import _batches
+
+        #only the rows of the given subscriptions are read
+        existing = {}
+        for batch in _batches(deadlines.keys()):
+            existing.update(self.filter(kind=kind, 
+                subscription__in=batch).values_list('subscription', 'due'))
+        moved = {}
+        removed = []
+
+        for pk, due in deadlines.items():
+            if due == None:
+                if pk in existing:
+                    removed.append(pk)
+            elif not pk in existing:
+                self.create(subscription_id=pk, kind=kind, due=due)
+            elif existing[pk] != due:
+                moved.setdefault(due, []).append(pk)
+
+        for due, pks in moved.items():
+            for batch in _batches(pks):
+                self.filter(kind=kind, subscription__in=batch).update(due=due)
+        for batch in _batches(removed):
+            self.filter(kind=kind, subscription__in=batch).delete()
+
+class TriggerDeadline(models.Model):
+    """The time at which a triggered subscription next needs attention: the
+    end of a L{NodeDownSub}'s grace period or the time a L{TShirtSub}'s 
+    router will have been up long enough to earn a t-shirt (after that, the
+    time its average bandwidth can have reached the threshold). The updaters
+    read the due rows from this table, indexed by time, instead of 
+    computing the deadline of every triggered subscription on every run.
+    Subscriptions that are created or edited, and those of newly confirmed
+    subscribers, are made due right away. L{VersionSub}s and 
+    L{BandwidthSub}s have no deadlines of their own, so their rows only 
+    exist until that first check.
+
+    @type NODE_DOWN: str
+    @cvar NODE_DOWN: The L{kind} of L{NodeDownSub} grace period deadlines.
+    @type VERSION: str
+    @cvar VERSION: The L{kind} of new or edited L{VersionSub}s.
+    @type BANDWIDTH: str
+    @cvar BANDWIDTH: The L{kind} of new or edited L{BandwidthSub}s.
+    @type T_SHIRT: str
+    @cvar T_SHIRT: The L{kind} of L{TShirtSub} uptime deadlines.
+    @type _KIND_MAX_LEN: int
+    @cvar _KIND_MAX_LEN: Maximum length for L{kind} fields.
+
+    @type subscription: L{Subscription}
+    @ivar subscription: The subscription that is due. Required constructor
+        argument.
+    @type kind: CharField (str)
+    @ivar kind: One of L{NODE_DOWN}, L{VERSION}, L{BANDWIDTH} and 
+        L{T_SHIRT}. Required constructor argument.
+    @type due: DateTimeField (datetime)
+    @ivar due: The time at which the subscription is due. Required
+        constructor argument.
+    """
+
+    NODE_DOWN = 'NODE_DOWN'
+    VERSION = 'VERSION'
+    BANDWIDTH = 'BANDWIDTH'
+    T_SHIRT = 'T_SHIRT'
+    _KIND_MAX_LEN = 9
+
+    subscription = models.ForeignKey(Subscription, unique=True)
+    kind = models.CharField(max_length=_KIND_MAX_LEN)
+    due = models.DateTimeField(db_index=True)
+
+    objects = TriggerDeadlineManager()
+
+    def __unicode__(self):
+        """Returns a unicode representation of the deadline.
+
+        @rtype: unicode
+        @return: The kind and due time of the deadline.
+        """
+
+        return u'%s %s' % (self.kind, self.due)
+
+class QueuedEmail(models.Model):
+    """An email waiting to be sent by the L{mailqueue<weatherapp.mailqueue>}
+    senders. Rows are deleted once their email has been delivered.
+
+    @type _SUBJECT_MAX_LEN: int
+    @cvar _SUBJECT_MAX_LEN: Maximum length for L{subject} fields.
+    @type _EMAIL_MAX_LEN: int
+    @cvar _EMAIL_MAX_LEN: Maximum length for L{sender} and L{recipient}
+        fields.
+    @type _DEFAULTS: dict {str: various}
+    @cvar _DEFAULTS: Dictionary mapping field names to their default
+        parameters. These are the values that fields will be instantiated
+        with if they are not specified in the model's construction.
+
+    @type subject: CharField (str)
+    @ivar subject: The subject line. Required constructor argument.
+    @type message: TextField (str)
+    @ivar message: The email body. Required constructor argument.
+    @type sender: EmailField (str)
+    @ivar sender: The sender's address. Required constructor argument.
+    @type recipient: EmailField (str)
+    @ivar recipient: The recipient's address. Required constructor argument.
+    @type created: DateTimeField (datetime)
+    @ivar created: When the email was queued. Default value is the current
+        time, evaluated with a call to C{datetime.now}.
+    @type attempts: IntegerField (int)
+    @ivar attempts: The number of failed delivery attempts. Default value 
+        is 0.
+    @type next_attempt: DateTimeField (datetime)
+    @ivar next_attempt: The earliest time of the next delivery attempt.
+        Default value is the current time, evaluated with a call to
+        C{datetime.now}.
+    @type failed: BooleanField (bool)
+    @ivar failed: Whether the senders gave up on this email. Default value is
+        C{False}.
+    @type sent: BooleanField (bool)
+    @ivar sent: Whether a sender has claimed this email to send it. Emails
+        are claimed before they are sent, so an email whose row can't be
+        deleted afterwards is never sent again. Default value is C{False}.
+    """
+
+    _SUBJECT_MAX_LEN = 200
+    _EMAIL_MAX_LEN = 75
+    _DEFAULTS = { 'created': datetime.now,
+                  'attempts': 0,
+                  'next_attempt': datetime.now,
+                  'failed': False,
+                  'sent': False }
+
+    subject = models.CharField(max_length=_SUBJECT_MAX_LEN)
+    message = models.TextField()
+    sender = models.EmailField(max_length=_EMAIL_MAX_LEN)
+    recipient = models.EmailField(max_length=_EMAIL_MAX_LEN)
+    created = models.DateTimeField(default=_DEFAULTS['created'])
+    attempts = models.IntegerField(default=_DEFAULTS['attempts'])
+    next_attempt = models.DateTimeField(default=_DEFAULTS['next_attempt'],
+                                        db_index=True)
+    failed = models.BooleanField(default=_DEFAULTS['failed'])
+    sent = models.BooleanField(default=_DEFAULTS['sent'])
+
+    def __unicode__(self):
+        """Returns the recipient and subject of this email.
+
+        @rtype: unicode
+        @return: A simple description of the email.
+        """
+
+        return u'%s: %s' % (self.recipient, self.subject)
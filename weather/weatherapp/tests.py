@@ -2,18 +2,53 @@
 The test module. To run tests, cd to weather and run 'python manage.py
 test weatherapp'.
 """
+import copy
+import os
+import pickle
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
 import time
 from datetime import datetime, timedelta
 
 from models import Subscriber, Subscription, Router, NodeDownSub, TShirtSub, \
-                   VersionSub, BandwidthSub
+                   VersionSub, BandwidthSub, TriggerDeadline, QueuedEmail
 import emails
-from ctlutil import CtlUtil
+from ctlutil import CtlUtil, ConsensusSnapshot, VersionClassifier, \
+                    iter_descriptors
+from weatherapp import updaters, mailqueue, fakectl, testutil, ctlutil
+from TorCtl import TorCtl, TorUtil, AsyncSupport
 
-from django.test import TestCase
+from django.conf import settings
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import DatabaseError
+from django.db.models.signals import post_init
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
 from django.core import mail
 
+#A consensus document and descriptor document with a single router, moria1
+_MORIA_FINGERPRINT = '9695DFC35FFEB861329B9F1AB04C46397020CE31'
+_CONSENSUS = 'r moria1 lpXfw1/+uGEym58asExGOXAgzjE IpcU7dolas8+Q+oAzwgvZIWx7PA ' + \
+             '2010-08-01 12:00:00 128.31.0.34 9101 9131\n' + \
+             's Authority Fast Running Stable V2Dir Valid\n' + \
+             'w Bandwidth=20\n'
+_DESCRIPTOR = 'router moria1 128.31.0.34 9101 0 9131\n' + \
+              'platform Tor 0.2.2.13-alpha on Linux i686\n' + \
+              'opt fingerprint 9695 DFC3 5FFE B861 329B 9F1A B04C 4639 ' + \
+              '7020 CE31\n' + \
+              'uptime 1200\n' + \
+              'bandwidth 512000 5120000 40960\n' + \
+              'contact 1024D/28988BF5 arma mit edu\n' + \
+              'reject *:*\n' + \
+              'router-signature\n' + \
+              '-----BEGIN SIGNATURE-----\n' + \
+              'abc\n' + \
+              '-----END SIGNATURE-----\n'
+
 class TestWeb(TestCase):
     """Tests the Tor Weather application via post requests"""
 
@@ -453,5 +488,1315 @@ class TestNotifications(TestCase):
         shirt_sub.last_changed = shirt_sub.last_changed + timedelta(hours=1)
         self.assertEqual(shirt_sub.should_email(), False)
 
-                               
-                                   
+class TestConsensusSnapshot(TestCase):
+    """Test the fingerprint-indexed consensus/descriptor snapshot"""
+
+    def setUp(self):
+        """Build a snapshot from the moria1 documents"""
+        self.snapshot = ConsensusSnapshot(_CONSENSUS, _DESCRIPTOR)
+
+    def test_consensus_lookup(self):
+        """Consensus entries should be found by hex fingerprint"""
+        self.assertEqual(self.snapshot.get_consensus(_MORIA_FINGERPRINT),
+                         _CONSENSUS)
+        self.assertEqual(self.snapshot.get_consensus('1234'), '')
+
+    def test_descriptor_lookup(self):
+        """Descriptors should be found by fingerprint and keep their 
+        signature delimiter"""
+        self.assertEqual(self.snapshot.get_descriptor(_MORIA_FINGERPRINT),
+                         _DESCRIPTOR)
+        self.assertEqual(self.snapshot.get_descriptor('1234'), '')
+
+    def test_changed_since(self):
+        """Only routers whose relevant state differs should be reported as
+        changed"""
+        self.assertEqual(self.snapshot.changed_since(None), None)
+        digests = self.snapshot.digests()
+        self.assertEqual(self.snapshot.changed_since(digests), set())
+
+        #a new signature doesn't matter, a new bandwidth does
+        resigned = ConsensusSnapshot(_CONSENSUS, 
+                                     _DESCRIPTOR.replace('abc', 'def'))
+        self.assertEqual(resigned.changed_since(digests), set())
+        slower = ConsensusSnapshot(_CONSENSUS, 
+                                   _DESCRIPTOR.replace('40960', '20480'))
+        self.assertEqual(slower.changed_since(digests), 
+                         set([_MORIA_FINGERPRINT]))
+
+        #routers that disappear have changed too
+        empty = ConsensusSnapshot('', '')
+        self.assertEqual(empty.changed_since(digests), 
+                         set([_MORIA_FINGERPRINT]))
+
+    def test_descriptor_records(self):
+        """The streaming parser should yield one record per signed 
+        descriptor with the fields Weather uses"""
+        records = list(iter_descriptors(_DESCRIPTOR * 2 + 'router unsigned'))
+        self.assertEqual(len(records), 2)
+        record = records[1]
+        self.assertEqual(record.fingerprint, _MORIA_FINGERPRINT)
+        self.assertEqual(record.nickname, 'moria1')
+        self.assertEqual(record.bandwidth, 40960)
+        self.assertEqual(record.platform, 'Tor 0.2.2.13-alpha on Linux i686')
+        self.assertEqual(record.contact, 'contact 1024D/28988BF5 arma mit edu')
+        self.assertEqual(record.hibernating, False)
+        self.assertEqual(record.exit, False)
+        self.assertEqual((_DESCRIPTOR * 2)[record.start:record.end] + '\n',
+                         _DESCRIPTOR)
+
+class TestVersionClassifier(TestCase):
+    """Test classifying router versions against the recommended versions"""
+
+    def test_classify(self):
+        """The latest stable and newer versions are recommended, older 
+        listed versions unrecommended, and unlisted versions obsolete"""
+        classifier = VersionClassifier(['0.2.1.25', '0.2.1.26', 
+                                        '0.2.2.13-alpha', '0.2.2.14-alpha'])
+        self.assertEqual(classifier.stable, ['0.2.1.25', '0.2.1.26'])
+        self.assertEqual(classifier.classify('0.2.1.25'), 'UNRECOMMENDED')
+        self.assertEqual(classifier.classify('0.2.1.26'), 'RECOMMENDED')
+        self.assertEqual(classifier.classify('0.2.2.14-alpha'), 'RECOMMENDED')
+        self.assertEqual(classifier.classify('0.2.0.35'), 'OBSOLETE')
+        self.assertEqual(classifier.classify(''), 'ERROR')
+        self.assertEqual(classifier.classify_platform(
+                         'Tor 0.2.1.26 on Linux i686'), 'RECOMMENDED')
+
+    def test_no_unstable(self):
+        """Without unstable versions only the latest version is 
+        recommended"""
+        classifier = VersionClassifier(['0.2.1.25', '0.2.1.26'])
+        self.assertEqual(classifier.classify('0.2.1.25'), 'UNRECOMMENDED')
+        self.assertEqual(classifier.classify('0.2.1.26'), 'RECOMMENDED')
+
+class _StubCtlUtil:
+    """Stands in for L{CtlUtil} in the t-shirt checker. Every router has the
+    same bandwidth, and looking up a bandwidth fails once C{calls} lookups
+    have been made."""
+
+    def __init__(self, calls):
+        """Allow C{calls} bandwidth lookups."""
+        self.calls = calls
+
+    def get_bandwidth(self, fingerprint):
+        """Return 100 kB/s, or fail if no lookups are left."""
+        if self.calls == 0:
+            raise RuntimeError('Lost the control connection')
+        self.calls -= 1
+        return 100
+
+    def get_new_avg_bandwidth(self, avg_bandwidth, hours_up, obs_bandwidth):
+        """Average like L{CtlUtil.get_new_avg_bandwidth}."""
+        return int(round(float(hours_up * avg_bandwidth + obs_bandwidth) / 
+                         (hours_up + 1)))
+
+class _RouterCtlUtil(_StubCtlUtil):
+    """Stands in for L{CtlUtil} in the router updater and the t-shirt 
+    checker, for a set of up, non-exit routers with settable bandwidths.
+
+    @type bandwidths: dict {str: int}
+    @ivar bandwidths: Maps the fingerprint of every router to its bandwidth
+        in kB/s.
+    """
+
+    def __init__(self, fingerprints):
+        """Serve the routers with C{fingerprints}, with no bandwidth yet."""
+        self.bandwidths = dict([(fingerprint, 0) 
+                                for fingerprint in fingerprints])
+
+    def get_finger_name_list(self):
+        """Return the fingerprint and name of every router."""
+        return [(fingerprint, 'up') for fingerprint in self.bandwidths]
+
+    def is_up_or_hibernating(self, fingerprint):
+        return True
+
+    def is_exit(self, fingerprint):
+        return False
+
+    def is_stable(self, fingerprint):
+        return False
+
+    def get_bandwidth(self, fingerprint):
+        """Return the router's current bandwidth."""
+        return self.bandwidths[fingerprint]
+
+    def get_version_type(self, fingerprint):
+        return 'RECOMMENDED'
+
+class TestCheckers(TestCase):
+    """Test the subscription checkers in the updaters module"""
+
+    def setUp(self):
+        """Create a down router with a confirmed node down subscriber"""
+        self.router = Router(name='myrouter', fingerprint='1234', up=False)
+        self.router.save()
+        self.subscriber = Subscriber(email='name@place.com', 
+                                     router=self.router, confirmed=True)
+        self.subscriber.save()
+        self.sub = NodeDownSub(subscriber=self.subscriber, grace_pd=1)
+        self.sub.save()
+
+    def test_node_down(self):
+        """A down router should trigger the subscription first, and only
+        send an email once the grace period has passed"""
+        email_list = updaters.check_node_down([])
+        self.assertEqual(len(email_list), 0)
+        sub = NodeDownSub.objects.get(pk=self.sub.pk)
+        self.assertEqual(sub.triggered, True)
+        self.assertEqual(sub.emailed, False)
+
+        #the end of the grace period should be queued
+        deadline = TriggerDeadline.objects.get(subscription=self.sub.pk)
+        self.assertEqual(deadline.kind, TriggerDeadline.NODE_DOWN)
+        self.assertEqual(deadline.due, sub.last_changed + timedelta(hours=1))
+
+        #move the trigger time back past the grace period
+        then = datetime.now() - timedelta(hours=2)
+        NodeDownSub.objects.filter(pk=self.sub.pk).update(last_changed=then)
+        TriggerDeadline.objects.filter(subscription=self.sub.pk).update(
+                                                due=then + timedelta(hours=1))
+        email_list = updaters.check_node_down([], updaters._RunState())
+        self.assertEqual(len(email_list), 1)
+        self.assertEqual(NodeDownSub.objects.get(pk=self.sub.pk).emailed, True)
+        self.assertEqual(TriggerDeadline.objects.count(), 0)
+
+        #the router coming back up should reset the subscription
+        Router.objects.filter(pk=self.router.pk).update(up=True)
+        email_list = updaters.check_node_down([])
+        self.assertEqual(len(email_list), 0)
+        sub = NodeDownSub.objects.get(pk=self.sub.pk)
+        self.assertEqual(sub.triggered, False)
+        self.assertEqual(sub.emailed, False)
+
+    def test_unconfirmed(self):
+        """Subscriptions of unconfirmed subscribers should not be touched"""
+        Subscriber.objects.filter(pk=self.subscriber.pk).update(
+                                                            confirmed=False)
+        updaters.check_node_down([])
+        self.assertEqual(NodeDownSub.objects.get(pk=self.sub.pk).triggered,
+                         False)
+
+    def test_only_due_subs_loaded(self):
+        """A run should only load the subscriptions that are due or follow
+        a router that changed"""
+        router = Router(name='other', fingerprint='5678', up=True)
+        router.save()
+        subscriber = Subscriber(email='other@place.com', router=router,
+                                confirmed=True)
+        subscriber.save()
+        other = NodeDownSub(subscriber=subscriber, grace_pd=1)
+        other.save()
+        #new subscriptions are due right away
+        self.assertEqual(TriggerDeadline.objects.filter(
+                         due__lte=datetime.now()).count(), 2)
+        updaters.check_node_down([])
+
+        loaded = []
+        def count(sender, instance, **kwargs):
+            loaded.append(instance.pk)
+        post_init.connect(count, sender=NodeDownSub)
+        try:
+            state = updaters._RunState()
+            state.changed = set()
+            updaters.check_node_down([], state)
+            self.assertEqual(loaded, [])
+
+            #the end of the grace period
+            TriggerDeadline.objects.filter(subscription=self.sub.pk).update(
+                                    due=datetime.now() - timedelta(hours=1))
+            updaters.check_node_down([], state)
+            self.assertEqual(loaded, [self.sub.pk])
+
+            #a changed router
+            del loaded[:]
+            state.changed = set(['5678'])
+            updaters.check_node_down([], state)
+            self.assertEqual(loaded, [other.pk])
+
+            #edited preferences
+            state.changed = set()
+            other.grace_pd = 2
+            other.save()
+            del loaded[:]
+            updaters.check_node_down([], state)
+            self.assertEqual(loaded, [other.pk])
+        finally:
+            post_init.disconnect(count, sender=NodeDownSub)
+
+    def test_only_changed_bandwidth_subs_loaded(self):
+        """The bandwidth checker should only load new or edited 
+        subscriptions and those following a router that changed"""
+        router = Router(name='other', fingerprint='5678', up=True)
+        router.save()
+        subscriber = Subscriber(email='other@place.com', router=router,
+                                confirmed=True)
+        subscriber.save()
+        subs = [BandwidthSub(subscriber=self.subscriber, threshold=20),
+                BandwidthSub(subscriber=subscriber, threshold=20)]
+        for sub in subs:
+            sub.save()
+        ctl_util = _RouterCtlUtil(['1234', '5678'])
+
+        loaded = []
+        def count(sender, instance, **kwargs):
+            loaded.append(instance.pk)
+        post_init.connect(count, sender=BandwidthSub)
+        try:
+            state = updaters._RunState()
+            state.changed = set()
+            #new subscriptions
+            email_list = updaters.check_low_bandwidth(ctl_util, [], state)
+            self.assertEqual(sorted(loaded), sorted([sub.pk for sub in subs]))
+            self.assertEqual(len(email_list), 2)
+            self.assertEqual(TriggerDeadline.objects.filter(
+                             kind=TriggerDeadline.BANDWIDTH).count(), 0)
+
+            del loaded[:]
+            updaters.check_low_bandwidth(ctl_util, [], state)
+            self.assertEqual(loaded, [])
+
+            #a changed router
+            state.changed = set(['5678'])
+            updaters.check_low_bandwidth(ctl_util, [], state)
+            self.assertEqual(loaded, [subs[1].pk])
+
+            #an edited threshold
+            state.changed = set()
+            subs[0].threshold = 30
+            subs[0].save()
+            del loaded[:]
+            updaters.check_low_bandwidth(ctl_util, [], state)
+            self.assertEqual(loaded, [subs[0].pk])
+        finally:
+            post_init.disconnect(count, sender=BandwidthSub)
+
+    def test_only_changed_version_subs_loaded(self):
+        """The version checker should only load new or edited subscriptions
+        and those following a router that changed, unless the recommended
+        versions changed"""
+        sub = VersionSub(subscriber=self.subscriber, notify_type='OBSOLETE')
+        sub.save()
+        ctl_util = _RouterCtlUtil(['1234'])
+
+        loaded = []
+        def count(sender, instance, **kwargs):
+            loaded.append(instance.pk)
+        post_init.connect(count, sender=VersionSub)
+        try:
+            state = updaters._RunState()
+            state.changed = set()
+            state.versions_changed = False
+            updaters.check_version(ctl_util, [], state)
+            self.assertEqual(loaded, [sub.pk])
+            self.assertEqual(TriggerDeadline.objects.filter(
+                             kind=TriggerDeadline.VERSION).count(), 0)
+
+            del loaded[:]
+            updaters.check_version(ctl_util, [], state)
+            self.assertEqual(loaded, [])
+
+            #a changed router
+            state.changed = set(['1234'])
+            updaters.check_version(ctl_util, [], state)
+            self.assertEqual(loaded, [sub.pk])
+
+            #new recommended versions
+            state.changed = set()
+            state.versions_changed = True
+            del loaded[:]
+            updaters.check_version(ctl_util, [], state)
+            self.assertEqual(loaded, [sub.pk])
+
+            #an edited notification type
+            state.versions_changed = False
+            sub.notify_type = 'UNRECOMMENDED'
+            sub.save()
+            del loaded[:]
+            updaters.check_version(ctl_util, [], state)
+            self.assertEqual(loaded, [sub.pk])
+        finally:
+            post_init.disconnect(count, sender=VersionSub)
+
+    def test_sync_deadlines(self):
+        """Syncing should only touch the deadlines it is given"""
+        pks = [self.sub.pk]
+        for fingerprint in ('5678', '9ABC', 'DEF0'):
+            router = Router(name='other', fingerprint=fingerprint)
+            router.save()
+            subscriber = Subscriber(email='other@place.com', router=router,
+                                    confirmed=True)
+            subscriber.save()
+            sub = NodeDownSub(subscriber=subscriber, grace_pd=1)
+            sub.save()
+            pks.append(sub.pk)
+        TriggerDeadline.objects.filter(subscription=pks[3]).delete()
+        now = datetime.now()
+
+        later = now + timedelta(hours=2)
+        TriggerDeadline.objects.sync(TriggerDeadline.NODE_DOWN, 
+                                     {pks[0]: later, pks[1]: None,
+                                      pks[3]: later})
+        deadlines = dict(TriggerDeadline.objects.values_list('subscription',
+                                                             'due'))
+        self.assertEqual(deadlines[pks[0]], later)
+        self.assertFalse(pks[1] in deadlines)
+        self.assertTrue(deadlines[pks[2]] <= now)
+        self.assertEqual(deadlines[pks[3]], later)
+
+    def test_tshirt_deadline_after_failed_check(self):
+        """A t-shirt subscription that has been up long enough but whose 
+        average is too low should only be due again when the average can
+        have reached the threshold"""
+        Router.objects.filter(pk=self.router.pk).update(up=True)
+        then = datetime.now() - timedelta(hours=1500, minutes=1)
+        sub = TShirtSub(subscriber=self.subscriber, triggered=True,
+                        avg_bandwidth=400, last_changed=then, 
+                        last_hours=1499, last_bandwidth=400)
+        sub.save()
+        ctl_util = _RouterCtlUtil(['1234'])
+
+        #the bandwidth is below the threshold, so the average never gets there
+        ctl_util.bandwidths['1234'] = 450
+        updaters.check_earn_tshirt(ctl_util, [])
+        self.assertEqual(TriggerDeadline.objects.filter(
+                         subscription=sub.pk).count(), 0)
+
+        #the average catches up with a high bandwidth within a few hours
+        ctl_util.bandwidths['1234'] = 5000
+        updaters.check_earn_tshirt(ctl_util, [])
+        sub = TShirtSub.objects.get(pk=sub.pk)
+        self.assertEqual(sub.emailed, False)
+        avg = sub.avg_bandwidth
+        hours = 1500
+        while avg < 500:
+            hours += 1
+            avg = ctl_util.get_new_avg_bandwidth(avg, hours, 5000)
+        deadline = TriggerDeadline.objects.get(subscription=sub.pk)
+        self.assertEqual(deadline.due, then + timedelta(hours=hours))
+        self.assertTrue(deadline.due > datetime.now())
+
+    def test_failed_run_keeps_marks(self):
+        """A run that fails partway should leave the t-shirt marks of the
+        last completed run unchanged"""
+        then = datetime.now() - timedelta(hours=5)
+        for fingerprint in ('5678', '9ABC'):
+            router = Router(name='up', fingerprint=fingerprint, up=True)
+            router.save()
+            subscriber = Subscriber(email='up@place.com', router=router,
+                                    confirmed=True)
+            subscriber.save()
+            TShirtSub(subscriber=subscriber, triggered=True, 
+                      avg_bandwidth=50, last_changed=then).save()
+
+        updaters.check_earn_tshirt(_StubCtlUtil(2), [])
+        marks = list(TShirtSub.objects.order_by('pk').values_list(
+                     'avg_bandwidth', 'last_hours', 'last_bandwidth'))
+        self.assertEqual(marks, [(58, 5, 100), (58, 5, 100)])
+
+        #an hour later, the run fails after updating the first subscription
+        TShirtSub.objects.update(last_changed=then - timedelta(hours=1))
+        self.assertRaises(RuntimeError, updaters.check_earn_tshirt,
+                          _StubCtlUtil(1), [])
+        self.assertEqual(list(TShirtSub.objects.order_by('pk').values_list(
+                         'avg_bandwidth', 'last_hours', 'last_bandwidth')),
+                         marks)
+
+    def test_catch_up_matches_hourly(self):
+        """A t-shirt subscription that is only checked when its router
+        changes should get the same average as one checked every hour, even
+        if the listener restarts in between"""
+        bandwidths = [120, 120, 120, 400, 400, 400, 400, 400, 90, 90, 90, 90,
+                      90, 700]
+        #the first router changes every hour, the second only when its
+        #bandwidth changes
+        ctl_util = _RouterCtlUtil(['5678', '9ABC'])
+        subs = []
+        for fingerprint in ctl_util.bandwidths:
+            router = Router(name='up', fingerprint=fingerprint, up=True)
+            router.save()
+            subscriber = Subscriber(email='up@place.com', router=router,
+                                    confirmed=True)
+            subscriber.save()
+            sub = TShirtSub(subscriber=subscriber)
+            sub.save()
+            subs.append(sub.pk)
+
+        for hour, bandwidth in enumerate(bandwidths):
+            changed = set(['5678'])
+            if hour == 0 or bandwidth != bandwidths[hour - 1]:
+                changed.add('9ABC')
+            for fingerprint in ctl_util.bandwidths:
+                ctl_util.bandwidths[fingerprint] = bandwidth
+            updaters.update_all_routers(ctl_util, [], changed)
+
+            #every run starts without memory of the previous ones
+            state = updaters._RunState()
+            state.changed = changed
+            updaters.check_earn_tshirt(ctl_util, [], state)
+
+            #an hour passes
+            for sub in TShirtSub.objects.all():
+                TShirtSub.objects.filter(pk=sub.pk).update(
+                    last_changed=sub.last_changed - timedelta(hours=1))
+
+        expected = bandwidths[0]
+        for hour in range(1, len(bandwidths)):
+            expected = ctl_util.get_new_avg_bandwidth(expected, hour,
+                                                      bandwidths[hour])
+        hourly = TShirtSub.objects.get(pk=subs[0])
+        skipped = TShirtSub.objects.get(pk=subs[1])
+        self.assertEqual(hourly.avg_bandwidth, expected)
+        self.assertEqual(skipped.avg_bandwidth, expected)
+        self.assertEqual(skipped.last_hours, len(bandwidths) - 1)
+
+class TestParallelCheck(TransactionTestCase):
+    """Test checking the subscriptions on several threads. The data is
+    committed, since every thread has its own database connection."""
+
+    def _subscribe(self, count):
+        """Create C{count} routers with fingerprints spread over the whole
+        range, each followed by a confirmed bandwidth subscriber, and
+        return a CtlUtil stand-in where every other router has too little
+        bandwidth."""
+        fingerprints = ['%04X' % (i * 0xFFFF / (count - 1)) + '0' * 36
+                        for i in range(count)]
+        ctl_util = _RouterCtlUtil(fingerprints)
+        for i, fingerprint in enumerate(fingerprints):
+            router = Router(name='router%d' % i, fingerprint=fingerprint,
+                            up=True)
+            router.save()
+            subscriber = Subscriber(email='sub%d@place.com' % i,
+                                    router=router, confirmed=True)
+            subscriber.save()
+            BandwidthSub(subscriber=subscriber, threshold=20).save()
+            ctl_util.bandwidths[fingerprint] = 10 + 20 * (i % 2)
+        return ctl_util
+
+    def _check(self, workers):
+        """Check 40 new subscriptions on C{workers} threads, and return
+        the subjects and recipients of the emails."""
+        ctl_util = self._subscribe(40)
+        email_list = updaters.check_all_subs_parallel(ctl_util, [], None,
+                                                      workers)
+        self.assertEqual(BandwidthSub.objects.filter(emailed=True).count(),
+                         20)
+        for model in (Subscription, Subscriber, Router, TriggerDeadline):
+            model.objects.all().delete()
+        return sorted([(subject, recipients) for subject, body, sender,
+                       recipients in email_list])
+
+    def test_fingerprint_ranges(self):
+        """Every fingerprint should be in exactly one range"""
+        fingerprints = ['0' * 40, 'F' * 40, '8000' + '0' * 36,
+                        '7FFF' + 'F' * 36, '5555' + '0' * 36]
+        rand = random.Random(6)
+        fingerprints += ['%040X' % rand.getrandbits(160) for i in range(100)]
+        for count in (1, 2, 3, 4, 7, 16):
+            ranges = updaters._fingerprint_ranges(count)
+            self.assertEqual(len(ranges), count)
+            self.assertEqual(ranges[0][0], None)
+            self.assertEqual(ranges[-1][1], None)
+            for fingerprint in fingerprints:
+                matches = [(low, high) for low, high in ranges
+                           if (low == None or fingerprint >= low) and
+                              (high == None or fingerprint < high)]
+                self.assertEqual(len(matches), 1)
+
+    def test_same_emails(self):
+        """Several workers should send the same emails as one"""
+        expected = self._check(1)
+        self.assertEqual(len(expected), 20)
+        self.assertEqual(self._check(4), expected)
+        self.assertEqual(self._check(7), expected)
+
+class _UnreachableBackend(BaseEmailBackend):
+    """An email backend for a mail server that can't be reached."""
+
+    def open(self):
+        """Fail to connect."""
+        raise socket.error('Connection refused')
+
+    def send_messages(self, email_messages):
+        """Fail to connect."""
+        self.open()
+
+class TestMailQueue(TestCase):
+    """Test queueing emails and delivering them from the queue"""
+
+    def test_drain(self):
+        """Queued emails should be sent once and then removed from the queue"""
+        queue = mailqueue.EmailQueue()
+        queue.append(('Subject', 'Message', 'from@place.com',
+                      ['to@place.com']))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(QueuedEmail.objects.count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(mailqueue.drain(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['to@place.com'])
+        self.assertEqual(QueuedEmail.objects.count(), 0)
+        self.assertEqual(mailqueue.drain(), 0)
+
+    def test_unreachable_server(self):
+        """If the mail server can't be reached, every email in the pass 
+        should be retried later"""
+        queue = mailqueue.EmailQueue()
+        for recipient in ('one@place.com', 'two@place.com'):
+            queue.append(('Subject', 'Message', 'from@place.com', 
+                          [recipient]))
+
+        backend = settings.EMAIL_BACKEND
+        settings.EMAIL_BACKEND = 'weatherapp.tests._UnreachableBackend'
+        try:
+            self.assertEqual(mailqueue.drain(), 0)
+        finally:
+            settings.EMAIL_BACKEND = backend
+
+        now = datetime.now()
+        for email in QueuedEmail.objects.all():
+            self.assertEqual(email.attempts, 1)
+            self.assertEqual(email.failed, False)
+            self.assertTrue(email.next_attempt > now)
+        #nothing is due until the retry delay has passed
+        self.assertEqual(mailqueue.drain(), 0)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_delete_fails(self):
+        """An email whose row can't be deleted after it was sent should not
+        be sent again"""
+        queue = mailqueue.EmailQueue()
+        for recipient in ('one@place.com', 'two@place.com'):
+            queue.append(('Subject', 'Message', 'from@place.com', 
+                          [recipient]))
+
+        delete = QueuedEmail.delete
+        def locked(self, *args, **kwargs):
+            raise DatabaseError('database is locked')
+        QueuedEmail.delete = locked
+        try:
+            self.assertEqual(mailqueue.drain(), 2)
+        finally:
+            QueuedEmail.delete = delete
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(QueuedEmail.objects.filter(sent=True).count(), 2)
+
+        #the next pass removes them without sending them again
+        self.assertEqual(mailqueue.drain(), 0)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(QueuedEmail.objects.count(), 0)
+
+class TestFakeControlPort(TestCase):
+    """Test CtlUtil and the updaters against the fake control port"""
+
+    def setUp(self):
+        """Serve the moria1 documents"""
+        self.server = fakectl.FakeControlPort(_CONSENSUS, _DESCRIPTOR,
+                                              ['0.2.2.13-alpha']).start()
+        self.ctl_util = CtlUtil(control_port = self.server.port, 
+                                synchronous = True)
+
+    def tearDown(self):
+        """Close the connection and stop the server"""
+        self.ctl_util.close()
+        self.server.stop()
+
+    def test_getinfo(self):
+        """Single and full documents should be served as Tor would"""
+        self.assertEqual(self.ctl_util.get_single_consensus(
+                         _MORIA_FINGERPRINT), _CONSENSUS)
+        self.assertEqual(self.ctl_util.get_single_consensus('1234'), '')
+        self.assertEqual(self.ctl_util.get_full_descriptor(), _DESCRIPTOR)
+        self.assertEqual(self.ctl_util.get_rec_version_list(), 
+                         ['0.2.2.13-alpha'])
+        self.assertEqual(self.ctl_util.get_record(
+                         _MORIA_FINGERPRINT).nickname, 'moria1')
+
+    def test_newdesc(self):
+        """A NEWDESC event should invalidate the cached record"""
+        self.ctl_util.get_record(_MORIA_FINGERPRINT)
+        self.server.set_documents(_CONSENSUS, 
+                                  _DESCRIPTOR.replace('40960', '20480'),
+                                  ['0.2.2.13-alpha'])
+        self.assertEqual(self.server.emit_newdesc([_MORIA_FINGERPRINT]), 1)
+        self.ctl_util.control.poll_events(5.0)
+        self.assertEqual(self.ctl_util.get_record(
+                         _MORIA_FINGERPRINT).bandwidth, 20480)
+
+    def test_update_all_routers(self):
+        """The routers of the served consensus should be added"""
+        self.ctl_util.load_snapshot()
+        updaters.update_all_routers(self.ctl_util, [])
+        router = Router.objects.get(fingerprint = _MORIA_FINGERPRINT)
+        self.assertEqual(router.name, 'moria1')
+        self.assertEqual(router.up, True)
+
+class _BandwidthRecorder(TorCtl.EventHandler):
+    """Records BW events, and whether a command sent from the handler could
+    be waited on."""
+
+    def __init__(self):
+        TorCtl.EventHandler.__init__(self)
+        self.bandwidth = []
+        self.refused = 0
+
+    def bandwidth_event(self, event):
+        self.bandwidth.append((event.read, event.written))
+        try:
+            self.c.get_info('version').result()
+        except TorCtl.TorCtlError:
+            self.refused += 1
+
+class TestAsyncSupport(TestCase):
+    """Test the incremental reply parser and AsyncConnection over a
+    socket pair"""
+
+    def setUp(self):
+        """Connect an AsyncConnection to a socket acting as Tor"""
+        self.tor, sock = socket.socketpair()
+        self.map = {}
+        self.conn = AsyncSupport.AsyncConnection(sock, self.map)
+
+    def tearDown(self):
+        """Close both ends"""
+        self.conn.close()
+        self.tor.close()
+
+    def _flush(self):
+        """Run the loop until the commands are sent and return them"""
+        while self.conn.writable():
+            self.conn.poll(0.1)
+        return self.tor.recv(65536)
+
+    def test_split_block(self):
+        """A "+" block fed a byte at a time should parse like it does in
+        one piece"""
+        data = '250+ns/all=\r\nr a\r\n..dot\r\n.x\r\n.\r\n250 OK\r\n' + \
+               '650+NS\r\nr b\r\n.\r\n'
+        expected = [(False, [('250', 'ns/all=', 'r a\n.dot\nx\n'),
+                             ('250', 'OK', None)]),
+                    (True, [('650', 'NS', 'r b\n')])]
+        self.assertEqual(AsyncSupport.ReplyParser().feed(data), expected)
+        parser = AsyncSupport.ReplyParser()
+        replies = []
+        for c in data:
+            replies.extend(parser.feed(c))
+        self.assertEqual(replies, expected)
+
+    def test_events_between_replies(self):
+        """Events should go to the handler and replies to their commands,
+        in order"""
+        handler = _BandwidthRecorder()
+        self.conn.set_event_handler(handler)
+        version = self.conn.get_info('version')
+        setevents = self.conn.set_events(['BW'])
+        self.assertEqual(self._flush(),
+                         'GETINFO version\r\nSETEVENTS BW\r\n')
+        self.tor.sendall('650 BW 1 2\r\n250-version=0.2.2.13-alpha\r\n' +
+                         '250 OK\r\n650 BW 3 4\r\n250 OK\r\n')
+        self.assertEqual(version.result(5), {'version': '0.2.2.13-alpha'})
+        self.assertEqual(setevents.result(5), [('250', 'OK', None)])
+        self.assertEqual(handler.bandwidth, [(1, 2), (3, 4)])
+        #the handler can't block on its own commands
+        self.assertEqual(handler.refused, 2)
+
+    def test_close_pending(self):
+        """Commands pending when Tor closes the connection should fail"""
+        version = self.conn.get_info('version')
+        setevents = self.conn.set_events(['BW'])
+        self._flush()
+        self.tor.sendall('250-version=0.2.2.13-alpha\r\n')
+        self.tor.close()
+        self.assertRaises(TorCtl.TorCtlClosed, version.result, 5)
+        self.assertRaises(TorCtl.TorCtlClosed, setevents.result, 5)
+        self.assertFalse(self.conn.is_live())
+        self.assertRaises(TorCtl.TorCtlClosed, self.conn.sendAndRecv,
+                          'GETINFO version\r\n')
+
+    def test_sync_handler_refused(self):
+        """Handlers that need synchronous replies should be refused"""
+        self.assertRaises(TorCtl.TorCtlError, TorCtl.ConsensusTracker,
+                          self.conn)
+        self.assertEqual(self.conn._handler, None)
+
+class TestEventQueue(TestCase):
+    """Test coalescing and dropping in TorCtl's bounded event queue"""
+
+    def _consensus(self, i):
+        """A NEWCONSENSUS event carrying i as its data"""
+        return (i, [('650', 'NEWCONSENSUS', str(i)), ('650', 'OK', None)])
+
+    def test_bound_holds(self):
+        """Protected events should be dropped rather than growing the queue
+        past its size"""
+        queue = TorCtl.EventQueue(3)
+        for i in xrange(20):
+            queue.put(self._consensus(i))
+            queue.put((i, i)) #timer event
+            self.assertTrue(queue.qsize() <= 3)
+        queue.put((20, 'CLOSE'))
+        self.assertTrue(queue.qsize() <= 3)
+        items = []
+        while queue.qsize():
+            items.append(queue.get(False))
+        #the latest consensus and the close message survive
+        self.assertEqual(items[0], self._consensus(19))
+        self.assertEqual(items[-1], (20, 'CLOSE'))
+        stats = queue.stats()
+        self.assertEqual(stats['peak'], 3)
+        self.assertEqual(stats['merged'], 19)
+        self.assertEqual(stats['dropped'] + stats['merged'] + len(items), 41)
+
+    def test_drops_unprotected_first(self):
+        """Ordinary events should be dropped before timer events"""
+        queue = TorCtl.EventQueue(2)
+        queue.put((0, 0))
+        queue.put((1, [('650', 'BW 1 2', None)]))
+        queue.put((2, [('650', 'BW 3 4', None)]))
+        self.assertEqual(queue.get(False), (0, 0))
+        self.assertEqual(queue.get(False), (2, [('650', 'BW 3 4', None)]))
+        self.assertEqual(queue.stats()['dropped'], 1)
+
+class TestCtlUtilPool(TestCase):
+    """Test the pool of CtlUtils against a fake control port"""
+
+    def setUp(self):
+        """Serve the moria1 documents, and make the pool connect to them"""
+        self.server = fakectl.FakeControlPort(_CONSENSUS, _DESCRIPTOR,
+                                              ['0.2.2.13-alpha']).start()
+        self.ctl_util_class = ctlutil.CtlUtil
+        def connect(**kwargs):
+            kwargs.setdefault('control_port', self.server.port)
+            return self.ctl_util_class(**kwargs)
+        ctlutil.CtlUtil = connect
+
+    def tearDown(self):
+        """Restore CtlUtil and stop the server"""
+        ctlutil.CtlUtil = self.ctl_util_class
+        self.server.stop()
+
+    def test_reuse(self):
+        """A released CtlUtil should be handed out again"""
+        pool = ctlutil.CtlUtilPool(2)
+        ctl_util = pool.acquire()
+        pool.release(ctl_util)
+        self.assertTrue(pool.acquire() is ctl_util)
+        pool.release(ctl_util)
+        pool.close_all()
+
+    def test_discard_dead(self):
+        """Dead CtlUtils should be closed instead of reused"""
+        pool = ctlutil.CtlUtilPool(2)
+        ctl_util = pool.acquire()
+        ctl_util.control.close()
+        pool.release(ctl_util)
+        other = pool.acquire()
+        self.assertFalse(other is ctl_util)
+        self.assertTrue(other.is_live())
+
+        idle = pool.acquire()
+        pool.release(idle)
+        idle.control.close()
+        self.assertFalse(pool.acquire() is idle)
+        pool.close_all()
+
+    def test_size(self):
+        """No more than ctl_pool_size CtlUtils should be in use"""
+        pool = ctlutil.CtlUtilPool(1)
+        ctl_util = pool.acquire()
+        acquired = []
+        thread = threading.Thread(target = lambda:
+                                  acquired.append(pool.acquire()))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.isAlive())
+        self.assertEqual(acquired, [])
+        pool.release(ctl_util)
+        thread.join(5.0)
+        self.assertEqual(acquired, [ctl_util])
+        pool.release(ctl_util)
+        pool.close_all()
+
+    def test_close_all(self):
+        """close_all should close every idle CtlUtil but adopted ones"""
+        pool = ctlutil.CtlUtilPool(2)
+        ctl_utils = [pool.acquire(), pool.acquire()]
+        for ctl_util in ctl_utils:
+            pool.release(ctl_util)
+        control = TorCtl.Connection(self.server.connect())
+        control.launch_thread()
+        control.authenticate()
+        pool.adopt(control)
+        pool.close_all()
+        for ctl_util in ctl_utils:
+            self.assertFalse(ctl_util.is_live())
+        self.assertTrue(control.is_live())
+        control.close()
+        ctl_util = pool.acquire()
+        self.assertFalse(ctl_util in ctl_utils)
+        pool.release(ctl_util)
+        pool.close_all()
+
+class TestReadReply(TestCase):
+    """Test the buffered reply reader against the original one"""
+
+    def setUp(self):
+        """Make up a few documents with escaped dots and terminators"""
+        self.consensus = fakectl.synthetic_consensus(20) + _CONSENSUS
+        self.descriptors = fakectl.synthetic_descriptors(20)
+        self.replies = (fakectl.data_reply('ns/all', self.consensus) +
+                        '650+NS\r\n' + _CONSENSUS.replace('\n', '\r\n') +
+                        '.\r\n650 OK\r\n' +
+                        fakectl.data_reply('desc/all-recent',
+                                           self.descriptors) +
+                        '250+config-text=\r\n..dotted\r\n..\r\n.\r\n' +
+                        '250 OK\r\n' +
+                        '650 BW 1 2\r\n' +
+                        '552 Unrecognized key "x"\r\n')
+
+    def test_read_reply(self):
+        """Replies should read the same however the data is split"""
+        legacy = testutil.LegacyBufSock(testutil.ReplaySocket(self.replies))
+        expected = []
+        for i in xrange(7):
+            expected.append(testutil.legacy_read_reply(legacy))
+        self.assertEqual(expected[1][1][0][2], _CONSENSUS)
+        for chunk in (1, 2, 5, 7, 64, 65536):
+            conn = TorCtl.Connection(testutil.ReplaySocket(self.replies,
+                                                            chunk))
+            for reply in expected:
+                self.assertEqual(conn._read_reply(), reply)
+
+    def test_closed(self):
+        """A reply cut off by the connection closing should raise"""
+        for data in ('', '250-version=0.2.2.13-alpha\r\n',
+                     '250+config-text=\r\nline\r\n'):
+            conn = TorCtl.Connection(testutil.ReplaySocket(data, 5))
+            self.assertRaises(TorCtl.TorCtlClosed, conn._read_reply)
+
+class TestPipelining(TestCase):
+    """Test pipelined commands on TorCtl connections"""
+
+    def test_pipelined_errors(self):
+        """An error reply should only fail its own command"""
+        tor, sock = socket.socketpair()
+        conn = TorCtl.Connection(sock)
+        conn.launch_thread()
+        try:
+            futures = conn.sendAndRecvPipelined(['GETINFO x\r\n',
+                                                 'GETINFO version\r\n',
+                                                 'GETINFO y\r\n'])
+            tor.sendall('552 Unrecognized key "x"\r\n650 BW 1 2\r\n' +
+                        '250-version=0.2.2.13-alpha\r\n250 OK\r\n' +
+                        '552 Unrecognized key "y"\r\n')
+            self.assertRaises(TorCtl.ErrorReply, futures[0].result)
+            self.assertEqual(futures[1].result(),
+                             [('250', 'version=0.2.2.13-alpha', None),
+                              ('250', 'OK', None)])
+            self.assertRaises(TorCtl.ErrorReply, futures[2].result)
+        finally:
+            conn.close()
+            tor.close()
+
+    def test_newdesc_window(self):
+        """NEWDESC lookups should be sent PIPELINE_WINDOW at a time"""
+        consensus, descriptors, versions = fakectl.synthetic_documents(7)
+        server = fakectl.FakeControlPort(consensus, descriptors,
+                                         versions).start()
+        conn = TorCtl.Connection(server.connect())
+        conn.launch_thread()
+        window = TorCtl.PIPELINE_WINDOW
+        try:
+            conn.authenticate()
+            tracker = TorCtl.ConsensusTracker(conn)
+            batches = []
+            pipelined = conn.sendAndRecvPipelined
+            def record(msgs):
+                batches.append([msg.split()[1] for msg in msgs])
+                return pipelined(msgs)
+            conn.sendAndRecvPipelined = record
+            TorCtl.PIPELINE_WINDOW = 3
+
+            fingerprints = [fakectl.synthetic_fingerprint(i)
+                            for i in xrange(7)]
+            tracker.new_desc_event(TorCtl.NewDescEvent('NEWDESC',
+                                                       fingerprints))
+            expected = []
+            for key in ('ns/id/', 'desc/id/'):
+                for i in xrange(0, 7, 3):
+                    expected.append([key + fingerprint for fingerprint
+                                     in fingerprints[i:i + 3]])
+            self.assertEqual(batches, expected)
+        finally:
+            TorCtl.PIPELINE_WINDOW = window
+            conn.close()
+            server.stop()
+
+class TestReplyParser(TestCase):
+    """Test the fast path reply parser"""
+
+    def test_unescape_dots(self):
+        """unescape_dots should give the original line by line result"""
+        for s in ('', '.', 'a', '.a', '..a\r\nb', 'a\r\n.b\r\n', 
+                  'a\r\n..\r\n.\r\n', '\r\n', 'a\r\nb\r\n.'):
+            self.assertEqual(TorUtil.unescape_dots(s),
+                             testutil.legacy_unescape_dots(s))
+
+    def test_readblock(self):
+        """Data blocks should end at the first terminator line only"""
+        data = ('a\r\n..\r\nb.\r\n.\r\n' + '.\r\n' +
+                'x\r\n650 OKAY\r\n 650 OK\r\n650 OK\r\n' + 'tail\r\n')
+        for chunk in (1, 2, 3, 5, 64):
+            bufsock = TorUtil.BufSock(testutil.ReplaySocket(data, chunk))
+            self.assertEqual(bufsock.readblock(TorCtl.DATA_TERMINATORS),
+                             'a\r\n..\r\nb.\r\n')
+            self.assertEqual(bufsock.readblock(TorCtl.DATA_TERMINATORS), '')
+            self.assertEqual(bufsock.readblock(TorCtl.DATA_TERMINATORS),
+                             'x\r\n650 OKAY\r\n 650 OK\r\n')
+            self.assertEqual(bufsock.readline(), 'tail\r\n')
+            self.assertEqual(bufsock.readblock(TorCtl.DATA_TERMINATORS), None)
+
+class _EventRecorder(TorCtl.EventHandler):
+    """Records the BW events it handles, and counts the events it
+    decodes."""
+
+    def __init__(self):
+        TorCtl.EventHandler.__init__(self)
+        self.bandwidth = []
+        self.decoded = 0
+
+    def _decode1(self, body, data):
+        self.decoded += 1
+        return TorCtl.EventHandler._decode1(self, body, data)
+
+    def bandwidth_event(self, event):
+        self.bandwidth.append((event.read, event.written))
+
+class _CircuitListener(TorCtl.PostEventListener):
+    """Records the ids of the circuits in CIRC events."""
+
+    def __init__(self):
+        TorCtl.PostEventListener.__init__(self)
+        self.circuits = []
+
+    def circ_status_event(self, event):
+        self.circuits.append(event.circ_id)
+
+class TestLazyEvents(TestCase):
+    """Test lazy event decoding and the skipping of unhandled events"""
+
+    def test_unhandled_dropped(self):
+        """Events nobody handles should be dropped without decoding"""
+        handler = _EventRecorder()
+        handler._handle1(time.time(), [('650', 'CIRC 1 LAUNCHED', None),
+                                       ('650', 'NOTICE Hello', None)])
+        self.assertEqual(handler.decoded, 0)
+        handler._handle1(time.time(), [('650', 'BW 1 2', None)])
+        self.assertEqual(handler.decoded, 1)
+        self.assertEqual(handler.bandwidth, [(1, 2)])
+
+    def test_listener_resets_wants(self):
+        """Adding a listener should make its event types wanted"""
+        handler = _EventRecorder()
+        self.assertFalse(handler._wants('CIRC'))
+        listener = _CircuitListener()
+        handler.add_event_listener(listener)
+        self.assertTrue(handler._wants('CIRC'))
+        handler._handle1(time.time(), [('650', 'CIRC 7 BUILT $AB=x', None)])
+        self.assertEqual(listener.circuits, [7])
+        self.assertEqual(handler.decoded, 1)
+
+    def test_lazy_matches_eager(self):
+        """Fields should decode on first access to the eager result"""
+        handler = TorCtl.EventHandler()
+        for msg, data in [('CIRC 4 EXTENDED $AB=a,$CD~c PURPOSE=GENERAL',
+                           None),
+                          ('STREAM 9 NEW 0 example.com:80 SOURCE=EXIT',
+                           None),
+                          ('ORCONN $AB=a CONNECTED NCIRCS=2', None),
+                          ('BW 100 200', None),
+                          ('NEWDESC $AB=a $CD~c', None),
+                          ('NEWCONSENSUS', _CONSENSUS)]:
+            evtype = msg.split(' ', 1)[0]
+            event = TorCtl.LazyEvent(evtype, msg, data, handler._decode1)
+            self.assertEqual(event.event_name, evtype)
+            self.assertTrue('_raw' in event.__dict__)
+            eager = handler._decode1(msg, data)
+            fields = dict(eager.__dict__)
+            del fields['arrived_at']
+            if 'nslist' in fields:
+                fields['nslist'] = map(_ns_fields, fields['nslist'])
+            for name in fields:
+                value = getattr(event, name)
+                if name == 'nslist':
+                    value = map(_ns_fields, value)
+                self.assertEqual(value, fields[name])
+            self.assertTrue(event.__class__ is eager.__class__)
+            self.assertFalse('_raw' in event.__dict__)
+
+class TestSyncConnection(TestCase):
+    """Test the thread-free SyncConnection"""
+
+    def test_pipelined(self):
+        """A synchronous connection should queue events between replies"""
+        conn = TorCtl.SyncConnection(testutil.ReplaySocket(
+                   '552 Unrecognized key "x"\r\n650 BW 1 2\r\n' +
+                   '250-version=0.2.2.13-alpha\r\n250 OK\r\n', 3))
+        conn.set_event_handler(TorCtl.EventHandler())
+        futures = conn.sendAndRecvPipelined(['GETINFO x\r\n',
+                                             'GETINFO version\r\n'])
+        self.assertRaises(TorCtl.ErrorReply, futures[0].result)
+        self.assertEqual(futures[1].result()[0][1], 'version=0.2.2.13-alpha')
+        self.assertEqual(conn.get_event_queue_stats()['depth'], 1)
+
+    def test_poll_events(self):
+        """Events should only be handled when they are polled for"""
+        tor, sock = socket.socketpair()
+        conn = TorCtl.SyncConnection(sock)
+        try:
+            self.assertRaises(TorCtl.TorCtlError, conn.launch_thread)
+            conn.set_event_handler(TorCtl.EventHandler())
+            tor.sendall('650 BW 1 2\r\n650 BW 3 4\r\n')
+            self.assertEqual(conn.poll_events(5.0), 2)
+            self.assertEqual(conn.poll_events(), 0)
+        finally:
+            conn.close()
+            tor.close()
+
+class TestProtocolTrace(TestCase):
+    """Test the buffered ProtocolTrace in a temporary directory"""
+
+    def setUp(self):
+        """Make the directory for the trace files"""
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'trace')
+
+    def tearDown(self):
+        """Remove the trace files"""
+        shutil.rmtree(self.dir)
+
+    def _trace(self, **kwargs):
+        """Record a command, a reply and an event with a data block, and
+        return what was written"""
+        trace = TorUtil.ProtocolTrace(self.path, **kwargs)
+        trace.command('GETINFO version\r\n')
+        trace.reply([('250', 'version=0.2.2.13-alpha', None),
+                     ('250', 'OK', None)])
+        trace.reply([('650', 'NS', 'r moria1\n'), ('650', 'OK', None)])
+        trace.close()
+        result = open(self.path).read()
+        os.remove(self.path)
+        return result
+
+    def test_levels(self):
+        """Each level should record what it says it does"""
+        self.assertEqual(self._trace(level = 'OFF'), '')
+
+        commands = self._trace(level = 'COMMANDS')
+        self.assertTrue(commands.endswith('\t>>> GETINFO version\n'))
+        self.assertEqual(commands.count('\n'), 1)
+
+        headers = self._trace(level = 'HEADERS')
+        self.assertTrue('\t  250 version=0.2.2.13-alpha\n' in headers)
+        self.assertTrue('\t  650 NS\n+++ [9 bytes]\n' in headers)
+        self.assertFalse('moria1' in headers)
+
+        full = self._trace(level = 'FULL')
+        self.assertTrue('\t  650 NS\n+++ r moria1\n' in full)
+
+    def test_max_data(self):
+        """Data blocks over max_data bytes should only be recorded by
+        size"""
+        self.assertTrue('+++ r moria1\n' in
+                        self._trace(level = 'FULL', max_data = 9))
+        self.assertTrue('+++ [9 bytes]\n' in
+                        self._trace(level = 'FULL', max_data = 8))
+        self.assertTrue('+++ r moria1\n' in
+                        self._trace(level = 'FULL', max_data = None))
+
+    def test_rotation(self):
+        """The file should be rotated once it reaches max_bytes"""
+        trace = TorUtil.ProtocolTrace(self.path, level = 'FULL',
+                                      max_bytes = 100, backups = 2,
+                                      flush_interval = 60.0)
+        for i in xrange(5):
+            trace.write(str(i) * 59 + '\n')
+            trace.flush()
+        trace.close()
+        self.assertEqual(open(self.path).read(), '4' * 59 + '\n')
+        self.assertEqual(open(self.path + '.1').read(),
+                         '2' * 59 + '\n' + '3' * 59 + '\n')
+        self.assertEqual(open(self.path + '.2').read(),
+                         '0' * 59 + '\n' + '1' * 59 + '\n')
+        self.assertFalse(os.path.exists(self.path + '.3'))
+
+    def test_flush_on_close(self):
+        """Records should be buffered until the trace is closed"""
+        trace = TorUtil.ProtocolTrace(self.path, level = 'FULL',
+                                      flush_interval = 60.0)
+        trace.write('buffered\n')
+        self.assertEqual(open(self.path).read(), '')
+        trace.close()
+        self.assertEqual(open(self.path).read(), 'buffered\n')
+        trace.write('late\n')
+        trace.flush()
+        self.assertEqual(open(self.path).read(), 'buffered\n')
+
+def _router_fields(router):
+    """Get the fields of a TorCtl Router in a form that can be compared."""
+    fields = dict(router.__dict__)
+    fields['exitpolicy'] = [(line.match, line.ip, line.netmask, 
+                             line.port_low, line.port_high)
+                            for line in router.exitpolicy]
+    fields['version'] = str(router.version)
+    return fields
+
+class TestBuildFromDesc(TestCase):
+    """Test the keyword dispatching Router.build_from_desc"""
+
+    def setUp(self):
+        """Make up a consensus and descriptors for it"""
+        self.consensus = fakectl.synthetic_consensus(20) + _CONSENSUS
+        self.descriptors = fakectl.synthetic_descriptors(20)
+
+    def test_build_from_desc(self):
+        """Routers should be built as the original parser built them"""
+        nslist = dict([(ns.idhex, ns) for ns in
+                       TorCtl.parse_ns_body(self.consensus)])
+        pairs = []
+        for record in iter_descriptors(self.descriptors):
+            pairs.append((self.descriptors[record.start:record.end]
+                          .split('\n'), nslist[record.fingerprint]))
+        self.assertEqual(len(pairs), 20)
+        for desc, ns in pairs:
+            self.assertEqual(
+                _router_fields(TorCtl.Router.build_from_desc(desc, ns)),
+                _router_fields(testutil.legacy_build_from_desc(desc, ns)))
+
+def _ns_fields(ns):
+    """Get the fields of a NetworkStatus in a form that can be compared."""
+    return (ns.nickname, ns.idhash, ns.orhash, ns.idhex, ns.ip, ns.orport,
+            ns.dirport, list(ns.flags), ns.bandwidth, ns.updated)
+
+class TestNsBody(TestCase):
+    """Test the streaming and columnar network status parsers"""
+
+    def setUp(self):
+        """Make up a consensus"""
+        self.consensus = fakectl.synthetic_consensus(20) + _CONSENSUS
+
+    def test_ns_body(self):
+        """The network status parsers should agree with the original"""
+        expected = map(_ns_fields,
+                       testutil.legacy_parse_ns_body(self.consensus))
+        self.assertEqual(len(expected), 21)
+        self.assertEqual(map(_ns_fields, 
+                             TorCtl.iter_ns_body(self.consensus)), expected)
+        self.assertEqual(map(_ns_fields,
+                             TorCtl.parse_ns_body(self.consensus)), expected)
+        columns = TorCtl.parse_ns_columns(self.consensus)
+        self.assertEqual(columns.idhex, [f[3] for f in expected])
+        self.assertEqual([list(TorCtl.Flags(f)) for f in columns.flags],
+                         [f[7] for f in expected])
+        self.assertTrue(columns.has_flags(20, ['Authority', 'Running']))
+
+class TestFlags(TestCase):
+    """Test the interned Flags bitmasks"""
+
+    def test_flags(self):
+        """Flags should still work where a list of names was used"""
+        names = ['Exit', 'Fast', 'Running', 'Valid']
+        flags = TorCtl.Flags.parse(' '.join(names))
+        self.assertTrue(flags is TorCtl.Flags.of(names))
+        self.assertTrue('Exit' in flags)
+        self.assertFalse('Guard' in flags)
+        self.assertFalse('Unknown' in flags)
+        self.assertEqual(sorted(flags), names)
+        self.assertEqual(len(flags), 4)
+        self.assertEqual(str(flags), str(list(flags)))
+        self.assertTrue(flags & TorCtl.Flags.EXIT)
+        self.assertFalse(flags.without('Running') & TorCtl.Flags.RUNNING)
+        self.assertTrue(flags.without('Running').with_flag('Running') 
+                        is flags)
+        self.assertTrue(copy.deepcopy(flags) is flags)
+        self.assertTrue(pickle.loads(pickle.dumps(flags)) is flags)
+
+    def test_shared(self):
+        """Routers with the same flags should share one Flags object"""
+        nslist = TorCtl.parse_ns_body(fakectl.synthetic_consensus(20))
+        flags = {}
+        for ns in nslist:
+            flags.setdefault(str(ns.flags), ns.flags)
+            self.assertTrue(ns.flags is flags[str(ns.flags)])
+        self.assertTrue(len(flags) < len(nslist))
+
+class TestExitPolicy(TestCase):
+    """Test the compiled exit policies"""
+
+    def test_exit_policy(self):
+        """A compiled policy should agree with scanning its lines"""
+        masks = ['*', '18.0.0.0/8', '18.244.0.188', '128.31.0.0/16',
+                 '128.31.0.34/32', '10.0.0.0/255.0.255.0', '0.0.0.0/1']
+        ports = [('*', None), ('80', None), ('1', '1023'), ('443', '443'),
+                 ('6660', '6669'), ('1024', '65535')]
+        ips = ['18.244.0.188', '18.1.2.3', '128.31.0.34', '128.31.9.9',
+               '10.7.0.1', '10.7.1.1', '127.0.0.1', '200.1.1.1', '0.0.0.0',
+               '255.255.255.255']
+        rand = random.Random(7)
+        for i in xrange(30):
+            lines = []
+            for j in xrange(rand.randint(0, 8)):
+                port_low, port_high = rand.choice(ports)
+                lines.append(TorCtl.ExitPolicyLine(rand.random() < 0.5,
+                                                   rand.choice(masks),
+                                                   port_low, port_high))
+            policy = TorCtl.compile_exit_policy(lines)
+            for ip in ips:
+                ip_int = struct.unpack('>I', socket.inet_aton(ip))[0]
+                for port in (0, 1, 22, 79, 80, 81, 443, 1023, 1024, 6665,
+                             6670, 65535):
+                    expected = None
+                    for line in lines:
+                        match = line.check(ip, port)
+                        if match != -1:
+                            expected = match
+                            break
+                    self.assertEqual(policy.check(ip_int, port), expected)
+
+    def test_interned(self):
+        """Routers with the same policy should share one parsed copy"""
+        lines = ['reject 18.0.0.0/8:*', 'accept *:80', 'reject *:*']
+        policy = TorCtl.parse_exit_policy(lines)
+        self.assertTrue(TorCtl.parse_exit_policy(list(lines)) is policy)
+        self.assertTrue(TorCtl.parse_exit_policy(
+            ['reject 18.0.0.0/255.0.0.0:*', 'accept *:80-80',
+             'reject *:*']) is policy)
+        self.assertFalse(TorCtl.parse_exit_policy(lines[1:]) is policy)
+
+        consensus = fakectl.synthetic_consensus(5)
+        descriptors = fakectl.synthetic_descriptors(5)
+        nslist = dict([(ns.idhex, ns) for ns in
+                       TorCtl.parse_ns_body(consensus)])
+        routers = []
+        for record in iter_descriptors(descriptors):
+            routers.append(TorCtl.Router.build_from_desc(
+                descriptors[record.start:record.end].split('\n'),
+                nslist[record.fingerprint]))
+        for router in routers[1:]:
+            self.assertTrue(router.policy is routers[0].policy)
+            self.assertTrue(router.exitpolicy is routers[0].exitpolicy)
+
+    def test_copy(self):
+        """Copying or pickling a policy should give the shared one back"""
+        policy = TorCtl.parse_exit_policy(['accept *:443', 'reject *:*'])
+        self.assertTrue(copy.copy(policy) is policy)
+        self.assertTrue(copy.deepcopy(policy) is policy)
+        self.assertTrue(copy.deepcopy(policy.lines) is policy.lines)
+        self.assertTrue(pickle.loads(pickle.dumps(policy)) is policy)
+
+        router = TorCtl.Router('A' * 40, 'router', 100, False, policy,
+                               ['Exit', 'Running'], '10.0.0.1', None, None,
+                               0, None, None, False, None, None)
+        self.assertTrue(TorCtl.Router(router).policy is policy)
+        self.assertTrue(TorCtl.Router(router).exitpolicy is policy.lines)
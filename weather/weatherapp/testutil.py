@@ -0,0 +1,187 @@
+"""Helpers shared by the unit tests and the benchmarks: a socket that
+replays recorded control port data, and copies of the original TorCtl
+parsers, which the rewritten ones are checked and timed against.
+"""
+import re
+import time
+from datetime import datetime
+
+from TorCtl import TorCtl
+
+class ReplaySocket:
+    """A socket that returns recorded control port data in fixed size
+    chunks and discards everything sent to it.
+
+    @type data: str
+    @ivar data: The data to replay.
+    @type chunk: int
+    @ivar chunk: The largest number of bytes returned by one receive call.
+    """
+
+    def __init__(self, data, chunk = 65536):
+        """Replay C{data} in chunks of C{chunk} bytes."""
+        self.data = data
+        self.chunk = chunk
+        self._pos = 0
+
+    def recv(self, size):
+        """Return the next chunk of at most C{size} bytes."""
+        size = min(size, self.chunk)
+        result = self.data[self._pos:self._pos + size]
+        self._pos += len(result)
+        return result
+
+    def recv_into(self, buf):
+        """Copy the next chunk into C{buf}, returning its length."""
+        result = self.recv(len(buf))
+        buf[:len(result)] = result
+        return len(result)
+
+    def send(self, data):
+        return len(data)
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+class LegacyBufSock:
+    """The original TorCtl line reader."""
+
+    def __init__(self, s):
+        self._s = s
+        self._buf = []
+
+    def readline(self):
+        if self._buf:
+            idx = self._buf[0].find('\n')
+            if idx >= 0:
+                result = self._buf[0][:idx+1]
+                self._buf[0] = self._buf[0][idx+1:]
+                return result
+
+        while 1:
+            s = self._s.recv(128)
+            if not s: return None
+            idx = s.find('\n')
+            if idx >= 0:
+                self._buf.append(s[:idx+1])
+                result = "".join(self._buf)
+                rest = s[idx+1:]
+                if rest:
+                    self._buf = [ rest ]
+                else:
+                    del self._buf[:]
+                return result
+            else:
+                self._buf.append(s)
+
+def legacy_unescape_dots(s):
+    """The original line by line TorUtil.unescape_dots."""
+    lines = s.split("\r\n")
+    for i in xrange(len(lines)):
+        if lines[i].startswith("."):
+            lines[i] = lines[i][1:]
+    if lines and lines[-1]:
+        lines.append("")
+    return "\n".join(lines)
+
+def legacy_read_reply(bufsock):
+    """The original Connection._read_reply, without debug logging."""
+    lines = []
+    while 1:
+        line = bufsock.readline()
+        line = line.strip()
+        code = line[:3]
+        tp = line[3]
+        s = line[4:]
+        if tp == "-":
+            lines.append((code, s, None))
+        elif tp == " ":
+            lines.append((code, s, None))
+            return (lines[0][0][0] == '6'), lines
+        else:
+            more = []
+            while 1:
+                line = bufsock.readline()
+                if line in (".\r\n", ".\n", "650 OK\n", "650 OK\r\n"):
+                    break
+                more.append(line)
+            lines.append((code, s, legacy_unescape_dots("".join(more))))
+            if lines[0][0][0] == '6':
+                return True, lines
+
+def legacy_build_from_desc(desc, ns):
+    """The original TorCtl.Router.build_from_desc, which runs every pattern
+    on every line."""
+    exitpolicy = []
+    dead = not ("Running" in ns.flags)
+    bw_observed = 0
+    version = None
+    os = None
+    uptime = 0
+    ip = 0
+    router = "[none]"
+    published = "never"
+    contact = None
+
+    for line in desc:
+        rt = re.search(r"^router (\S+) (\S+)", line)
+        fp = re.search(r"^opt fingerprint (.+).*on (\S+)", line)
+        pl = re.search(r"^platform Tor (\S+).*on ([\S\s]+)", line)
+        ac = re.search(r"^accept (\S+):([^-]+)(?:-(\d+))?", line)
+        rj = re.search(r"^reject (\S+):([^-]+)(?:-(\d+))?", line)
+        bw = re.search(r"^bandwidth (\d+) \d+ (\d+)", line)
+        up = re.search(r"^uptime (\d+)", line)
+        ct = re.search(r"^contact (.+)", line)
+        pb = re.search(r"^published (\S+ \S+)", line)
+        if re.search(r"^opt hibernating 1", line):
+            dead = True 
+        if ac:
+            exitpolicy.append(TorCtl.ExitPolicyLine(True, *ac.groups()))
+        elif rj:
+            exitpolicy.append(TorCtl.ExitPolicyLine(False, *rj.groups()))
+        elif bw:
+            bws = map(int, bw.groups())
+            bw_observed = min(bws)
+            rate_limited = False
+            if bws[0] < bws[1]:
+                rate_limited = True
+        elif pl:
+            version, os = pl.groups()
+        elif up:
+            uptime = int(up.group(1))
+        elif rt:
+            router,ip = rt.groups()
+        elif pb:
+            t = time.strptime(pb.group(1)+" UTC", "20%y-%m-%d %H:%M:%S %Z")
+            published = datetime(*t[0:6])
+        elif ct:
+            contact = ct.group(1)
+    if not bw_observed and not dead and ("Valid" in ns.flags):
+        dead = True
+    return TorCtl.Router(ns.idhex, ns.nickname, bw_observed, dead, 
+                         exitpolicy, ns.flags, ip, version, os, uptime, 
+                         published, contact, rate_limited, ns.orhash, 
+                         ns.bandwidth)
+
+def legacy_parse_ns_body(data):
+    """The original TorCtl.parse_ns_body, which splits the document with
+    regular expressions."""
+    if not data: return []
+    nsgroups = re.compile(r"^r ", re.M).split(data)
+    nsgroups.pop(0)
+    nslist = []
+    for nsline in nsgroups:
+        m = re.search(r"^s((?:[ ]\S*)+)", nsline, re.M)
+        flags = m.groups()[0].strip().split(" ")
+        m = re.match(r"(\S+)\s(\S+)\s(\S+)\s(\S+\s\S+)\s(\S+)\s(\d+)\s(\d+)",
+                     nsline)
+        w = re.search(r"^w Bandwidth=(\d+)", nsline, re.M)
+        if w:
+            nslist.append(TorCtl.NetworkStatus(*(m.groups() + (flags,) +
+                                                 (int(w.group(1))*1000,))))
+        else:
+            nslist.append(TorCtl.NetworkStatus(*(m.groups() + (flags,))))
+    return nslist
@@ -4,76 +4,330 @@ the Router table by storing new routers seen in the consensus document and
 updating info relating to routers already stored. Next, each subscription is 
 checked to determine if the Subscriber should be emailed. When an email 
 notification is indicated, a tuple with the email subject, message, sender, and 
-recipient is added to the list of email tuples. Once all updates are complete, 
-Django's send_mass_mail method is called, passing in the emails tuple as a 
-parameter.
+recipient is added to the email list, which in L{run_all} is an
+L{EmailQueue<mailqueue.EmailQueue>} that queues every email in the database
+as soon as it is produced. Once all updates are complete, the background
+mail senders are woken up to deliver the queued emails.
+
+Between consensuses, a L{_RunState} remembers a digest of every router's
+state. Only routers whose digest changed are refreshed in the Router table,
+and only subscriptions following those routers, subscriptions that are new or
+whose preferences changed, and subscriptions with a due time-based trigger
+are re-evaluated. New and edited subscriptions are marked due in the
+L{TriggerDeadline} table, which the checkers also keep the time-based 
+triggers in, so only the due subscriptions and those following changed 
+routers are loaded at all. Version subscriptions are all checked when the 
+recommended versions change.
 
 @type ctl_util: CtlUtil
 @var ctl_util: A CtlUtil object for the module to handle the connection to and
-    communication with TorCtl.
-@var failed_email_file: A log file for parsed email addresses that were non-functional. 
+    communication with TorCtl, taken from L{ctlutil.pool} for each run.
+@type _BATCH_SIZE: int
+@var _BATCH_SIZE: The maximum number of rows selected by fingerprint in a 
+    single bulk UPDATE statement.
+@type _state: L{_RunState}
+@var _state: What the previous run saw, for incremental updates.
 """
 import socket, sys, os
 import threading
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import logging
-from smtplib import SMTPException
 
 from config import config
-from weatherapp.ctlutil import CtlUtil
+from weatherapp import ctlutil
 from weatherapp.models import Subscriber, Router, NodeDownSub, BandwidthSub, \
-                              TShirtSub, VersionSub, DeployedDatetime
-from weatherapp import emails
+                              TShirtSub, VersionSub, DeployedDatetime, \
+                              TriggerDeadline
+from weatherapp import emails, mailqueue
 
-from django.core.mail import send_mass_mail
+from django.db import connection, transaction
 
-failed_email_file = 'log/failed_emails.txt'
+#The maximum number of fingerprints in a single bulk UPDATE, which keeps each
+#statement below sqlite's limit of 999 query parameters
+_BATCH_SIZE = 500
 
-def check_node_down(email_list):
+def _batches(items, size = _BATCH_SIZE):
+    """Split C{items} into consecutive lists of at most C{size} items.
+
+    @type items: list
+    @param items: The list to split.
+    @type size: int
+    @param size: The maximum length of each batch.
+    @rtype: list[list]
+    @return: The list of batches.
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+class _DirtyRows:
+    """Collects the fields that the checkers change on subscriptions of one
+    type, so that only changed rows are written and rows that need the same
+    new values share a single UPDATE statement.
+
+    @type model: class
+    @ivar model: The L{Subscription} subclass whose rows are collected.
+    @type rows: dict {int: dict {str: various}}
+    @ivar rows: Maps the primary key of every changed row to its changed
+        fields and their new values.
+    """
+
+    def __init__(self, model):
+        """Start collecting changes to rows of C{model}."""
+        self.model = model
+        self.rows = {}
+
+    def set(self, sub, **fields):
+        """Set the given fields on C{sub}, remembering the fields whose value
+        actually changed.
+
+        @type sub: L{Subscription}
+        @param sub: The subscription to update.
+        """
+        for field, value in fields.items():
+            if getattr(sub, field) != value:
+                setattr(sub, field, value)
+                self.rows.setdefault(sub.pk, {})[field] = value
+
+    def flush(self):
+        """Write all collected changes, grouping rows with identical changes
+        into one UPDATE statement per batch."""
+        groups = {}
+        for pk, fields in self.rows.items():
+            groups.setdefault(tuple(sorted(fields.items())), []).append(pk)
+
+        for changes, pks in groups.items():
+            for batch in _batches(pks):
+                self.model.objects.filter(pk__in = batch).update(
+                                                            **dict(changes))
+        self.rows = {}
+
+def _confirmed_subs(model, fp_range = None):
+    """Get the subscriptions of type C{model} that belong to confirmed 
+    subscribers, with their subscriber and router fetched in the same query.
+
+    @type model: class
+    @param model: The L{Subscription} subclass to query.
+    @type fp_range: (str, str)
+    @param fp_range: If given, only subscriptions following routers whose
+        fingerprint is in this range are returned. See L{_fingerprint_ranges}.
+    @rtype: QuerySet
+    @return: The subscriptions of confirmed subscribers.
+    """
+    subs = model.objects.select_related('subscriber__router').filter(
+                                                subscriber__confirmed = True)
+    if fp_range != None:
+        low, high = fp_range
+        if low != None:
+            subs = subs.filter(subscriber__router__fingerprint__gte = low)
+        if high != None:
+            subs = subs.filter(subscriber__router__fingerprint__lt = high)
+    return subs
+
+def _due_or_changed_subs(subs, due, changed):
+    """Get the subscriptions in C{subs} that are due or whose router 
+    changed, without loading any of the others.
+
+    @type subs: QuerySet
+    @param subs: The subscriptions to choose from. See L{_confirmed_subs}.
+    @type due: set
+    @param due: The primary keys of the due subscriptions.
+    @type changed: set
+    @param changed: The fingerprints of the routers that changed.
+    @rtype: iterator
+    @return: Every chosen subscription, once.
+    """
+    seen = set()
+    for batch in _batches(list(due)):
+        for sub in subs.filter(pk__in = batch):
+            seen.add(sub.pk)
+            yield sub
+    for batch in _batches(list(changed)):
+        for sub in subs.filter(subscriber__router__fingerprint__in = batch):
+            if not sub.pk in seen:
+                yield sub
+
+def _fingerprint_ranges(count):
+    """Split the fingerprint space into C{count} ranges of equal size.
+
+    @type count: int
+    @param count: The number of ranges.
+    @rtype: list[(str, str)]
+    @return: The (inclusive lower bound, exclusive upper bound) of each 
+        range, where C{None} stands for an open end.
+    """
+    bounds = ['%04X' % (i * 0x10000 / count) for i in range(1, count)]
+    return zip([None] + bounds, bounds + [None])
+
+class _RunState:
+    """Remembers what the previous L{run_all} saw, so that the next run only
+    re-evaluates the routers and subscriptions whose state could have 
+    changed since. A run's observations only replace the previous ones once
+    L{commit} is called, so a failed run is repeated in full.
+
+    @type digests: dict {str: str}
+    @ivar digests: The router L{digests<ConsensusSnapshot.digests>} of the 
+        last committed run, or C{None} before the first one.
+    @type versions: list[str]
+    @ivar versions: The recommended versions of the last committed run.
+    @type changed: set
+    @ivar changed: Fingerprints of the routers that changed since the last
+        committed run, or C{None} if every router should be treated as
+        changed.
+    @type versions_changed: bool
+    @ivar versions_changed: Whether the recommended versions changed since 
+        the last committed run.
+    """
+
+    def __init__(self):
+        """Start with no previous run, so the first run checks everything."""
+        self.digests = None
+        self.versions = None
+        self.changed = None
+        self.versions_changed = True
+        self._next = None
+
+    def begin(self, snapshot, versions):
+        """Start a new run for the routers in C{snapshot}.
+
+        @type snapshot: L{ConsensusSnapshot}
+        @param snapshot: The snapshot of the new consensus.
+        @type versions: list[str]
+        @param versions: The currently recommended versions.
+        @rtype: set
+        @return: The fingerprints of the routers that changed since the last
+            committed run, or C{None} if all routers should be updated.
+        """
+        self.changed = snapshot.changed_since(self.digests)
+        self.versions_changed = (versions != self.versions)
+        self._next = (snapshot.digests(), versions)
+        return self.changed
+
+    def commit(self):
+        """Make the observations of the current run the ones the next run
+        is compared against."""
+        if self._next is not None:
+            self.digests, self.versions = self._next
+            self._next = None
+
+_state = _RunState()
+
+def _catch_up_avg_bandwidth(ctl_util, sub, hours_up):
+    """Account for the consensuses in which a L{TShirtSub} was skipped
+    because its router didn't change. The router's bandwidth was the 
+    L{last_bandwidth<TShirtSub.last_bandwidth>} for each hour that was
+    skipped, so the average is updated for each of them as an hourly check
+    would have updated it.
+
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance.
+    @type sub: L{TShirtSub}
+    @param sub: A triggered t-shirt subscription.
+    @type hours_up: int
+    @param hours_up: The number of hours that the router has been up.
+    @rtype: int
+    @return: The average bandwidth in kB/s over the hours before this one.
+    """
+    avg = sub.avg_bandwidth
+    if sub.last_hours == None or sub.last_bandwidth == None:
+        return avg
+
+    for hours in range(sub.last_hours + 1, hours_up):
+        avg = ctl_util.get_new_avg_bandwidth(avg, hours, sub.last_bandwidth)
+    return avg
+
+def _next_tshirt_deadline(ctl_util, sub, hours_up):
+    """Get the next time a L{TShirtSub} whose router has been up long
+    enough, but whose average bandwidth is below the threshold, can earn a
+    t-shirt if the router doesn't change. Each hourly update moves the
+    average towards the router's L{last_bandwidth<TShirtSub.last_bandwidth>},
+    so it only gets there if that bandwidth is at or above the threshold.
+    If the router changes first, the subscription is checked anyway.
+
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance.
+    @type sub: L{TShirtSub}
+    @param sub: A triggered t-shirt subscription that was just updated.
+    @type hours_up: int
+    @param hours_up: The number of hours that the router has been up.
+    @rtype: datetime
+    @return: The time of the first hourly update after which the average
+        reaches the threshold, or C{None} if it never will.
+    """
+    threshold = sub.get_threshold()
+    bandwidth = sub.last_bandwidth
+    if bandwidth == None or bandwidth < threshold:
+        return None
+
+    avg = sub.avg_bandwidth
+    hours = hours_up
+    while avg < threshold:
+        hours += 1
+        new_avg = ctl_util.get_new_avg_bandwidth(avg, hours, bandwidth)
+        #rounding can keep the average just below the bandwidth for good
+        if new_avg == avg:
+            return None
+        avg = new_avg
+    return sub.last_changed + timedelta(hours = hours)
+
+@transaction.commit_on_success
+def check_node_down(email_list, state = None, fp_range = None):
     """Check if all nodes with L{NodeDownSub} subs are up or down,
     and send emails and update sub data as necessary.
     
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type state: L{_RunState}
+    @param state: If given, only subscriptions that need it are checked.
+    @type fp_range: (str, str)
+    @param fp_range: If given, only subscriptions following routers in this
+        fingerprint range are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    #All node down subs
-    subs = NodeDownSub.objects.all()
+    dirty = _DirtyRows(NodeDownSub)
+    now = datetime.now()
+    deadlines = {}
+
+    #only check subscriptions of confirmed subscribers
+    subs = _confirmed_subs(NodeDownSub, fp_range)
+    if state != None and state.changed != None:
+        due_subs = TriggerDeadline.objects.due_subscriptions(
+                                            TriggerDeadline.NODE_DOWN, now)
+        subs = _due_or_changed_subs(subs, due_subs, state.changed)
 
     for sub in subs:
-        #only check subscriptions of confirmed subscribers
-        if sub.subscriber.confirmed:
-
-            if sub.subscriber.router.up:
-                if sub.triggered:
-                   sub.triggered = False
-                   sub.emailed = False
-                   sub.last_changed = datetime.now()
+        router = sub.subscriber.router
+
+        if router.up:
+            if sub.triggered:
+                dirty.set(sub, triggered = False, emailed = False, 
+                          last_changed = now)
+        else:
+            if sub.triggered:
+                if sub.is_grace_passed() and sub.emailed == False:
+                    recipient = sub.subscriber.email
+                    fingerprint = router.fingerprint
+                    name = router.name
+                    grace_pd = sub.grace_pd
+                    unsubs_auth = sub.subscriber.unsubs_auth
+                    pref_auth = sub.subscriber.pref_auth
+                    
+                    email = emails.node_down_tuple(recipient, fingerprint, 
+                                                   name, grace_pd,          
+                                                   unsubs_auth, pref_auth)
+                    email_list.append(email)
+                    dirty.set(sub, emailed = True)
             else:
-                if sub.triggered:
-                    if sub.is_grace_passed() and sub.emailed == False:
-                        recipient = sub.subscriber.email
-                        fingerprint = sub.subscriber.router.fingerprint
-                        name = sub.subscriber.router.name
-                        grace_pd = sub.grace_pd
-                        unsubs_auth = sub.subscriber.unsubs_auth
-                        pref_auth = sub.subscriber.pref_auth
-                        
-                        email = emails.node_down_tuple(recipient, fingerprint, 
-                                                       name, grace_pd,          
-                                                       unsubs_auth, pref_auth)
-                        email_list.append(email)
-                        sub.emailed = True 
-                else:
-                    sub.triggered = True
-                    sub.last_changed = datetime.now()
+                dirty.set(sub, triggered = True, last_changed = now)
+
+        deadlines[sub.pk] = sub.get_deadline()
 
-            sub.save()
+    dirty.flush()
+    TriggerDeadline.objects.sync(TriggerDeadline.NODE_DOWN, deadlines)
     return email_list
 
-def check_low_bandwidth(ctl_util, email_list):
+@transaction.commit_on_success
+def check_low_bandwidth(ctl_util, email_list, state = None, fp_range = None):
     """Checks all L{BandwidthSub} subscriptions, updates the information,
     determines if an email should be sent, and updates email_list.
 
@@ -81,37 +335,53 @@ def check_low_bandwidth(ctl_util, email_list):
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type state: L{_RunState}
+    @param state: If given, only subscriptions that need it are checked.
+    @type fp_range: (str, str)
+    @param fp_range: If given, only subscriptions following routers in this
+        fingerprint range are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-    subs = BandwidthSub.objects.all()
+    dirty = _DirtyRows(BandwidthSub)
+    deadlines = {}
+
+    subs = _confirmed_subs(BandwidthSub, fp_range)
+    if state != None and state.changed != None:
+        due_subs = TriggerDeadline.objects.due_subscriptions(
+                                    TriggerDeadline.BANDWIDTH, datetime.now())
+        subs = _due_or_changed_subs(subs, due_subs, state.changed)
 
     for sub in subs:
+        router = sub.subscriber.router
+        #new and edited subscriptions are only due until they are checked
+        deadlines[sub.pk] = None
 
         #TorCtl does type checking, so fingerprint needs to be converted from
         #a unicode string to a python str
-        fingerprint = str(sub.subscriber.router.fingerprint)
-
-        if sub.subscriber.confirmed:
-            bandwidth = ctl_util.get_bandwidth(fingerprint)
-            if bandwidth < sub.threshold: 
-                if sub.emailed == False:
-                    recipient = sub.subscriber.email
-                    name = sub.subscriber.router.name
-                    threshold = sub.threshold
-                    unsubs_auth = sub.subscriber.unsubs_auth
-                    pref_auth = sub.subscriber.pref_auth
-                    email_list.append(emails.bandwidth_tuple(recipient, 
-                    fingerprint, name, bandwidth, threshold, unsubs_auth,
-                    pref_auth)) 
-                    sub.emailed = True
-            else:
-                sub.emailed = False
-            sub.save()
+        fingerprint = str(router.fingerprint)
+
+        bandwidth = ctl_util.get_bandwidth(fingerprint)
+        if bandwidth < sub.threshold: 
+            if sub.emailed == False:
+                recipient = sub.subscriber.email
+                name = router.name
+                threshold = sub.threshold
+                unsubs_auth = sub.subscriber.unsubs_auth
+                pref_auth = sub.subscriber.pref_auth
+                email_list.append(emails.bandwidth_tuple(recipient, 
+                fingerprint, name, bandwidth, threshold, unsubs_auth,
+                pref_auth)) 
+                dirty.set(sub, emailed = True)
+        else:
+            dirty.set(sub, emailed = False)
 
+    dirty.flush()
+    TriggerDeadline.objects.sync(TriggerDeadline.BANDWIDTH, deadlines)
     return email_list
 
-def check_earn_tshirt(ctl_util, email_list):
+@transaction.commit_on_success
+def check_earn_tshirt(ctl_util, email_list, state = None, fp_range = None):
     """Check all L{TShirtSub} subscriptions and send an email if necessary. 
     If the node is down, the trigger flag set to False. The average 
     bandwidth is calculated if triggered is True. This method uses the 
@@ -121,62 +391,84 @@ def check_earn_tshirt(ctl_util, email_list):
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type state: L{_RunState}
+    @param state: If given, only subscriptions that need it are checked.
+    @type fp_range: (str, str)
+    @param fp_range: If given, only subscriptions following routers in this
+        fingerprint range are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
-   
-    subs = TShirtSub.objects.filter(emailed = False)
+    dirty = _DirtyRows(TShirtSub)
+    now = datetime.now()
+    deadlines = {}
+
+    subs = _confirmed_subs(TShirtSub, fp_range).filter(emailed = False)
+    if state != None and state.changed != None:
+        due_subs = TriggerDeadline.objects.due_subscriptions(
+                                            TriggerDeadline.T_SHIRT, now)
+        subs = _due_or_changed_subs(subs, due_subs, state.changed)
 
     for sub in subs:
-        if sub.subscriber.confirmed:
-
-            # first, update the database 
-            router = sub.subscriber.router
-            is_up = router.up
-            fingerprint = str(router.fingerprint)
-            if not is_up and sub.triggered:
-                # reset the data if the node goes down
-                sub.triggered = False
-                sub.avg_bandwidth = 0
-                sub.last_changed = datetime.now()
-            elif is_up:
-                descriptor = ctl_util.get_single_descriptor(fingerprint)
-                current_bandwidth = ctl_util.get_bandwidth(fingerprint)
-                if sub.triggered == False:
-                # router just came back, reset values
-                    sub.triggered = True
-                    sub.avg_bandwidth = current_bandwidth
-                    sub.last_changed = datetime.now()
-                else:
-                # update the avg bandwidth (arithmetic)
-                    hours_up = sub.get_hours_since_triggered()
-                    sub.avg_bandwidth = ctl_util.get_new_avg_bandwidth(
-                                                sub.avg_bandwidth,
-                                                hours_up,
-                                                current_bandwidth)
-
-                    #send email if needed
-                    if sub.should_email():
-                        recipient = sub.subscriber.email
-                        fingerprint = sub.subscriber.router.fingerprint
-                        name = sub.subscriber.router.name
-                        avg_band = sub.avg_bandwidth
-                        time = hours_up
-                        exit = sub.subscriber.router.exit
-                        unsubs_auth = sub.subscriber.unsubs_auth
-                        pref_auth = sub.subscriber.pref_auth
-                        
-                        email = emails.t_shirt_tuple(recipient, fingerprint,
-                                                     name, avg_band, time,
-                                                     exit, unsubs_auth, 
-                                                     pref_auth)
-                        email_list.append(email)
-                        sub.emailed = True
-
-            sub.save()
+        router = sub.subscriber.router
+
+        # first, update the database 
+        is_up = router.up
+        fingerprint = str(router.fingerprint)
+        if not is_up and sub.triggered:
+            # reset the data if the node goes down
+            dirty.set(sub, triggered = False, avg_bandwidth = 0, 
+                      last_changed = now, last_hours = None,
+                      last_bandwidth = None)
+        elif is_up:
+            current_bandwidth = ctl_util.get_bandwidth(fingerprint)
+            if sub.triggered == False:
+            # router just came back, reset values
+                dirty.set(sub, triggered = True, 
+                          avg_bandwidth = current_bandwidth,
+                          last_changed = now, last_hours = 0,
+                          last_bandwidth = current_bandwidth)
+            else:
+            # update the avg bandwidth (arithmetic)
+                hours_up = sub.get_hours_since_triggered()
+                avg_bandwidth = ctl_util.get_new_avg_bandwidth(
+                                    _catch_up_avg_bandwidth(ctl_util, sub,
+                                                            hours_up),
+                                    hours_up,
+                                    current_bandwidth)
+                dirty.set(sub, avg_bandwidth = avg_bandwidth,
+                          last_hours = hours_up,
+                          last_bandwidth = current_bandwidth)
+
+                #send email if needed
+                if sub.should_email():
+                    recipient = sub.subscriber.email
+                    name = router.name
+                    avg_band = sub.avg_bandwidth
+                    exit = router.exit
+                    unsubs_auth = sub.subscriber.unsubs_auth
+                    pref_auth = sub.subscriber.pref_auth
+                    
+                    email = emails.t_shirt_tuple(recipient, fingerprint,
+                                                 name, avg_band, hours_up,
+                                                 exit, unsubs_auth, 
+                                                 pref_auth)
+                    email_list.append(email)
+                    dirty.set(sub, emailed = True)
+                elif hours_up >= 1464:
+                    #up long enough, but the average is too low
+                    deadlines[sub.pk] = _next_tshirt_deadline(ctl_util, sub,
+                                                              hours_up)
+                    continue
+
+        deadlines[sub.pk] = sub.get_deadline()
+
+    dirty.flush()
+    TriggerDeadline.objects.sync(TriggerDeadline.T_SHIRT, deadlines)
     return email_list
 
-def check_version(ctl_util, email_list):
+@transaction.commit_on_success
+def check_version(ctl_util, email_list, state = None, fp_range = None):
     """Check/update all C{VersionSub} subscriptions and send emails as
     necessary.
 
@@ -184,77 +476,154 @@ def check_version(ctl_util, email_list):
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type state: L{_RunState}
+    @param state: If given, only subscriptions that need it are checked.
+    @type fp_range: (str, str)
+    @param fp_range: If given, only subscriptions following routers in this
+        fingerprint range are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send."""
+    dirty = _DirtyRows(VersionSub)
+    deadlines = {}
 
-    subs = VersionSub.objects.all()
+    subs = _confirmed_subs(VersionSub, fp_range)
+    #every version subscription is due when the recommended versions change
+    if state != None and state.changed != None and \
+            not state.versions_changed:
+        due_subs = TriggerDeadline.objects.due_subscriptions(
+                                    TriggerDeadline.VERSION, datetime.now())
+        subs = _due_or_changed_subs(subs, due_subs, state.changed)
 
     for sub in subs:
-        if sub.subscriber.confirmed:
-            version_type = ctl_util.get_version_type(
-                           str(sub.subscriber.router.fingerprint))
-
-            if version_type != 'ERROR':
-                if (version_type == 'OBSOLETE' or sub.notify_type == \
-                    version_type): 
-                    if sub.emailed == False:
-                
-                        fingerprint = sub.subscriber.router.fingerprint
-                        name = sub.subscriber.router.name
-                        recipient = sub.subscriber.email
-                        unsubs_auth = sub.subscriber.unsubs_auth
-                        pref_auth = sub.subscriber.pref_auth
-                        email_list.append(emails.version_tuple(recipient,     
-                                                               fingerprint,
-                                                               name,
-                                                               version_type,
-                                                               unsubs_auth,
-                                                               pref_auth))
-                        sub.emailed = True
-
-            #if the user has their desired version type, we need to set emailed
-            #to False so that we can email them in the future if we need to
-                else:
-                    sub.emailed = False
-
+        router = sub.subscriber.router
+        #new and edited subscriptions are only due until they are checked
+        deadlines[sub.pk] = None
+        fingerprint = str(router.fingerprint)
+        version_type = ctl_util.get_version_type(fingerprint)
+
+        if version_type != 'ERROR':
+            if (version_type == 'OBSOLETE' or sub.notify_type == \
+                version_type): 
+                if sub.emailed == False:
+            
+                    name = router.name
+                    recipient = sub.subscriber.email
+                    unsubs_auth = sub.subscriber.unsubs_auth
+                    pref_auth = sub.subscriber.pref_auth
+                    email_list.append(emails.version_tuple(recipient,     
+                                                           fingerprint,
+                                                           name,
+                                                           version_type,
+                                                           unsubs_auth,
+                                                           pref_auth))
+                    dirty.set(sub, emailed = True)
+
+        #if the user has their desired version type, we need to set emailed
+        #to False so that we can email them in the future if we need to
             else:
-                logging.info("Couldn't parse the version relay %s is running" \
-                              % fingerprint)
+                dirty.set(sub, emailed = False)
 
-            sub.save()
+        else:
+            logging.info("Couldn't parse the version relay %s is running" \
+                          % fingerprint)
 
+    dirty.flush()
+    TriggerDeadline.objects.sync(TriggerDeadline.VERSION, deadlines)
     return email_list
         
                 
-def check_all_subs(ctl_util, email_list):
+def check_all_subs(ctl_util, email_list, state = None, fp_range = None):
     """Check/update all subscriptions
    
     @type ctl_util: CtlUtil
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type state: L{_RunState}
+    @param state: If given, only subscriptions that need it are checked.
+    @type fp_range: (str, str)
+    @param fp_range: If given, only subscriptions following routers in this
+        fingerprint range are checked.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
     logging.debug('Checking node down subscriptions.')
-    email_list = check_node_down(email_list)
+    email_list = check_node_down(email_list, state, fp_range)
     logging.debug('Checking version subscriptions.')
-    check_version(email_list)
+    email_list = check_version(ctl_util, email_list, state, fp_range)
     logging.debug('Checking bandwidth subscriptions.')
-    check_low_bandwidth(email_list)
+    email_list = check_low_bandwidth(ctl_util, email_list, state, fp_range)
     logging.debug('Checking shirt subscriptions.')
-    email_list = check_earn_tshirt(email_list)
+    email_list = check_earn_tshirt(ctl_util, email_list, state, fp_range)
     return email_list
 
-def update_all_routers(ctl_util, email_list):
+def check_all_subs_parallel(ctl_util, email_list, state = None, workers = 1):
+    """Check/update all subscriptions on C{workers} threads. The 
+    subscriptions are partitioned by the fingerprint of the router they
+    follow, so that every subscription is checked by exactly one thread.
+    Each thread uses its own database connection, reads routers from
+    the shared C{ctl_util}, which should have a snapshot loaded, and adds its
+    emails to the shared C{email_list}. The threads share the interpreter 
+    lock, so they only overlap database and Tor round trips and don't make
+    the checks themselves run on more cores.
+
+    @type ctl_util: CtlUtil
+    @param ctl_util: A valid CtlUtil instance.
+    @type email_list: list
+    @param email_list: The list of tuples representing emails to send.
+    @type state: L{_RunState}
+    @param state: If given, only subscriptions that need it are checked.
+    @type workers: int
+    @param workers: The number of threads to use.
+    @rtype: list
+    @return: The updated list of tuples representing emails to send.
+    """
+    if workers <= 1:
+        return check_all_subs(ctl_util, email_list, state)
+
+    ranges = _fingerprint_ranges(workers)
+    errors = []
+
+    def check_partition(index):
+        try:
+            try:
+                check_all_subs(ctl_util, email_list, state, ranges[index])
+            except Exception:
+                errors.append(sys.exc_info())
+        finally:
+            #Django opens one connection per thread
+            connection.close()
+
+    threads = [threading.Thread(target = check_partition, args = (i,),
+                                name = 'SubsChecker-%d' % i)
+               for i in range(len(ranges))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        tp, ex, tb = errors[0]
+        raise tp, ex, tb
+
+    return email_list
+
+@transaction.commit_on_success
+def update_all_routers(ctl_util, email_list, changed = None):
     """Add ORs we haven't seen before to the database and update the
     information of ORs that are already in the database. Check if a welcome
-    email should be sent and add the email tuples to the list.
+    email should be sent and add the email tuples to the list. All changes
+    are made in a single transaction, and routers whose name, exit flag and
+    welcomed flag are unchanged are updated with bulk UPDATE statements
+    rather than one save() each.
 
     @type ctl_util: CtlUtil
     @param ctl_util: A valid CtlUtil instance.
     @type email_list: list
     @param email_list: The list of tuples representing emails to send.
+    @type changed: set
+    @param changed: If given, only the routers with these fingerprints are
+        refreshed, and every other router keeps its up flag.
     @rtype: list
     @return: The updated list of tuples representing emails to send.
     """
@@ -273,30 +642,45 @@ def update_all_routers(ctl_util, email_list):
         fully_deployed = False
     else:
         fully_deployed = True
-    
-    router_set = Router.objects.all()
-    for router in router_set:
-        #remove routers from the db that we haven't seen for more than a year 
-        if (datetime.now() - router.last_seen).days > 365:
-            router.delete()
-        #Set the 'up' flag to False for every router
-        else:
-            router.up = False
-            router.save()
-    
+
+    now = datetime.now()
+
+    #remove routers from the db that we haven't seen for more than a year 
+    Router.objects.filter(last_seen__lte = now - timedelta(days = 366)).delete()
+
     #Get a list of fingerprint/name tuples in the current descriptor file
     finger_name = ctl_util.get_finger_name_list()
 
+    #Look up the routers we already know about in memory rather than with one
+    #query per router
+    if changed == None:
+        #Set the 'up' flag to False for every router
+        Router.objects.update(up = False)
+        known_routers = dict([(router.fingerprint, router) for router in 
+                              Router.objects.all()])
+    else:
+        finger_name = [router for router in finger_name 
+                       if router[0] in changed]
+        known_routers = {}
+        for batch in _batches(list(changed)):
+            for router in Router.objects.filter(fingerprint__in = batch):
+                known_routers[router.fingerprint] = router
+
+    #Routers that only need last_seen and up refreshed
+    unchanged = []
+    #Routers that are up or hibernating
+    seen = set()
+
     for router in finger_name:
         finger = router[0]
         name = router[1]
 
         if ctl_util.is_up_or_hibernating(finger):
+            seen.add(finger)
+            is_exit = ctl_util.is_exit(finger)
 
-            router_data = None
-            try:
-                router_data = Router.objects.get(fingerprint = finger)
-            except:
+            router_data = known_routers.get(finger)
+            if router_data == None:
                 if fully_deployed:
                     router_data = Router(name = name, fingerprint = finger,
                                          welcomed = False)
@@ -305,11 +689,16 @@ def update_all_routers(ctl_util, email_list):
                     #when  Weather was deployed, so set welcomed to True
                     router_data = Router(name = name, fingerprint = finger,
                                          welcomed = True)           
+                known_routers[finger] = router_data
+            elif router_data.name == name and router_data.exit == is_exit \
+                    and router_data.welcomed:
+                unchanged.append(finger)
+                continue
             
-            router_data.last_seen = datetime.now()
+            router_data.last_seen = now
             router_data.name = name
             router_data.up = True
-            router_data.exit = ctl_util.is_exit(finger)
+            router_data.exit = is_exit
 
             #send a welcome email if indicated
             if router_data.welcomed == False and ctl_util.is_stable(finger):
@@ -321,27 +710,45 @@ def update_all_routers(ctl_util, email_list):
 
             router_data.save()
 
-    return email_list
+    for batch in _batches(unchanged):
+        Router.objects.filter(fingerprint__in = batch).update(last_seen = now,
+                                                              up = True)
 
-def run_all():
-    """Run all updaters/checkers in proper sequence, then send emails."""
+    if changed != None:
+        went_down = [fingerprint for fingerprint in changed
+                     if fingerprint not in seen]
+        for batch in _batches(went_down):
+            Router.objects.filter(fingerprint__in = batch).update(up = False)
+        #The remaining routers that are up didn't change, so they are still up
+        Router.objects.filter(up = True).update(last_seen = now)
 
-    #The CtlUtil for all methods to use
-    ctl_util = CtlUtil()
+    return email_list
 
-    # the list of tuples of email info, gets updated w/ each call
-    email_list = []
-    email_list = update_all_routers(ctl_util, email_list)
-    logging.info('Finished updating routers. About to check all subscriptions.')
-    email_list = check_all_subs(ctl_util, email_list)
-    logging.info('Finished checking subscriptions. About to send emails.')
-    mails = tuple(email_list)
+def run_all():
+    """Run all updaters/checkers in proper sequence, queueing emails as they
+    are produced, then wake up the mail senders, if they were started."""
 
+    #The CtlUtil for all methods to use, with a warm connection if possible
+    ctl_util = ctlutil.pool.acquire()
     try:
-        send_mass_mail(mails, fail_silently = False)
-    except SMTPException, e:
-        logging.info(e)
-        failed = open(failed_email_file, 'w')
-        failed.write(e + '\n')
-        failed.close()
-    logging.info('Finished sending emails.')
+        #Fetch the consensus and descriptors once, rather than once per router
+        snapshot = ctl_util.load_snapshot()
+        changed = _state.begin(snapshot, ctl_util.get_rec_version_list())
+        if changed != None:
+            logging.info('%d routers changed since the last consensus.' % 
+                         len(changed))
+
+        # the queue of emails, gets updated w/ each call
+        email_list = mailqueue.EmailQueue()
+        email_list = update_all_routers(ctl_util, email_list, changed)
+        logging.info('Finished updating routers. About to check all ' + \
+                     'subscriptions.')
+        email_list = check_all_subs_parallel(ctl_util, email_list, _state,
+                                             config.check_workers)
+        _state.commit()
+        logging.info('Finished checking subscriptions. Queued %d emails.' %
+                     len(email_list))
+    finally:
+        ctlutil.pool.release(ctl_util)
+
+    mailqueue.wake()